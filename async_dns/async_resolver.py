@@ -1,53 +1,83 @@
 import asyncio
+import socket
+import struct
 
-from asyncdns.enums import QType, QClass
+from async_dns.resolver import answers_of, first_answer
+from async_dns.tcp_pool import DnsTcpPool
+from asyncdns.cache import STALE_TTL, DnsCache, cache_key
+from asyncdns.cache_store import load_cache, save_cache
+from asyncdns.enums import QType, QClass, ResponseCode
 from asyncdns.resolve_req import ResolveRequest
-from asyncdns.resolve_rsp import ResolveResponse
-from utils.util import pull
+from asyncdns.resolve_rsp import decode_response, demux_answers
+from asyncdns.singleflight import SingleFlight
+from asyncdns.upstreams import DEFAULT_UPSTREAMS, UpstreamSet
+from exc import DnsResolveTimeout, DnsRspRecvErr
+from utils.loggers import get_logger
 
 HOST = "8.8.8.8"
 PORT = 53
 
+QUERY_TIMEOUT = 1.0
+QUERY_RETRIES = 2
+RCVBUF_SIZE = 1 << 20
+BATCH_SIZE = 8
+PREFETCH_INTERVAL = 5.0
+SNAPSHOT_INTERVAL = 60.0
+
+# what a server that takes a single question per query answers to more
+SPLIT_RCODES = (
+    ResponseCode.FMT_ERR.value,
+    ResponseCode.NOT_IMPL.value,
+    ResponseCode.REFUSED.value,
+)
+
+log = get_logger("async-resolver")
+
 
 class DnsProtocol:
-    
-    def __init__(self, loop):
+
+    def __init__(self, loop, remote_addr=(HOST, PORT)):
         self._loop = loop
+        self._remote_addr = remote_addr
         self._transport = None
         self._on_resolve = loop.create_future()
         self._on_lost = loop.create_future()
         self._answers = None
-    
+        self._query_id = None
+
     def connection_made(self, transport):
         print("connected")
         self._transport = transport
 
     def datagram_received(self, data, addr):
-        if addr != (HOST, PORT):
+        if (
+            tuple(addr[:2]) != self._remote_addr
+            or len(data) < 12
+            or struct.unpack_from("!H", data)[0] != self._query_id
+        ):
             print("received:", data)
             return None
         else:
-            header, questions, answers, authorities = pull(
-                ResolveResponse(), data
-            )
+            header, questions, answers = decode_response(data)[:3]
             self._answers = answers
             self._on_resolve.set_result(self._answers)
 
     def error_received(self, exc):
         print("Error received", exc)
-        
+
     def connection_lost(self, exc):
         print("connection lost")
         self._on_lost.set_result(True)
-        
+
     def resolve(self, hostnames, qtype=QType.QTYPE_A, qclass=QClass.QCLASS_IN):
         if isinstance(hostnames, bytes):
             hostnames = [hostnames]
         else:
             hostnames = [h.encode("utf8") for h in hostnames]
-        req = ResolveRequest(hostnames, qtype, qclass).to_bytes()
-        self._transport.sendto(req)
-        
+        req = ResolveRequest(hostnames, qtype, qclass)
+        self._query_id = req.query_id
+        self._transport.sendto(req.to_bytes())
+
     @property
     def resolved(self):
         return self._on_resolve
@@ -55,13 +85,464 @@ class DnsProtocol:
     @property
     def on_lost(self):
         return self._on_lost
-    
+
+
+class MultiplexDnsProtocol(DnsProtocol):
+    """
+    DnsProtocol on an unconnected socket that keeps any number of queries
+    in flight, to any number of servers, and hands each reply to the
+    future registered under its transaction ID. A reply only counts when
+    it comes from a server the query was sent to.
+    """
+
+    def __init__(self, loop):
+        super().__init__(loop)
+        self._pending = {}
+
+    def connection_made(self, transport):
+        self._transport = transport
+        sock = transport.get_extra_info("socket")
+        try:
+            # replies to a burst of queries arrive back to back
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+        except OSError:
+            pass
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return None
+        pending = self._pending.get(struct.unpack_from("!H", data)[0])
+        addr = tuple(addr[:2])
+        if pending is None or addr not in pending[1]:
+            return None
+        fut = pending[0]
+        if fut.done():
+            return None
+        try:
+            response = decode_response(data)
+        except Exception as e:
+            log.info("malformed dns response: %r" % e)
+            return None
+        fut.set_result((response, addr))
+
+    def error_received(self, exc):
+        log.info("dns socket error: %r" % exc)
+
+    def connection_lost(self, exc):
+        pending, self._pending = self._pending, {}
+        for fut, _ in pending.values():
+            if not fut.done():
+                fut.set_exception(exc or ConnectionAbortedError())
+        if not self._on_lost.done():
+            self._on_lost.set_result(True)
+
+    def is_pending(self, query_id):
+        return query_id in self._pending
+
+    def query(self, query_id, req, addr):
+        pending = self._pending.get(query_id)
+        if pending is None:
+            pending = self._pending[query_id] = (
+                self._loop.create_future(),
+                set(),
+            )
+        pending[1].add(addr)
+        self._transport.sendto(req, addr)
+        return pending[0]
+
+    def forget(self, query_id):
+        self._pending.pop(query_id, None)
+
+
+class AsyncDnsResolver:
+    """
+    Non-blocking resolver on a datagram endpoint. Replies are matched to
+    queries by transaction ID and source, so thousands of lookups can
+    share one socket per address family; a query unanswered after
+    QUERY_TIMEOUT is sent again, up to QUERY_RETRIES times, with the
+    timeout doubling each time.
+
+    Queries go to the fastest of the configured upstreams (``host`` first,
+    then ``upstreams``), judged by moving averages of their round trip
+    times and losses, and are hedged on a second one when slow.
+
+    Every PREFETCH_INTERVAL the entries clients keep hitting are renewed
+    before they expire. With ``serve_stale`` an expired answer is handed
+    out at once while a fresh one is fetched in the background.
+
+    With ``cache_file`` the cache survives restarts: it is saved there
+    every SNAPSHOT_INTERVAL and by save(), and what the file holds is
+    loaded entry by entry as names are first looked up.
+
+    Same resolve() signature as async_dns.resolver.DnsResolver.
+    """
+
+    def __init__(
+        self,
+        loop,
+        host=None,
+        port=53,
+        cache=None,
+        prefetch=True,
+        serve_stale=False,
+        upstreams=None,
+        cache_file=None,
+    ):
+        self._loop = loop
+        upstreams = ([(host, port)] if host else []) + list(upstreams or ())
+        self._upstreams = UpstreamSet(upstreams or DEFAULT_UPSTREAMS)
+        if cache is None:
+            cache = DnsCache(stale_ttl=STALE_TTL if serve_stale else 0.0)
+        self._cache = cache
+        self._cache_file = cache_file
+        self._snapshot_timer = None
+        if cache_file:
+            load_cache(cache, cache_file)
+        self._flights = SingleFlight(loop)
+        self._tcp = DnsTcpPool(loop)
+        self._transports = {}
+        self._protocols = {}
+        self._connecting = {}
+        self._batching = True
+        self._prefetch = prefetch
+        self._serve_stale = serve_stale
+        self._prefetch_timer = None
+        self.batches = 0
+        self.split_batches = 0
+        self.prefetches = 0
+        self.revalidations = 0
+        self.hedges = 0
+        self.tcp_fallbacks = 0
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def flights(self):
+        return self._flights
+
+    @property
+    def upstreams(self):
+        return self._upstreams
+
+    @property
+    def tcp(self):
+        return self._tcp
+
+    async def _endpoint(self, family):
+        protocol = self._protocols.get(family)
+        if protocol and not protocol.on_lost.done():
+            return protocol
+        if self._prefetch and self._prefetch_timer is None:
+            self._prefetch_timer = self._loop.call_later(
+                PREFETCH_INTERVAL, self._prefetch_expiring
+            )
+        if self._cache_file and self._snapshot_timer is None:
+            self._snapshot_timer = self._loop.call_later(
+                SNAPSHOT_INTERVAL, self._save_periodically
+            )
+        connecting = self._connecting.get(family)
+        if connecting is None:
+            connecting = self._connecting[family] = self._loop.create_task(
+                self._loop.create_datagram_endpoint(
+                    lambda: MultiplexDnsProtocol(self._loop), family=family
+                )
+            )
+        try:
+            transport, protocol = await asyncio.shield(connecting)
+        finally:
+            self._connecting.pop(family, None)
+        self._transports[family] = transport
+        self._protocols[family] = protocol
+        return protocol
+
+    async def _query(self, hostnames, qtype, qclass):
+        """
+        Ask the upstream with the best score. When it has not answered
+        within its hedge delay the next best one is asked as well, with the
+        same transaction ID, and the first reply wins. Every retry moves
+        on to the next upstream.
+        """
+        ranked = self._upstreams.ranked()
+        protocols = {}
+        for upstream in ranked:
+            if upstream.family not in protocols:
+                protocols[upstream.family] = await self._endpoint(
+                    upstream.family
+                )
+        req = ResolveRequest(hostnames, qtype, qclass)
+        while any(p.is_pending(req.query_id) for p in protocols.values()):
+            req = ResolveRequest(hostnames, qtype, qclass)
+        data = req.to_bytes()
+        sent = {}
+        futs = set()
+
+        def ask(upstream):
+            upstream.on_sent()
+            sent[upstream] = self._loop.time()
+            futs.add(
+                protocols[upstream.family].query(
+                    req.query_id, data, upstream.addr
+                )
+            )
+            return upstream
+
+        async def first_reply(timeout):
+            done, _ = await asyncio.wait(
+                futs, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            return done.pop().result() if done else None
+
+        timeout = QUERY_TIMEOUT
+        try:
+            for attempt in range(QUERY_RETRIES + 1):
+                asked = [ask(ranked[attempt % len(ranked)])]
+                deadline = self._loop.time() + timeout
+                reply = None
+                if len(ranked) > 1:
+                    reply = await first_reply(asked[0].hedge_delay)
+                    if reply is None:
+                        self.hedges += 1
+                        asked.append(ask(ranked[(attempt + 1) % len(ranked)]))
+                if reply is None:
+                    reply = await first_reply(
+                        max(deadline - self._loop.time(), 0)
+                    )
+                now = self._loop.time()
+                if reply is not None:
+                    response, addr = reply
+                    winner = self._upstreams.get(addr)
+                    winner.on_answer(now - sent[winner])
+                    for upstream in asked:
+                        if upstream is not winner:
+                            upstream.on_late(now - sent[upstream])
+                    if response.header.truncated:
+                        return await self._query_tcp(addr, data, response)
+                    return response
+                for upstream in asked:
+                    upstream.on_timeout(now - sent[upstream])
+                timeout *= 2
+        finally:
+            for protocol in protocols.values():
+                protocol.forget(req.query_id)
+        raise DnsResolveTimeout(hostnames)
+
+    async def _query_tcp(self, addr, data, truncated):
+        """
+        Ask again over TCP the server whose UDP answer did not fit; if
+        that fails too, the truncated answer is all there is.
+        """
+        self.tcp_fallbacks += 1
+        try:
+            return await self._tcp.query(addr, data)
+        except (OSError, asyncio.TimeoutError, DnsRspRecvErr) as e:
+            log.info("dns over tcp to %r failed: %r" % (addr, e))
+            return truncated
+
+    async def resolve(
+        self, hostnames, qtype=QType.QTYPE_A, qclass=QClass.QCLASS_IN
+    ):
+        if isinstance(hostnames, (bytes, str)):
+            hostnames = [hostnames]
+        hostnames = [
+            h.encode("utf8") if isinstance(h, str) else h for h in hostnames
+        ]
+        if len(hostnames) == 1:
+            return first_answer(
+                await self._answers(hostnames[0], qtype, qclass), qtype
+            )
+        return first_answer(
+            await self._lookup(hostnames, qtype, qclass), qtype
+        )
+
+    async def resolve_all(
+        self, hostname, qtype=QType.QTYPE_A, qclass=QClass.QCLASS_IN
+    ):
+        """
+        Every record of ``qtype`` for one name, in the order the server
+        gave them, without the CNAMEs that led there.
+        """
+        if isinstance(hostname, str):
+            hostname = hostname.encode("utf8")
+        return answers_of(await self._answers(hostname, qtype, qclass), qtype)
+
+    async def _answers(self, hostname, qtype, qclass):
+        entry = self._cache.get(hostname, qtype, stale=self._serve_stale)
+        if entry is not None:
+            if self._cache.is_stale(entry):
+                self.revalidations += 1
+                self._refresh([hostname], qtype, qclass)
+            return entry.answers
+        # concurrent lookups of one name share a single query
+        key = cache_key(hostname, qtype) + (qclass,)
+        return await self._flights.do(
+            key, self._lookup, [hostname], qtype, qclass
+        )
+
+    async def _lookup(self, hostnames, qtype, qclass):
+        try:
+            response = await self._query(hostnames, qtype, qclass)
+        except (DnsResolveTimeout, OSError) as e:
+            log.info("resolve %r failed: %r" % (hostnames, e))
+            return None
+        header, answers = response.header, response.answers
+        # still cut off when the TCP retry failed: use it, do not keep it
+        if len(hostnames) == 1 and not header.truncated:
+            self._cache.put(hostnames[0], qtype, answers, header.rcode)
+        return answers
+
+    async def resolve_many(
+        self,
+        hostnames,
+        qtype=QType.QTYPE_A,
+        qclass=QClass.QCLASS_IN,
+        batch_size=BATCH_SIZE,
+        refresh=False,
+    ):
+        """
+        Resolve several names at once, asking up to ``batch_size`` of those
+        neither cached nor already in flight in a single query. Returns a
+        dict from each name to its first answer, or None. ``refresh`` asks
+        again for names still in the cache, to renew them.
+        """
+        hostnames = [
+            h.encode("utf8") if isinstance(h, str) else h for h in hostnames
+        ]
+        results = {}
+        misses = []
+        for hostname in hostnames:
+            entry = None if refresh else self._cache.get(hostname, qtype)
+            if entry is not None:
+                results[hostname] = first_answer(entry.answers, qtype)
+            elif hostname not in misses:
+                misses.append(hostname)
+
+        batches = {}
+        if self._batching:
+            fresh = [
+                h
+                for h in misses
+                if cache_key(h, qtype) + (qclass,) not in self._flights
+            ]
+            for i in range(0, len(fresh), batch_size):
+                names = fresh[i : i + batch_size]
+                if len(names) < 2:
+                    break
+                batch = self._loop.create_task(
+                    self._lookup_batch(names, qtype, qclass)
+                )
+                batches.update((name, batch) for name in names)
+
+        def lookup(hostname):
+            # registered per name, so a resolve() of one of them joins in
+            key = cache_key(hostname, qtype) + (qclass,)
+            batch = batches.get(hostname)
+            if batch is None:
+                return self._flights.do(
+                    key, self._lookup, [hostname], qtype, qclass
+                )
+            return self._flights.do(
+                key, self._from_batch, batch, hostname, qtype, qclass
+            )
+
+        answers = await asyncio.gather(*[lookup(h) for h in misses])
+        results.update(
+            (h, first_answer(a, qtype)) for h, a in zip(misses, answers)
+        )
+        return results
+
+    async def _from_batch(self, batch, hostname, qtype, qclass):
+        answers = await asyncio.shield(batch)
+        if answers is None:
+            return await self._lookup([hostname], qtype, qclass)
+        return answers.get(cache_key(hostname, qtype))
+
+    async def _lookup_batch(self, hostnames, qtype, qclass):
+        """
+        Ask every name in one query and split the reply by question. None
+        tells the callers to fall back to one query per name.
+        """
+        try:
+            response = await self._query(hostnames, qtype, qclass)
+        except (DnsResolveTimeout, OSError) as e:
+            log.info("resolve %r failed: %r" % (hostnames, e))
+            return None
+        header = response.header
+        if header.rcode in SPLIT_RCODES or len(response.questions) != len(
+            hostnames
+        ):
+            log.info("server takes one question per query, not batching")
+            self._batching = False
+            self.split_batches += 1
+            return None
+        if header.rcode != ResponseCode.NO_ERR.value or header.truncated:
+            # an NXDOMAIN or a cut off answer does not say which name it
+            # is about, ask them one by one
+            self.split_batches += 1
+            return None
+        self.batches += 1
+        answers = demux_answers(response.questions, response.answers)
+        for (name, qtype_), records in answers.items():
+            self._cache.put(name, qtype_, records, header.rcode)
+        return answers
+
+    def _refresh(self, hostnames, qtype, qclass=QClass.QCLASS_IN):
+        self._loop.create_task(
+            self.resolve_many(hostnames, qtype, qclass, refresh=True)
+        )
+
+    def _prefetch_expiring(self):
+        self._cache.sweep()
+        # the scan must come round again before what it skips expires
+        by_qtype = {}
+        for name, qtype in self._cache.expiring(2 * PREFETCH_INTERVAL):
+            by_qtype.setdefault(qtype, []).append(name)
+        for qtype, names in by_qtype.items():
+            self.prefetches += len(names)
+            self._refresh(names, qtype)
+        self._prefetch_timer = self._loop.call_later(
+            PREFETCH_INTERVAL, self._prefetch_expiring
+        )
+
+    def save(self):
+        """
+        Write the cache to ``cache_file``, if there is one.
+        """
+        if not self._cache_file:
+            return
+        try:
+            saved = save_cache(self._cache, self._cache_file)
+        except OSError as e:
+            log.info("saving dns cache to %s: %r" % (self._cache_file, e))
+            return
+        log.info("saved %u dns records to %s" % (saved, self._cache_file))
+
+    def _save_periodically(self):
+        self.save()
+        self._snapshot_timer = self._loop.call_later(
+            SNAPSHOT_INTERVAL, self._save_periodically
+        )
+
+    def close(self):
+        if self._prefetch_timer:
+            self._prefetch_timer.cancel()
+            self._prefetch_timer = None
+        if self._snapshot_timer:
+            self._snapshot_timer.cancel()
+            self._snapshot_timer = None
+        self.save()
+        self._tcp.close()
+        transports, self._transports = self._transports, {}
+        for transport in transports.values():
+            transport.close()
+
 
 async def main(loop):
     transport, protocol = await loop.create_datagram_endpoint(
-        lambda: DnsProtocol(loop),
-        remote_addr=(HOST, PORT))
-    
+        lambda: DnsProtocol(loop), remote_addr=(HOST, PORT)
+    )
+
     try:
         protocol.resolve(b"google.com")
         resolved = await protocol.resolved
@@ -74,6 +555,6 @@ async def main(loop):
         transport.close()
 
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     mloop = asyncio.get_event_loop()
     mloop.run_until_complete(main(mloop))
@@ -1,37 +1,154 @@
 from functools import partial
 import asyncio
+from asyncdns.cache import DnsCache, cache_key
 from asyncdns.enums import QType, QClass
 from asyncdns.resolve_req import ResolveRequest
-from asyncdns.resolve_rsp import ResolveResponse
+from asyncdns.resolve_rsp import decode_response
+from asyncdns.singleflight import SingleFlight
+from asyncdns.upstreams import DEFAULT_UPSTREAMS, UpstreamSet
+from async_dns.tcp_pool import query_once
 from concurrent.futures import ThreadPoolExecutor
-from lrucache import LRUCache
-from utils.util import pull
+from exc import DnsRspRecvErr
+import select
 import socket
-
+import struct
+import time
 
 HOST = "8.8.8.8"
 PORT = 53
 
+QUERY_TIMEOUT = 2.0
+RECV_SIZE = 4096
+
 
 pool = ThreadPoolExecutor(max_workers=10)
 
 
+def first_answer(answers, qtype):
+    qtype = getattr(qtype, "value", qtype)
+    for answer in answers or []:
+        if answer.type == qtype:
+            return answer
+    return None
+
+
+def answers_of(answers, qtype):
+    qtype = getattr(qtype, "value", qtype)
+    return [answer for answer in answers or [] if answer.type == qtype]
+
+
 class DnsResolver:
-    def __init__(self, loop, host, port):
+    """
+    Blocking lookups run on a thread pool. Each one asks the best scoring
+    of the upstreams (``host`` first, then ``upstreams``) and, when that
+    one is slower than its hedge delay, the next one too; the first reply
+    whose transaction ID and source match is taken.
+
+    The pool threads only record what happened to each upstream; the
+    scores are ranked and updated on the loop thread, like the cache.
+    """
+
+    def __init__(self, loop, host=None, port=53, cache=None, upstreams=None):
         self._loop = loop
-        self._host = host
-        self._port = port
+        upstreams = ([(host, port)] if host else []) + list(upstreams or ())
+        self._upstreams = UpstreamSet(upstreams or DEFAULT_UPSTREAMS)
         self._hostname_to_callback = dict()
-        self._cache = LRUCache(timeout=300.0)
+        self._cache = cache if cache is not None else DnsCache()
+        self._flights = SingleFlight(loop)
         self._subjects = {}
-        self._sock = socket.socket(
-            socket.AF_INET, socket.SOCK_DGRAM, socket.SOL_UDP
-        )
-        # self._sock.setblocking(False)
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
 
-    def _resolve(self, hostnames, qtype, qclass):
-        if isinstance(hostnames, bytes):
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def flights(self):
+        return self._flights
+
+    @property
+    def upstreams(self):
+        return self._upstreams
+
+    def _resolve(self, hostnames, qtype, qclass, ranked, outcomes):
+        # runs in a pool thread: upstream updates go to ``outcomes``, to be
+        # applied on the loop
+        req = ResolveRequest(hostnames, qtype, qclass)
+        resolve_req = req.to_bytes()
+        print("resolve_req:", resolve_req)
+        socks = {}
+        sent = {}
+
+        def ask(upstream):
+            sock = socks.get(upstream.family)
+            if sock is None:
+                sock = socks[upstream.family] = socket.socket(
+                    upstream.family, socket.SOCK_DGRAM, socket.SOL_UDP
+                )
+            outcomes.append(upstream.on_sent)
+            sent[upstream] = time.monotonic()
+            sock.sendto(resolve_req, upstream.addr)
+
+        try:
+            ask(ranked[0])
+            deadline = time.monotonic() + QUERY_TIMEOUT
+            hedge_at = None
+            if len(ranked) > 1:
+                hedge_at = time.monotonic() + ranked[0].hedge_delay
+            while True:
+                now = time.monotonic()
+                if hedge_at is not None and now >= hedge_at:
+                    ask(ranked[1])
+                    hedge_at = None
+                if now >= deadline:
+                    for upstream, sent_at in sent.items():
+                        outcomes.append(
+                            partial(upstream.on_timeout, now - sent_at)
+                        )
+                    return None
+                readable, _, _ = select.select(
+                    list(socks.values()), [], [], (hedge_at or deadline) - now
+                )
+                for sock in readable:
+                    received, addr = sock.recvfrom(RECV_SIZE)
+                    print("received:", received, "addr:", addr)
+                    winner = self._upstreams.get(addr)
+                    if (
+                        winner not in sent
+                        or len(received) < 12
+                        or struct.unpack_from("!H", received)[0]
+                        != req.query_id
+                    ):
+                        continue
+                    now = time.monotonic()
+                    outcomes.append(
+                        partial(winner.on_answer, now - sent[winner])
+                    )
+                    for upstream, sent_at in sent.items():
+                        if upstream is not winner:
+                            outcomes.append(
+                                partial(upstream.on_late, now - sent_at)
+                            )
+                    response = decode_response(received)
+                    if response.header.truncated:
+                        response = self._resolve_tcp(
+                            winner.addr, resolve_req, response
+                        )
+                    return response.header, response.answers
+        finally:
+            for sock in socks.values():
+                sock.close()
+
+    def _resolve_tcp(self, addr, resolve_req, truncated):
+        try:
+            return query_once(addr, resolve_req)
+        except (OSError, DnsRspRecvErr) as e:
+            print("dns over tcp to %r failed: %r" % (addr, e))
+            return truncated
+
+    async def resolve(
+        self, hostnames, qtype=QType.QTYPE_A, qclass=QClass.QCLASS_IN
+    ):
+        if isinstance(hostnames, (bytes, str)):
             hostnames = [hostnames]
         hostnames = list(
             map(
@@ -39,29 +156,40 @@ class DnsResolver:
                 hostnames,
             )
         )
-        resolve_req = ResolveRequest(hostnames, qtype, qclass).to_bytes()
-        print("resolve_req:", resolve_req)
-        self._sock.sendto(resolve_req, (self._host, self._port))
-        print("sendto done")
-        received, addr = self._sock.recvfrom(1024)
-        print("received:", received, "addr:", addr)
-        if addr != (HOST, PORT):
-            return None
-        # received = await self._loop.sock_recv(self._sock, 1024)
-        # print("received:", received, "addr:", addr)
-        header, questions, answers, authorities = pull(
-            ResolveResponse(), received
-        )
-        return answers
-
-    async def resolve(
-        self, hostnames, qtype=QType.QTYPE_A, qclass=QClass.QCLASS_IN
-    ):
+        if len(hostnames) == 1:
+            entry = self._cache.get(hostnames[0], qtype)
+            if entry is not None:
+                return first_answer(entry.answers, qtype)
+            # concurrent lookups of one name share a single query
+            key = cache_key(hostnames[0], qtype) + (qclass,)
+            return await self._flights.do(
+                key, self._lookup, hostnames, qtype, qclass
+            )
+        return await self._lookup(hostnames, qtype, qclass)
 
-        answers = await self._loop.run_in_executor(
-            pool, partial(self._resolve, hostnames, qtype, qclass)
-        )
-        return answers[0] if answers else None
+    async def _lookup(self, hostnames, qtype, qclass):
+        outcomes = []
+        try:
+            resolved = await self._loop.run_in_executor(
+                pool,
+                partial(
+                    self._resolve,
+                    hostnames,
+                    qtype,
+                    qclass,
+                    self._upstreams.ranked(),
+                    outcomes,
+                ),
+            )
+        finally:
+            for outcome in outcomes:
+                outcome()
+        if not resolved:
+            return None
+        header, answers = resolved
+        if len(hostnames) == 1 and not header.truncated:
+            self._cache.put(hostnames[0], qtype, answers, header.rcode)
+        return first_answer(answers, qtype)
 
 
 if __name__ == "__main__":
@@ -70,3 +198,5 @@ if __name__ == "__main__":
     f = dns.resolve(b"google.com")
     ret = mloop.run_until_complete(f)
     print(ret)
+    ret = mloop.run_until_complete(dns.resolve(b"google.com"))
+    print(ret, dns.cache.stats())
@@ -0,0 +1,246 @@
+import asyncio
+import os
+import socket
+import struct
+
+from asyncdns.resolve_rsp import decode_response
+from utils.loggers import get_logger
+
+log = get_logger("dns-tcp")
+
+CONNECT_TIMEOUT = 2.0
+QUERY_TIMEOUT = 3.0
+IDLE_TIMEOUT = 30.0
+MAX_CONNECTIONS = 2
+# queries one connection carries at once before another is opened
+MAX_PIPELINE = 32
+
+LENGTH_STRUCT = struct.Struct("!H")
+
+
+def frame(data):
+    return LENGTH_STRUCT.pack(len(data)) + data
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("dns server closed the connection")
+        data += chunk
+    return data
+
+
+def query_once(addr, data, timeout=QUERY_TIMEOUT):
+    """
+    Blocking query over a fresh TCP connection, for the thread-pool
+    resolver. Returns the decoded response.
+    """
+    family = socket.AF_INET6 if ":" in addr[0] else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(addr)
+        sock.sendall(frame(data))
+        while True:
+            (size,) = LENGTH_STRUCT.unpack(_recv_exactly(sock, 2))
+            reply = _recv_exactly(sock, size)
+            if reply[:2] == data[:2]:
+                return decode_response(reply)
+
+
+class DnsTcpProtocol(asyncio.Protocol):
+    """
+    One persistent connection to a DNS server (RFC 7766). Queries are
+    pipelined without waiting for earlier replies, which may come back in
+    any order: each is matched to its query by transaction ID. IDs are
+    rewritten to be unique on the connection, whoever sent the query.
+    The connection is closed after IDLE_TIMEOUT without queries.
+    """
+
+    def __init__(self, loop, idle_timeout=IDLE_TIMEOUT):
+        self._loop = loop
+        self._idle_timeout = idle_timeout
+        self._transport = None
+        self._buffer = bytearray()
+        self._pending = {}
+        self._idle_timer = None
+        self._closed = loop.create_future()
+        self.queries = 0
+
+    @property
+    def load(self):
+        return len(self._pending)
+
+    @property
+    def closed(self):
+        return self._closed.done()
+
+    def connection_made(self, transport):
+        self._transport = transport
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._arm_idle_timer()
+
+    def data_received(self, data):
+        self._buffer += data
+        while len(self._buffer) >= 2:
+            (size,) = LENGTH_STRUCT.unpack_from(self._buffer)
+            if len(self._buffer) < 2 + size:
+                break
+            message = bytes(self._buffer[2 : 2 + size])
+            del self._buffer[: 2 + size]
+            self._on_message(message)
+
+    def _on_message(self, message):
+        if len(message) < 12:
+            return
+        fut = self._pending.pop(LENGTH_STRUCT.unpack_from(message)[0], None)
+        if fut is None or fut.done():
+            return
+        try:
+            fut.set_result(decode_response(message))
+        except Exception as e:
+            fut.set_exception(e)
+        if not self._pending:
+            self._arm_idle_timer()
+
+    def connection_lost(self, exc):
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(
+                    exc or ConnectionResetError("dns connection closed")
+                )
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def eof_received(self):
+        # the server is done with us, let the pool open a new one
+        return False
+
+    def _arm_idle_timer(self):
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        self._idle_timer = self._loop.call_later(
+            self._idle_timeout, self._close_idle
+        )
+
+    def _forget(self, query_id, fut):
+        if self._pending.get(query_id) is fut:
+            del self._pending[query_id]
+
+    def _close_idle(self):
+        if not self._pending and self._transport:
+            self._transport.close()
+
+    def query(self, data):
+        query_id = LENGTH_STRUCT.unpack_from(data)[0]
+        while query_id in self._pending:
+            query_id = LENGTH_STRUCT.unpack(os.urandom(2))[0]
+        fut = self._pending[query_id] = self._loop.create_future()
+        fut.add_done_callback(lambda _: self._forget(query_id, fut))
+        if self._idle_timer:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        self.queries += 1
+        self._transport.write(frame(LENGTH_STRUCT.pack(query_id) + data[2:]))
+        return fut
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+
+
+class DnsTcpPool:
+    """
+    Up to ``max_connections`` persistent connections per upstream. A query
+    rides on the least loaded one; a new connection is only opened when
+    all of them already carry ``max_pipeline`` queries.
+    """
+
+    def __init__(
+        self,
+        loop,
+        max_connections=MAX_CONNECTIONS,
+        max_pipeline=MAX_PIPELINE,
+        idle_timeout=IDLE_TIMEOUT,
+    ):
+        self._loop = loop
+        self._max_connections = max_connections
+        self._max_pipeline = max_pipeline
+        self._idle_timeout = idle_timeout
+        self._connections = {}
+        self._connecting = {}
+        self.connects = 0
+        self.queries = 0
+
+    def _open(self, addr):
+        return [c for c in self._connections.get(addr, ()) if not c.closed]
+
+    async def _connection(self, addr):
+        while True:
+            connections = self._open(addr)
+            self._connections[addr] = connections
+            best = min(connections, key=lambda c: c.load, default=None)
+            if best is not None and (
+                best.load < self._max_pipeline
+                or len(connections) >= self._max_connections
+            ):
+                return best
+            connecting = self._connecting.get(addr)
+            if connecting is None:
+                connecting = self._connecting[addr] = self._loop.create_task(
+                    self._connect(addr)
+                )
+                connecting.add_done_callback(
+                    lambda _: self._connecting.pop(addr, None)
+                )
+            protocol = await asyncio.shield(connecting)
+            if protocol.load < self._max_pipeline:
+                return protocol
+
+    async def _connect(self, addr):
+        family = socket.AF_INET6 if ":" in addr[0] else socket.AF_INET
+        _, protocol = await asyncio.wait_for(
+            self._loop.create_connection(
+                lambda: DnsTcpProtocol(self._loop, self._idle_timeout),
+                addr[0],
+                addr[1],
+                family=family,
+            ),
+            CONNECT_TIMEOUT,
+        )
+        self.connects += 1
+        self._connections.setdefault(addr, []).append(protocol)
+        return protocol
+
+    async def query(self, addr, data, timeout=QUERY_TIMEOUT):
+        """
+        Send one query message to ``addr`` and return the decoded reply.
+        Raises OSError or asyncio.TimeoutError.
+        """
+        addr = tuple(addr[:2])
+        protocol = await self._connection(addr)
+        self.queries += 1
+        fut = protocol.query(data)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            fut.cancel()
+
+    def close(self):
+        connections, self._connections = self._connections, {}
+        for protocols in connections.values():
+            for protocol in protocols:
+                protocol.close()
+
+    def stats(self):
+        return {
+            "connections": sum(len(self._open(a)) for a in self._connections),
+            "connects": self.connects,
+            "queries": self.queries,
+        }
@@ -0,0 +1,223 @@
+import time
+
+from asyncdns.enums import ResponseCode
+from lrucache import LRUCache
+
+NEGATIVE_TTL = 30.0
+MAX_ENTRIES = 4096
+# an entry hit in its last tenth of life is refreshed ahead of expiry
+PREFETCH_RATIO = 0.1
+STALE_TTL = 300.0
+
+NEGATIVE_RCODES = (ResponseCode.NAME_ERR.value, ResponseCode.SRV_ERR.value)
+
+
+def cache_key(name, qtype):
+    if isinstance(name, str):
+        name = name.encode("utf8")
+    return name.strip(b".").lower(), getattr(qtype, "value", qtype)
+
+
+class CacheEntry:
+    __slots__ = ("answers", "rcode", "expires", "ttl", "hits")
+
+    def __init__(self, answers, rcode, expires, ttl=0.0):
+        self.answers = answers
+        self.rcode = rcode
+        self.expires = expires
+        self.ttl = ttl
+        self.hits = 0
+
+    @property
+    def negative(self):
+        return not self.answers
+
+
+class DnsCache:
+    """
+    Answers keyed by (name, qtype). A positive entry lives for the smallest
+    TTL among its answers, a failed lookup (NXDOMAIN, SERVFAIL or an empty
+    answer) for ``negative_ttl`` seconds. Past ``max_entries`` the least
+    recently used entry is evicted. Entries sit in an LRUCache, which
+    drops them once expired when they are read or sweep() is called.
+
+    With ``stale_ttl`` set, a positive entry is kept that long past its
+    expiry so that ``get(..., stale=True)`` can still serve it while a
+    fresh answer is being fetched.
+
+    A snapshot attached with attach() (see asyncdns.cache_store) is where
+    a key missing from the cache is looked for first.
+    """
+
+    def __init__(
+        self,
+        max_entries=MAX_ENTRIES,
+        negative_ttl=NEGATIVE_TTL,
+        clock=None,
+        stale_ttl=0.0,
+    ):
+        self._negative_ttl = negative_ttl
+        self._stale_ttl = stale_ttl
+        self._clock = clock or time.monotonic
+        self._entries = LRUCache(
+            timeout=None, max_entries=max_entries, clock=self._clock
+        )
+        self._snapshot = None
+        self.hits = 0
+        self.negative_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.restored = 0
+
+    @property
+    def evictions(self):
+        return self._entries.evictions
+
+    @property
+    def stale_ttl(self):
+        return self._stale_ttl
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def attach(self, snapshot):
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = snapshot
+
+    def _fill(self, key):
+        """
+        Look for a key missing from the cache elsewhere: the snapshot
+        here, more in subclasses.
+        """
+        if self._snapshot is None:
+            return None
+        return self._restore(key, self._snapshot.pop(key))
+
+    def _restore(self, key, record):
+        """
+        Store ``record`` (answers, rcode, seconds left, ttl) kept outside
+        the cache, if it is still live.
+        """
+        if record is None:
+            return None
+        answers, rcode, left, ttl = record
+        lifetime = left + self._stale_ttl if answers else left
+        if lifetime <= 0:
+            return None
+        entry = CacheEntry(answers, rcode, self._clock() + left, ttl)
+        self._entries.set(key, entry, lifetime)
+        self.restored += 1
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name, qtype, count=True, stale=False):
+        key = cache_key(name, qtype)
+        if count:
+            entry = self._entries.get(key)
+        else:
+            entry = self._entries.peek(key)
+        if entry is None:
+            entry = self._fill(key)
+        now = self._clock()
+        if entry is not None and entry.expires <= now and not stale:
+            entry = None
+        if not count:
+            return entry
+        if entry is None:
+            self.misses += 1
+            return None
+        entry.hits += 1
+        if entry.negative:
+            self.negative_hits += 1
+        elif entry.expires <= now:
+            self.stale_hits += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def is_stale(self, entry):
+        return entry.expires <= self._clock()
+
+    def entries(self):
+        """
+        (key, entry, seconds left) for every entry not yet dropped, stale
+        ones included.
+        """
+        now = self._clock()
+        return [
+            (key, entry, entry.expires - now)
+            for key, entry in self._entries.items()
+            if key in self._entries
+        ]
+
+    def expiring(self, window=0.0):
+        """
+        Keys of the positive entries hit since they were stored that
+        expire within ``window`` seconds or within their last
+        PREFETCH_RATIO of life, whichever is longer: the ones worth
+        refreshing before a client has to wait for them.
+        """
+        now = self._clock()
+        keys = []
+        for key, entry in self._entries.items():
+            if not entry.hits or entry.negative:
+                continue
+            left = entry.expires - now
+            if 0 < left <= max(window, entry.ttl * PREFETCH_RATIO):
+                keys.append(key)
+        return keys
+
+    def put(self, name, qtype, answers, rcode=ResponseCode.NO_ERR.value):
+        if answers:
+            ttl = min(answer.ttl for answer in answers)
+        elif rcode in NEGATIVE_RCODES or rcode == ResponseCode.NO_ERR.value:
+            ttl = self._negative_ttl
+            answers = []
+        else:
+            # REFUSED, NOT_IMPL... say nothing about the name itself
+            return None
+        if ttl <= 0:
+            return None
+        entry = CacheEntry(answers, rcode, self._clock() + ttl, ttl)
+        # only a positive answer is worth keeping around stale
+        lifetime = ttl + self._stale_ttl if answers else ttl
+        self._entries.set(cache_key(name, qtype), entry, lifetime)
+        return entry
+
+    def put_negative(self, name, qtype, rcode):
+        return self.put(name, qtype, [], rcode)
+
+    def clear(self):
+        self._entries.clear()
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+    def sweep(self):
+        """
+        Drop the entries past expiry, and past the stale window for the
+        positive ones. Returns how many were dropped.
+        """
+        return self._entries.sweep()
+
+    @property
+    def hit_rate(self):
+        served = self.hits + self.negative_hits + self.stale_hits
+        lookups = served + self.misses
+        return served / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "restored": self.restored,
+            "hit_rate": self.hit_rate,
+        }
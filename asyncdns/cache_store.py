@@ -0,0 +1,215 @@
+import mmap
+import os
+import struct
+import time
+
+from asyncdns.resolve_rsp import Answer, TYPE_CNAME
+from utils.loggers import get_logger
+
+log = get_logger("dns-cache")
+
+MAGIC = b"DNSC"
+VERSION = 1
+
+# magic, version, record count, wall clock time of the save
+FILE_HEADER = struct.Struct("!4sHId")
+# name length, qtype, rcode, wall clock expiry, ttl, answers length
+RECORD_STRUCT = struct.Struct("!BHHddI")
+# name length, type, class, ttl, rlength, rdata length
+ANSWER_STRUCT = struct.Struct("!BHHIHH")
+
+
+def _pack_rdata(answer):
+    if isinstance(answer.rdata, int):
+        return bytes((answer.rdata,))
+    return bytes(answer.rdata)
+
+
+def pack_answers(answers):
+    return b"".join(
+        ANSWER_STRUCT.pack(
+            len(answer.name),
+            answer.type,
+            answer.clz,
+            answer.ttl,
+            answer.rlength,
+            len(rdata),
+        )
+        + answer.name
+        + rdata
+        for answer, rdata in ((a, _pack_rdata(a)) for a in answers)
+    )
+
+
+def unpack_answers(data, offset, end):
+    answers = []
+    while offset < end:
+        name_len, type_, clz, ttl, rlength, size = ANSWER_STRUCT.unpack_from(
+            data, offset
+        )
+        offset += ANSWER_STRUCT.size
+        name = bytes(data[offset : offset + name_len])
+        offset += name_len
+        rdata = bytes(data[offset : offset + size])
+        offset += size
+        # the shapes decode_response gives them
+        if type_ != TYPE_CNAME:
+            rdata = rdata[0] if size == 1 else tuple(rdata)
+        answers.append(Answer(name, type_, clz, ttl, rlength, rdata))
+    return answers
+
+
+def pack_record(key, answers, rcode, expires_at, ttl):
+    name, qtype = key
+    body = pack_answers(answers)
+    return (
+        RECORD_STRUCT.pack(len(name), qtype, rcode, expires_at, ttl, len(body))
+        + name
+        + body
+    )
+
+
+class CacheSnapshot:
+    """
+    A cache file saved by save_cache(), mapped read-only. Nothing is read
+    when it is opened: the first lookup indexes the record headers, and
+    a record's answers are only decoded when that key is asked for.
+    Raises OSError or ValueError when the file cannot be used.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < FILE_HEADER.size:
+                raise ValueError("%s: too short for a dns cache file" % path)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, self.saved_at = FILE_HEADER.unpack_from(
+            self._map
+        )
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(
+                "%s: not a version %u dns cache file" % (path, VERSION)
+            )
+        self._index = None
+
+    def _build_index(self):
+        index = {}
+        data = self._map
+        offset = FILE_HEADER.size
+        now = time.time()
+        try:
+            for _ in range(self._count):
+                start = offset
+                name_len, qtype, rcode, expires_at, ttl, size = (
+                    RECORD_STRUCT.unpack_from(data, offset)
+                )
+                offset += RECORD_STRUCT.size
+                name = bytes(data[offset : offset + name_len])
+                offset += name_len + size
+                if offset > len(data):
+                    raise ValueError("record past the end of the file")
+                index[name, qtype] = (
+                    start,
+                    offset,
+                    rcode,
+                    expires_at,
+                    ttl,
+                    size > 0,
+                )
+        except (struct.error, ValueError) as e:
+            log.info(
+                "dns cache file cut short, %u records kept: %r"
+                % (len(index), e)
+            )
+        log.info(
+            "dns cache file: %u records, saved %.0fs ago"
+            % (len(index), now - self.saved_at)
+        )
+        return index
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self._build_index()
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def pop(self, key):
+        """
+        (answers, rcode, seconds left, ttl) for ``key``, which is then
+        forgotten, or None. Seconds left may be negative.
+        """
+        record = self.index.pop(key, None)
+        if record is None:
+            return None
+        start, end, rcode, expires_at, ttl, _ = record
+        offset = start + RECORD_STRUCT.size + len(key[0])
+        answers = unpack_answers(self._map, offset, end)
+        if not self._index:
+            self.close()
+        return answers, rcode, expires_at - time.time(), ttl
+
+    def raw_records(self, stale_ttl=0.0, exclude=()):
+        """
+        The records never asked for and still worth loading, as stored,
+        but for the keys in ``exclude``.
+        """
+        if self._map.closed:
+            return []
+        now = time.time()
+        return [
+            self._map[start:end]
+            for key, (start, end, _, expires_at, _, positive) in list(
+                self.index.items()
+            )
+            if key not in exclude
+            and expires_at + (stale_ttl if positive else 0.0) > now
+        ]
+
+    def close(self):
+        self._index = {}
+        if not self._map.closed:
+            self._map.close()
+
+
+def save_cache(cache, path):
+    """
+    Write the live entries of ``cache``, plus those of its snapshot that
+    were never loaded, to ``path``, replaced atomically. Returns how many
+    records were written.
+    """
+    now = time.time()
+    entries = cache.entries()
+    records = [
+        pack_record(key, entry.answers, entry.rcode, now + left, entry.ttl)
+        for key, entry, left in entries
+    ]
+    if cache.snapshot is not None:
+        records.extend(
+            cache.snapshot.raw_records(
+                cache.stale_ttl, {key for key, _, _ in entries}
+            )
+        )
+    tmp = "%s.%u.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(FILE_HEADER.pack(MAGIC, VERSION, len(records), now))
+        f.writelines(records)
+    os.replace(tmp, path)
+    return len(records)
+
+
+def load_cache(cache, path):
+    """
+    Attach the snapshot at ``path`` to ``cache``, which loads each entry
+    from it on its first miss. Returns False when there is no usable file.
+    """
+    try:
+        cache.attach(CacheSnapshot(path))
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        log.info("dns cache file %s ignored: %r" % (path, e))
+        return False
+    return True
@@ -7,13 +7,23 @@ from utils.util import bits
 
 
 class HeaderSection:
-    def __init__(self, qr, opcode, rcode, qdcount, ancount, nscount, arcount):
+    def __init__(
+        self,
+        qr,
+        opcode,
+        rcode,
+        qdcount,
+        ancount,
+        nscount,
+        arcount,
+        recursion_desired=True,
+    ):
         self._query_id = os.urandom(2)
         self._is_response = qr.value
         self._opcode = opcode.value
         self._auth_answer = False
         self._truncation = False
-        self._recursion_desired = False
+        self._recursion_desired = recursion_desired
         self._recursion_avail = False
         self._rsv = 0
         self._rcode = rcode
@@ -22,32 +32,38 @@ class HeaderSection:
         self._nscount = nscount
         self._arcount = arcount
 
+        # most significant bit first: QR, OPCODE, AA, TC, RD
         self._misc_1 = (
-            bits(self._recursion_desired, 1)
-            + bits(self._truncation, 1)
-            + bits(self._auth_answer, 1)
+            bits(self._is_response, 1)
             + bits(self._opcode, 4)
-            + bits(self._is_response, 1)
+            + bits(self._auth_answer, 1)
+            + bits(self._truncation, 1)
+            + bits(self._recursion_desired, 1)
         )
 
+        # RA, Z, RCODE
         self._misc_2 = (
-            bits(self._rcode, 4)
+            bits(self._recursion_avail, 1)
             + bits(self._rsv, 3)
-            + bits(self._recursion_avail, 1)
+            + bits(self._rcode, 4)
         )
 
         assert len(self._misc_1) == len(self._misc_2) == 8
 
         self._header = struct.pack(
             "!BBHHHH",
-            int(self._misc_2, 2),
             int(self._misc_1, 2),
+            int(self._misc_2, 2),
             self._qdcount,
             self._ancount,
             self._nscount,
             self._arcount,
         )
 
+    @property
+    def query_id(self):
+        return struct.unpack("!H", self._query_id)[0]
+
     def to_bytes(self):
         return self._query_id + self._header
 
@@ -78,24 +94,40 @@ class QueryHeaderSection(HeaderSection):
         )
 
 
+class QuestionSection:
+    def __init__(self, address, qtype, qclass):
+        self._address = ResolveRequestAddress(address)
+        self._qtype = getattr(qtype, "value", qtype)
+        self._qclass = getattr(qclass, "value", qclass)
+
+    def to_bytes(self):
+        return self._address.to_bytes() + struct.pack(
+            "!HH", self._qtype, self._qclass
+        )
+
+
 class ResolveRequest:
+    """
+    One query carrying a question for every address, each followed by its
+    own QTYPE and QCLASS.
+    """
+
     def __init__(self, addresses, qtype, qclass):
-        if not isinstance(addresses, Iterable):
+        if isinstance(addresses, (bytes, str)) or not isinstance(
+            addresses, Iterable
+        ):
             addresses = [addresses]
+        addresses = list(addresses)
         self._header = QueryHeaderSection(len(addresses))
-        self._addresses = [
-            ResolveRequestAddress(address) for address in addresses
+        self._questions = [
+            QuestionSection(address, qtype, qclass) for address in addresses
         ]
-        self._qtype = qtype.value
-        self._qclass = qclass.value
+
+    @property
+    def query_id(self):
+        return self._header.query_id
 
     def to_bytes(self):
-        addresses = b""
-        for address in self._addresses:
-            addresses += address.to_bytes()
-        return (
-            self._header.to_bytes()
-            + addresses
-            + struct.pack(">H", self._qtype)
-            + struct.pack(">H", self._qclass)
+        return self._header.to_bytes() + b"".join(
+            question.to_bytes() for question in self._questions
         )
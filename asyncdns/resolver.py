@@ -1,18 +1,22 @@
 import socket
+import struct
+import time
 from selectors import EVENT_READ, EVENT_WRITE
 from threading import RLock
 
+from asyncdns.cache import STALE_TTL, DnsCache, cache_key
 from asyncdns.enums import QType, QClass
 from asyncdns.resolve_req import ResolveRequest
-from asyncdns.resolve_rsp import ResolveResponse
-from eventloop import EventLoop
+from asyncdns.resolve_rsp import decode_response, demux_answers
+from asyncdns.upstreams import DEFAULT_UPSTREAMS, UpstreamSet
+from eventloop import TIMEOUT_PRECISION, EventLoop
 from exc import DnsRspRecvErr
-from lrucache import LRUCache
-from utils.util import pull_diagram_sock, pull
 from utils.loggers import get_logger
 
 HOST = "8.8.8.8"
 PORT = 53
+INFLIGHT_TIMEOUT = 5.0
+RECV_SIZE = 4096
 log = get_logger("async-dns")
 
 
@@ -65,12 +69,40 @@ class Observer:
 
 
 class DnsResolver:
-    def __init__(self):
+    """
+    Answers are cached by name and type. On every periodic tick the
+    entries still being asked for that are about to expire are queried
+    again, all of one type in a single request. With ``serve_stale`` an
+    expired answer is passed to the callback at once and refreshed.
+
+    Each request goes to the best scoring of ``upstreams`` (IPv4 only on
+    this single socket) and is copied to the next one when unanswered
+    past the first one's hedge delay. Replies are matched by transaction
+    ID and source.
+    """
+
+    def __init__(self, serve_stale=False, upstreams=None):
+        self._upstreams = UpstreamSet(upstreams or DEFAULT_UPSTREAMS)
+        if any(u.family != socket.AF_INET for u in self._upstreams):
+            raise ValueError("the selector resolver takes IPv4 upstreams")
+        self._queries = {}
         self._loop = None
         self._hostname_to_callback = dict()
-        self._cache = LRUCache(timeout=300.0)
+        self._cache = DnsCache(stale_ttl=STALE_TTL if serve_stale else 0.0)
+        self._serve_stale = serve_stale
         self._subjects = {}
         self._sock = None
+        self._inflight = {}
+        self.coalesced = 0
+        self.prefetches = 0
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def upstreams(self):
+        return self._upstreams
 
     @staticmethod
     def _make_socket():
@@ -88,19 +120,77 @@ class DnsResolver:
         self._loop.add_periodic(self._periodic_handle)
 
     def _periodic_handle(self):
+        # a reply that never came must not block the name forever
+        now = time.time()
+        for key, sent in list(self._inflight.items()):
+            if now - sent > INFLIGHT_TIMEOUT:
+                del self._inflight[key]
+        for query_id, query in list(self._queries.items()):
+            if now - query[1] > INFLIGHT_TIMEOUT:
+                del self._queries[query_id]
+                for upstream, sent in query[2].items():
+                    upstream.on_timeout(now - sent)
         self._cache.sweep()
+        # ticks can be up to two poll timeouts apart
+        by_qtype = {}
+        for name, qtype in self._cache.expiring(2 * TIMEOUT_PRECISION):
+            key = cache_key(name, qtype)
+            if key not in self._inflight:
+                self._inflight[key] = now
+                by_qtype.setdefault(qtype, []).append(name)
+        for qtype, names in by_qtype.items():
+            self.prefetches += len(names)
+            self._send_req(names, qtype, QClass.QCLASS_IN)
+
+    def _hedge_overdue(self):
+        """
+        Copy the requests their upstream is slow to answer to the next
+        best one. Runs on every wakeup of the socket, which is registered
+        for writability as well and so comes round on each loop pass.
+        """
+        if len(self._upstreams) < 2:
+            return
+        now = time.time()
+        for query_id, (data, _, sent) in self._queries.items():
+            if len(sent) > 1:
+                continue
+            first, sent_at = next(iter(sent.items()))
+            if now - sent_at < first.hedge_delay:
+                continue
+            upstream = next(
+                u for u in self._upstreams.ranked() if u is not first
+            )
+            upstream.on_sent()
+            sent[upstream] = now
+            self._sock.sendto(data, upstream.addr)
+
+    def _match_reply(self, received, addr):
+        # the transaction ID must be ours and the source one we asked
+        if len(received) < 12:
+            return False
+        query_id = struct.unpack_from("!H", received)[0]
+        query = self._queries.get(query_id)
+        upstream = self._upstreams.get(addr)
+        if query is None or upstream not in query[2]:
+            return False
+        del self._queries[query_id]
+        now = time.time()
+        upstream.on_answer(now - query[2][upstream])
+        for other, sent in query[2].items():
+            if other is not upstream:
+                other.on_late(now - sent)
+        return True
 
     def _handle_event(self, sock, mask):
+        self._hedge_overdue()
         if mask & EVENT_READ:
-            received, addr = sock.recvfrom(1024)
-            if addr[0] != HOST:
+            received, addr = sock.recvfrom(RECV_SIZE)
+            if received and not self._match_reply(received, addr):
                 return log.info("Unknown server response")
             try:
                 if not received:
                     raise DnsRspRecvErr
-                header, questions, answers, authorities = pull(
-                    ResolveResponse(), received
-                )
+                response = decode_response(received)
             except DnsRspRecvErr:
                 self._loop.remove(sock)
                 self._sock.close()
@@ -109,11 +199,29 @@ class DnsResolver:
                     self._sock, EVENT_READ | EVENT_WRITE, self._handle_event
                 )
             else:
-                print(header, questions, answers, authorities)
-                for ans in answers:
-                    subject_ = self._subjects.get(ans.name, None)
-                    if subject_:
-                        subject_.ip = ans.rdata
+                print(response)
+                # one reply may answer several questions, each through its
+                # own CNAME chain, notify the subject of every question
+                header = response.header
+                answers = demux_answers(response.questions, response.answers)
+                for question in response.questions:
+                    key = cache_key(question.qname, question.qtype)
+                    self._inflight.pop(key, None)
+                    # a cut off answer is passed on but not remembered
+                    if header.truncated:
+                        pass
+                    elif len(response.questions) == 1 or not header.rcode:
+                        self._cache.put(
+                            question.qname,
+                            question.qtype,
+                            answers[key],
+                            header.rcode,
+                        )
+                    subject_ = self._subjects.get(question.qname, None)
+                    for ans in answers[key]:
+                        if subject_ and ans.type == question.qtype:
+                            subject_.ip = ans.rdata
+                            break
 
     def close(self):
         self._loop.remove(self._sock)
@@ -122,9 +230,26 @@ class DnsResolver:
         self._sock = None
 
     def _send_req(self, hostnames, qtype, qclass):
-        self._sock.sendto(
-            ResolveRequest(hostnames, qtype, qclass).to_bytes(), (HOST, PORT)
+        req = ResolveRequest(hostnames, qtype, qclass)
+        while req.query_id in self._queries:
+            req = ResolveRequest(hostnames, qtype, qclass)
+        data = req.to_bytes()
+        upstream = self._upstreams.ranked()[0]
+        upstream.on_sent()
+        now = time.time()
+        self._queries[req.query_id] = (data, now, {upstream: now})
+        self._sock.sendto(data, upstream.addr)
+
+    def _from_cache(self, hostname, qtype, resolve_callback):
+        entry = self._cache.get(hostname, qtype, stale=self._serve_stale)
+        if entry is None:
+            return None
+        answer = next(
+            (a for a in entry.answers if a.type == qtype.value), None
         )
+        if resolve_callback and callable(resolve_callback):
+            resolve_callback(answer.rdata if answer else None, None)
+        return entry
 
     def resolve(
         self,
@@ -141,7 +266,15 @@ class DnsResolver:
                 hostnames,
             )
         )
+        to_query = []
         for hostname in hostnames:
+            entry = self._from_cache(hostname, qtype, resolve_callback)
+            if entry is not None:
+                # a stale answer was served, renew it behind the caller
+                if self._cache.is_stale(entry):
+                    to_query.append(hostname)
+                continue
+            to_query.append(hostname)
             print(resolve_callback)
             if resolve_callback and callable(resolve_callback):
                 subject_ = self._subjects.get(hostname, None)
@@ -149,7 +282,19 @@ class DnsResolver:
                     subject_ = Subject(hostname)
                     self._subjects[hostname] = subject_
                 subject_.attach(Observer(resolve_callback))
-        self._send_req(hostnames, qtype, qclass)
+        # names already asked for are answered by the reply in flight,
+        # which notifies every observer attached to their subjects
+        now = time.time()
+        to_send = []
+        for hostname in to_query:
+            key = cache_key(hostname, qtype)
+            if key in self._inflight:
+                self.coalesced += 1
+                continue
+            self._inflight[key] = now
+            to_send.append(hostname)
+        if to_send:
+            self._send_req(to_send, qtype, qclass)
 
 
 counter = 0
@@ -171,16 +316,7 @@ def main():
     dns.resolve([b"google.com"], make_callable())
     dns.resolve(b"youtube.com", make_callable())
     loop.run()
-    # with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.SOL_UDP) as s:
-    #     resolve_req = ResolveRequest([b'www.google.com', b'youtube.com'], QType.QTYPE_A, QClass.QCLASS_IN).to_bytes()
-    #     s.sendto(resolve_req, (HOST, PORT))
-    #     header, questions, answers, authorities = pull_diagram_sock(ResolveResponse(), s)
-    #     log.info(header)
-    #     log.info(questions)
-    #     log.info(answers)
-    #     log.info(authorities)
-    
-    
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,240 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from asyncdns.cache import DnsCache, MAX_ENTRIES, cache_key
+from asyncdns.cache_store import pack_answers, unpack_answers
+from asyncdns.enums import ResponseCode
+from utils.loggers import get_logger
+
+log = get_logger("dns-shared")
+
+SHM_DIR = "/dev/shm"
+MAGIC = b"DNSS"
+VERSION = 1
+SLOT_SIZE = 512
+# slots a key may sit in, one bucket of them is locked per write
+BUCKET_SLOTS = 8
+BUCKETS = 1024
+READ_RETRIES = 4
+
+# magic, version, slot size, buckets, slots per bucket
+TABLE_HEADER = struct.Struct("=4sHHII")
+# sequence, crc of the key, name length, qtype, rcode, wall clock expiry,
+# ttl, answers length
+SLOT_HEADER = struct.Struct("=IIBHHddH")
+SEQ_STRUCT = struct.Struct("=I")
+
+
+def key_crc(key):
+    name, qtype = key
+    return zlib.crc32(name, qtype) or 1
+
+
+class SharedTable:
+    """
+    Fixed-size hash table in a file mapped by every process that opens it,
+    normally under /dev/shm. A key hashes to a bucket of BUCKET_SLOTS
+    slots of SLOT_SIZE bytes; when all are taken, the one expiring first
+    gives way. Records too big for a slot are not shared.
+
+    Readers take no lock. Each slot starts with a sequence number that a
+    writer makes odd before changing the slot and even again after, and a
+    read is retried when it sees an odd or changed one (a seqlock).
+    Writers of one bucket exclude each other with an fcntl lock on it.
+
+    Raises OSError or ValueError when the table cannot be mapped.
+    """
+
+    def __init__(self, path, buckets=BUCKETS):
+        self._buckets = buckets
+        self._bucket_size = BUCKET_SLOTS * SLOT_SIZE
+        size = TABLE_HEADER.size + buckets * self._bucket_size
+        header = TABLE_HEADER.pack(
+            MAGIC, VERSION, SLOT_SIZE, buckets, BUCKET_SLOTS
+        )
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # whoever comes first lays the table out
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, TABLE_HEADER.size, 0)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    os.ftruncate(self._fd, size)
+                    os.pwrite(self._fd, header, 0)
+                elif os.pread(self._fd, TABLE_HEADER.size, 0) != header:
+                    raise ValueError("%s: a table of another layout" % path)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, TABLE_HEADER.size, 0)
+            self._map = mmap.mmap(self._fd, size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._lock = threading.Lock()
+        self.path = path
+
+    def _bucket(self, crc):
+        return TABLE_HEADER.size + (crc % self._buckets) * self._bucket_size
+
+    def _read_slot(self, offset):
+        data = self._map
+        for _ in range(READ_RETRIES):
+            (seq,) = SEQ_STRUCT.unpack_from(data, offset)
+            if seq & 1:
+                continue
+            slot = data[offset : offset + SLOT_SIZE]
+            if SEQ_STRUCT.unpack_from(data, offset)[0] == seq:
+                return slot
+        return None
+
+    def load(self, key):
+        """
+        (answers, rcode, seconds left, ttl) for ``key``, or None.
+        """
+        crc = key_crc(key)
+        name = key[0]
+        bucket = self._bucket(crc)
+        for offset in range(bucket, bucket + self._bucket_size, SLOT_SIZE):
+            slot = self._read_slot(offset)
+            if slot is None:
+                continue
+            _, slot_crc, name_len, qtype, rcode, expires_at, ttl, size = (
+                SLOT_HEADER.unpack_from(slot)
+            )
+            start = SLOT_HEADER.size
+            if (
+                slot_crc != crc
+                or qtype != key[1]
+                or slot[start : start + name_len] != name
+            ):
+                continue
+            start += name_len
+            answers = unpack_answers(slot, start, start + size)
+            return answers, rcode, expires_at - time.time(), ttl
+        return None
+
+    def store(self, key, answers, rcode, expires_at, ttl):
+        """
+        Put a record in the table. Returns False when it does not fit.
+        """
+        name, qtype = key
+        body = pack_answers(answers)
+        if SLOT_HEADER.size + len(name) + len(body) > SLOT_SIZE:
+            return False
+        crc = key_crc(key)
+        bucket = self._bucket(crc)
+        data = self._map
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._bucket_size, bucket)
+            try:
+                # the same key, else a free slot, else the first to expire
+                victim = oldest = None
+                for offset in range(
+                    bucket, bucket + self._bucket_size, SLOT_SIZE
+                ):
+                    _, slot_crc, name_len, slot_qtype, _, expires, _, _ = (
+                        SLOT_HEADER.unpack_from(data, offset)
+                    )
+                    start = offset + SLOT_HEADER.size
+                    if (
+                        slot_crc == crc
+                        and slot_qtype == qtype
+                        and data[start : start + name_len] == name
+                    ):
+                        victim = offset
+                        break
+                    if victim is None or expires < oldest:
+                        victim, oldest = offset, expires
+                (seq,) = SEQ_STRUCT.unpack_from(data, victim)
+                SEQ_STRUCT.pack_into(data, victim, seq + 1)
+                record = (
+                    SLOT_HEADER.pack(
+                        seq + 2,
+                        crc,
+                        len(name),
+                        qtype,
+                        rcode,
+                        expires_at,
+                        ttl,
+                        len(body),
+                    )[SEQ_STRUCT.size :]
+                    + name
+                    + body
+                )
+                start = victim + SEQ_STRUCT.size
+                data[start : start + len(record)] = record
+                SEQ_STRUCT.pack_into(data, victim, seq + 2)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._bucket_size, bucket)
+        return True
+
+    def close(self):
+        if not self._map.closed:
+            self._map.close()
+            os.close(self._fd)
+
+
+def default_path(name):
+    return os.path.join(SHM_DIR, "ss-dns-%s" % name)
+
+
+class SharedDnsCache(DnsCache):
+    """
+    DnsCache whose answers are also written to a SharedTable at ``path``,
+    so processes sharing the table find each other's answers on a local
+    miss. When the table cannot be opened it is an ordinary per-process
+    DnsCache.
+    """
+
+    def __init__(
+        self, path, max_entries=MAX_ENTRIES, buckets=BUCKETS, **kwargs
+    ):
+        super().__init__(max_entries, **kwargs)
+        try:
+            self._table = SharedTable(path, buckets)
+        except (OSError, ValueError) as e:
+            log.info("no shared dns cache at %s, per process: %r" % (path, e))
+            self._table = None
+        self.shared_hits = 0
+        self.shared_stores = 0
+
+    @property
+    def shared(self):
+        return self._table is not None
+
+    def _fill(self, key):
+        entry = super()._fill(key)
+        if entry is None and self._table is not None:
+            entry = self._restore(key, self._table.load(key))
+            if entry is not None:
+                self.shared_hits += 1
+        return entry
+
+    def put(self, name, qtype, answers, rcode=ResponseCode.NO_ERR.value):
+        entry = super().put(name, qtype, answers, rcode)
+        if entry is not None and self._table is not None:
+            if self._table.store(
+                cache_key(name, qtype),
+                entry.answers,
+                entry.rcode,
+                time.time() + entry.ttl,
+                entry.ttl,
+            ):
+                self.shared_stores += 1
+        return entry
+
+    def close(self):
+        if self._table is not None:
+            self._table.close()
+            self._table = None
+
+    def stats(self):
+        return dict(
+            super().stats(),
+            shared=self.shared,
+            shared_hits=self.shared_hits,
+            shared_stores=self.shared_stores,
+        )
@@ -0,0 +1,38 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one: the first caller
+    starts the work, later callers wait on the same future until it is
+    done. A waiter being cancelled does not cancel the shared call.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._calls = {}
+        self.started = 0
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def do(self, key, func, *args):
+        fut = self._calls.get(key)
+        if fut is None:
+            self.started += 1
+            fut = self._calls[key] = self._loop.create_task(func(*args))
+            fut.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+        return await asyncio.shield(fut)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "started": self.started,
+            "shared": self.shared,
+        }
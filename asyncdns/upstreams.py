@@ -0,0 +1,141 @@
+import socket
+
+DEFAULT_UPSTREAMS = (("8.8.8.8", 53), ("1.1.1.1", 53))
+
+# weights of a new sample in the moving averages, as in TCP's RTO
+RTT_ALPHA = 0.125
+RTTVAR_BETA = 0.25
+LOSS_ALPHA = 0.1
+INITIAL_RTT = 0.1
+MIN_HEDGE_DELAY = 0.01
+MAX_HEDGE_DELAY = 1.0
+MAX_LOSS = 0.95
+
+
+def normalize_address(host, port=53):
+    """
+    (ip, port) the way recvfrom() reports it, so that replies can be
+    matched on their source. Upstreams must be given as IP addresses.
+    """
+    if isinstance(host, bytes):
+        host = host.decode("utf8")
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, host)
+        except OSError:
+            continue
+        return socket.inet_ntop(family, packed), port
+    raise ValueError("upstream must be an IP address: %r" % host)
+
+
+def parse_upstreams(spec):
+    """
+    "8.8.8.8,1.1.1.1:5353,[2001:4860:4860::8888]:53" -> [(ip, port), ...]
+    """
+    upstreams = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        port = 53
+        if item.startswith("["):
+            host, _, rest = item[1:].partition("]")
+            if rest.startswith(":"):
+                port = int(rest[1:])
+        elif item.count(":") == 1:
+            host, port = item.split(":")
+            port = int(port)
+        else:
+            host = item
+        upstreams.append(normalize_address(host, port))
+    return upstreams
+
+
+class Upstream:
+    """
+    One recursive server with smoothed round trip time, its variation and
+    the share of queries it left unanswered, all moving averages.
+    """
+
+    def __init__(self, host, port=53):
+        self.addr = normalize_address(host, port)
+        self.family = (
+            socket.AF_INET6 if ":" in self.addr[0] else socket.AF_INET
+        )
+        self.srtt = INITIAL_RTT
+        self.rttvar = INITIAL_RTT / 2
+        self.loss = 0.0
+        self.sent = 0
+        self.answered = 0
+        self.timeouts = 0
+
+    def on_sent(self):
+        self.sent += 1
+
+    def on_answer(self, rtt):
+        self.answered += 1
+        self.rttvar += RTTVAR_BETA * (abs(self.srtt - rtt) - self.rttvar)
+        self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        self.loss -= LOSS_ALPHA * self.loss
+
+    def on_late(self, elapsed):
+        # beaten by another server: only a lower bound of its rtt is known
+        if elapsed > self.srtt:
+            self.srtt += RTT_ALPHA * (elapsed - self.srtt)
+
+    def on_timeout(self, elapsed):
+        self.timeouts += 1
+        self.on_late(elapsed)
+        self.loss += LOSS_ALPHA * (1.0 - self.loss)
+
+    @property
+    def score(self):
+        # expected time to an answer, counting the retries losses cost
+        return self.srtt / (1.0 - min(self.loss, MAX_LOSS))
+
+    @property
+    def hedge_delay(self):
+        """
+        How long to wait on this server before asking another one too:
+        long enough for nearly every answer it gives.
+        """
+        delay = self.srtt + 4 * self.rttvar
+        return min(max(delay, MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+    def as_dict(self):
+        return {
+            "addr": "%s:%u" % self.addr,
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "loss": self.loss,
+            "sent": self.sent,
+            "answered": self.answered,
+            "timeouts": self.timeouts,
+        }
+
+
+class UpstreamSet:
+    """
+    The configured upstreams, best first by Upstream.score.
+    """
+
+    def __init__(self, upstreams=DEFAULT_UPSTREAMS):
+        self._upstreams = [Upstream(host, port) for host, port in upstreams]
+        if not self._upstreams:
+            raise ValueError("at least one upstream is needed")
+        self._by_addr = {u.addr: u for u in self._upstreams}
+
+    def __len__(self):
+        return len(self._upstreams)
+
+    def __iter__(self):
+        return iter(self._upstreams)
+
+    def get(self, addr):
+        return self._by_addr.get(tuple(addr[:2]))
+
+    def ranked(self):
+        return sorted(self._upstreams, key=lambda u: u.score)
+
+    def stats(self):
+        return [u.as_dict() for u in self.ranked()]
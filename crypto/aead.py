@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    with_statement,
+)
+
+from ctypes import create_string_buffer
+from struct import pack, unpack_from
+
+from crypto.hkdf import hkdf
+from crypto.util import to_str
+
+# EVP_CIPHER_CTX_ctrl, the GCM names work for every AEAD mode since 1.1.0
+EVP_CTRL_AEAD_SET_IVLEN = 0x9
+EVP_CTRL_AEAD_GET_TAG = 0x10
+EVP_CTRL_AEAD_SET_TAG = 0x11
+
+AEAD_MSG_LEN_UNKNOWN = 0
+AEAD_CHUNK_SIZE_LEN = 2
+AEAD_CHUNK_SIZE_MASK = 0x3FFF
+
+SUBKEY_INFO = b"ss-subkey"
+
+CIPHER_NONCE_LEN = {
+    "aes-128-gcm": 12,
+    "aes-192-gcm": 12,
+    "aes-256-gcm": 12,
+    "aes-128-ocb": 12,
+    "aes-192-ocb": 12,
+    "aes-256-ocb": 12,
+    "chacha20-ietf-poly1305": 12,
+}
+
+CIPHER_TAG_LEN = {
+    "aes-128-gcm": 16,
+    "aes-192-gcm": 16,
+    "aes-256-gcm": 16,
+    "aes-128-ocb": 16,
+    "aes-192-ocb": 16,
+    "aes-256-ocb": 16,
+    "chacha20-ietf-poly1305": 16,
+}
+
+
+class AeadCryptoBase(object):
+    """
+    Shadowsocks AEAD framing on top of a cipher that seals one message at
+    a time (aead_encrypt / aead_decrypt): the session subkey is derived
+    from the master key and the salt with HKDF-SHA1, the nonce is a
+    little endian counter bumped after every message, and a stream is
+    cut into chunks of
+
+        [encrypted payload length][tag][encrypted payload][tag]
+
+    with at most AEAD_CHUNK_SIZE_MASK bytes of payload each.
+
+    encrypt() and decrypt() take whatever a recv returned, as a whole:
+    decrypt() keeps a partial chunk for the next call and returns the
+    plain text of every complete one. encrypt_into() and decrypt_into()
+    do the same into a caller's buffer, sized with encrypt_size() and
+    decrypt_size().
+    """
+
+    def __init__(self, cipher_name, key, iv, op, crypto_path=None):
+        cipher_name = to_str(cipher_name)
+        self._op = int(op)
+        self._salt = iv
+        self._nlen = CIPHER_NONCE_LEN[cipher_name]
+        self._nonce = create_string_buffer(self._nlen)
+        self._nonce_mask = (1 << (8 * self._nlen)) - 1
+        self._tlen = CIPHER_TAG_LEN[cipher_name]
+        self._skey = self.derive_subkey(key, iv)
+        self._buf = bytearray()
+        self._mlen = AEAD_MSG_LEN_UNKNOWN
+        self._head = bytearray(AEAD_CHUNK_SIZE_LEN)
+
+    def derive_subkey(self, key, salt):
+        """
+        The session subkey of the master key and the salt
+        """
+        return hkdf(key, salt, SUBKEY_INFO, len(key))
+
+    def nonce_increment(self):
+        nonce = int.from_bytes(self._nonce.raw, "little") + 1
+        self._nonce.raw = (nonce & self._nonce_mask).to_bytes(
+            self._nlen, "little"
+        )
+
+    def encrypt_size(self, size):
+        """
+        Exact encrypt_into() output length for size bytes of plain text
+        """
+        chunks = -(-size // AEAD_CHUNK_SIZE_MASK)
+        return size + chunks * (AEAD_CHUNK_SIZE_LEN + 2 * self._tlen)
+
+    def decrypt_size(self, size):
+        """
+        Upper bound of decrypt_into() output for size more bytes of cipher
+        text: chunk framing only ever shrinks what is buffered
+        """
+        return size + len(self._buf)
+
+    def encrypt(self, data):
+        """
+        Encrypt a whole buffer into as many chunks as it takes
+        :param data: plain text
+        :return: the chunks
+        """
+        out = bytearray(self.encrypt_size(len(data)))
+        self.encrypt_into(data, out)
+        return bytes(out)
+
+    def decrypt(self, data):
+        """
+        Decrypt every complete chunk buffered so far
+        :param data: cipher text, any amount
+        :return: plain text, possibly empty
+        """
+        out = bytearray(self.decrypt_size(len(data)))
+        n = self.decrypt_into(data, out)
+        return bytes(memoryview(out)[:n])
+
+    def encrypt_into(self, data, out):
+        """
+        encrypt() into a caller's buffer of encrypt_size(len(data)) bytes
+        :return: number of bytes written
+        """
+        data = memoryview(data)
+        out = memoryview(out)
+        n = 0
+        for pos in range(0, len(data), AEAD_CHUNK_SIZE_MASK):
+            chunk = data[pos : pos + AEAD_CHUNK_SIZE_MASK]
+            n += self.aead_encrypt_into(pack("!H", len(chunk)), out[n:])
+            n += self.aead_encrypt_into(chunk, out[n:])
+        return n
+
+    def decrypt_into(self, data, out):
+        """
+        decrypt() into a caller's buffer of decrypt_size(len(data)) bytes.
+        Chunks are opened where they lie in data, only a trailing partial
+        one is copied aside for the next call.
+        :return: number of plain text bytes written
+        """
+        buf = self._buf
+        pending = bool(buf)
+        if pending:
+            buf += data
+            view = memoryview(buf)
+        else:
+            view = memoryview(data)
+        out = memoryview(out)
+        head = self._head
+        head_len = AEAD_CHUNK_SIZE_LEN + self._tlen
+        n = 0
+        pos = 0
+        while True:
+            if self._mlen == AEAD_MSG_LEN_UNKNOWN:
+                if len(view) - pos < head_len:
+                    break
+                self.aead_decrypt_into(view[pos : pos + head_len], head)
+                (mlen,) = unpack_from("!H", head)
+                mlen &= AEAD_CHUNK_SIZE_MASK
+                if not mlen:
+                    raise Exception("zero length chunk")
+                self._mlen = mlen
+                pos += head_len
+            end = pos + self._mlen + self._tlen
+            if len(view) < end:
+                break
+            n += self.aead_decrypt_into(view[pos:end], out[n:])
+            self._mlen = AEAD_MSG_LEN_UNKNOWN
+            pos = end
+        if pending:
+            view.release()
+            del buf[:pos]
+        else:
+            buf += view[pos:]
+        return n
+
+
+def test_nonce_increment():
+    base = AeadCryptoBase("aes-128-gcm", b"k" * 16, b"i" * 16, 1)
+    base.nonce_increment()
+    assert base._nonce.raw == b"\x01" + b"\x00" * 11
+    base._nonce.raw = b"\xff\xff" + b"\x00" * 10
+    base.nonce_increment()
+    assert base._nonce.raw == b"\x00\x00\x01" + b"\x00" * 9
+    base._nonce.raw = b"\xff" * 12
+    base.nonce_increment()
+    assert base._nonce.raw == b"\x00" * 12
+
+
+if __name__ == "__main__":
+    test_nonce_increment()
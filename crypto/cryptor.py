@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    with_statement,
+)
+
+import hashlib
+import os
+
+from crypto import openssl, rc4_md5
+from crypto.openssl import ctx_pool
+from crypto.util import to_bytes, to_str
+
+__all__ = ["Cryptor", "ctx_pool", "method_supported", "try_cipher"]
+
+CIPHER_ENC_ENCRYPTION = 1
+CIPHER_ENC_DECRYPTION = 0
+
+method_supported = {}
+method_supported.update(openssl.ciphers)
+method_supported.update(rc4_md5.ciphers)
+
+
+def random_string(length):
+    return os.urandom(length)
+
+
+def EVP_BytesToKey(password, key_len):
+    """
+    OpenSSL's EVP_BytesToKey with MD5, one iteration and no salt: the
+    master key of a password
+    """
+    password = to_bytes(password)
+    m = []
+    i = 0
+    while len(b"".join(m)) < key_len:
+        md5 = hashlib.md5()
+        data = password
+        if i > 0:
+            data = m[i - 1] + password
+        md5.update(data)
+        m.append(md5.digest())
+        i += 1
+    return b"".join(m)[:key_len]
+
+
+# (password, key length) -> master key, one per configured password
+master_keys = {}
+
+
+def master_key(password, key_len):
+    """
+    EVP_BytesToKey once per password: every connection of a method shares
+    the master key, only the subkey depends on the salt
+    """
+    password = to_bytes(password)
+    key = master_keys.get((password, key_len))
+    if key is None:
+        key = master_keys[(password, key_len)] = EVP_BytesToKey(
+            password, key_len
+        )
+    return key
+
+
+def try_cipher(password, method):
+    Cryptor(password, method).close()
+
+
+class Cryptor(object):
+    """
+    Both directions of one shadowsocks stream. The first encrypt() output
+    starts with a random salt (the IV of stream methods); decrypt() waits
+    for the peer's salt before it returns anything.
+    """
+
+    def __init__(self, password, method, crypto_path=None):
+        method = to_str(method).lower()
+        if method not in method_supported:
+            raise Exception("method %s not supported" % method)
+        self.method = method
+        self._crypto_path = crypto_path
+        self.key_len, self.iv_len, self._m = method_supported[method]
+        self.key = master_key(password, self.key_len)
+        self.cipher_iv = random_string(self.iv_len)
+        self.cipher = self._m(
+            method,
+            self.key,
+            self.cipher_iv,
+            CIPHER_ENC_ENCRYPTION,
+            crypto_path,
+        )
+        self.decipher = None
+        self._iv_sent = False
+        self._decipher_iv = b""
+
+    def encrypt(self, buf):
+        if not buf:
+            return b""
+        if self._iv_sent:
+            return self.cipher.encrypt(buf)
+        self._iv_sent = True
+        return self.cipher_iv + self.cipher.encrypt(buf)
+
+    def decrypt(self, buf):
+        if not buf:
+            return b""
+        if self.decipher is None:
+            need = self.iv_len - len(self._decipher_iv)
+            self._decipher_iv += bytes(buf[:need])
+            buf = buf[need:]
+            if len(self._decipher_iv) < self.iv_len:
+                return b""
+            self.decipher = self._m(
+                self.method,
+                self.key,
+                self._decipher_iv,
+                CIPHER_ENC_DECRYPTION,
+                self._crypto_path,
+            )
+            if not buf:
+                return b""
+        return self.decipher.decrypt(buf)
+
+    def close(self):
+        """Give the cipher contexts back to the pool"""
+        self.cipher.clean()
+        if self.decipher is not None:
+            self.decipher.clean()
+
+    def encrypt_size(self, size):
+        """Length of what encrypt_into() writes for size bytes"""
+        size = self.cipher.encrypt_size(size)
+        return size if self._iv_sent else size + self.iv_len
+
+    def decrypt_size(self, size):
+        """Most decrypt_into() can write for size more bytes"""
+        if self.decipher is None:
+            return size
+        return self.decipher.decrypt_size(size)
+
+    def encrypt_into(self, buf, out):
+        """
+        encrypt() into out, a writable buffer of encrypt_size(len(buf))
+        bytes; returns the number of bytes written
+        """
+        if not len(buf):
+            return 0
+        if self._iv_sent:
+            return self.cipher.encrypt_into(buf, out)
+        self._iv_sent = True
+        out = memoryview(out)
+        out[: self.iv_len] = self.cipher_iv
+        return self.iv_len + self.cipher.encrypt_into(buf, out[self.iv_len :])
+
+    def decrypt_into(self, buf, out):
+        """
+        decrypt() into out, a writable buffer of decrypt_size(len(buf))
+        bytes; returns the number of bytes written
+        """
+        if not len(buf):
+            return 0
+        if self.decipher is None:
+            buf = memoryview(buf)
+            need = self.iv_len - len(self._decipher_iv)
+            self._decipher_iv += buf[:need].tobytes()
+            buf = buf[need:]
+            if len(self._decipher_iv) < self.iv_len:
+                return 0
+            self.decipher = self._m(
+                self.method,
+                self.key,
+                self._decipher_iv,
+                CIPHER_ENC_DECRYPTION,
+                self._crypto_path,
+            )
+            if not buf:
+                return 0
+        return self.decipher.decrypt_into(buf, out)
+
+
+class _IntoPipe(object):
+    # _Pipe through the *_into calls and two reused buffers, as the relay
+    # pumps them
+    def __init__(self, sender, receiver):
+        self._sender = sender
+        self._receiver = receiver
+        self._sealed = bytearray()
+        self._opened = bytearray()
+
+    def encrypt_once(self, data):
+        size = self._sender.encrypt_size(len(data))
+        if len(self._sealed) < size:
+            self._sealed = bytearray(size * 2)
+        n = self._sender.encrypt_into(data, self._sealed)
+        return memoryview(self._sealed)[:n].tobytes()
+
+    def decrypt_once(self, data):
+        data = bytearray(data)
+        size = self._receiver.decrypt_size(len(data))
+        if len(self._opened) < size:
+            self._opened = bytearray(size * 2)
+        n = self._receiver.decrypt_into(data, self._opened)
+        return memoryview(self._opened)[:n].tobytes()
+
+
+class _Pipe(object):
+    # one direction of a Cryptor pair, shaped for util.run_cipher
+    def __init__(self, sender, receiver):
+        self.encrypt_once = sender.encrypt
+        self.decrypt_once = receiver.decrypt
+
+
+def run_method(method):
+    from crypto import util
+
+    print(method, ": [salt][chunks]")
+    local = Cryptor(b"password", method)
+    server = Cryptor(b"password", method)
+    pipe = _Pipe(local, server)
+    util.run_cipher(pipe, pipe)
+    print(method, ": [salt][chunks] into reused buffers")
+    local = Cryptor(b"password", method)
+    server = Cryptor(b"password", method)
+    pipe = _IntoPipe(local, server)
+    util.run_cipher(pipe, pipe)
+
+
+def bench_connections(method="aes-256-gcm", rounds=20000):
+    """
+    Connections per second a relay can set up: both ends of a connection
+    with a first small payload each way, key caches on and off
+    """
+    import time
+
+    from crypto.aead import AeadCryptoBase
+
+    def connection():
+        local = Cryptor(b"password", method)
+        server = Cryptor(b"password", method)
+        server.decrypt(local.encrypt(b"request"))
+        local.decrypt(server.encrypt(b"response"))
+        local.close()
+        server.close()
+
+    def uncached():
+        master_keys.clear()
+        connection()
+
+    native = openssl.OpenSSLAeadCrypto.derive_subkey
+    for label, run in (
+        ("no key cache, hashlib hkdf", uncached),
+        ("cached master key, libcrypto hkdf", connection),
+    ):
+        if run is uncached:
+            openssl.OpenSSLAeadCrypto.derive_subkey = (
+                AeadCryptoBase.derive_subkey
+            )
+        try:
+            start = time.time()
+            for _ in range(rounds):
+                run()
+            print(
+                "%s, %s: %d conns/s"
+                % (method, label, rounds / (time.time() - start))
+            )
+        finally:
+            openssl.OpenSSLAeadCrypto.derive_subkey = native
+
+
+if __name__ == "__main__":
+    for name in (
+        "aes-128-gcm",
+        "aes-256-gcm",
+        "chacha20-ietf-poly1305",
+        "aes-256-cfb",
+    ):
+        run_method(name)
+    bench_connections("aes-256-gcm")
+    bench_connections("aes-256-cfb")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    with_statement,
+)
+
+import hashlib
+import hmac
+
+__all__ = ["hkdf_extract", "hkdf_expand", "hkdf"]
+
+
+def hkdf_extract(salt, input_key_material, hash=hashlib.sha1):
+    """
+    RFC 5869 extract step
+    :return: pseudo random key
+    """
+    if not salt:
+        salt = b"\x00" * hash().digest_size
+    return hmac.new(salt, input_key_material, hash).digest()
+
+
+def hkdf_expand(pseudo_random_key, info=b"", length=32, hash=hashlib.sha1):
+    """
+    RFC 5869 expand step
+    :return: output key material of ``length`` bytes
+    """
+    hash_len = hash().digest_size
+    if length > 255 * hash_len:
+        raise Exception(
+            "cannot expand to more than %d bytes" % (255 * hash_len)
+        )
+    blocks = []
+    block = b""
+    for counter in range(1, -(-length // hash_len) + 1):
+        block = hmac.new(
+            pseudo_random_key, block + info + bytes((counter,)), hash
+        ).digest()
+        blocks.append(block)
+    return b"".join(blocks)[:length]
+
+
+def hkdf(key, salt, info, length, hash=hashlib.sha1):
+    return hkdf_expand(hkdf_extract(salt, key, hash), info, length, hash)
+
+
+def test():
+    # RFC 5869 test case 4, SHA-1
+    okm = hkdf(
+        bytes.fromhex("0b0b0b0b0b0b0b0b0b0b0b"),
+        bytes.fromhex("000102030405060708090a0b0c"),
+        bytes.fromhex("f0f1f2f3f4f5f6f7f8f9"),
+        42,
+    )
+    assert okm == bytes.fromhex(
+        "085a01ea1b10f36933068b56efa5ad81a4f14b822f5b091568a9cdd4f155fda2"
+        "c22e422478d305f3f896"
+    )
+
+
+if __name__ == "__main__":
+    test()
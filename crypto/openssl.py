@@ -14,51 +14,100 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from __future__ import absolute_import, division, print_function, \
-    with_statement
-
-from ctypes import c_char_p, c_int, c_long, byref,\
-    create_string_buffer, c_void_p
-
-from shadowsocks import common
-from shadowsocks.crypto import util
-from shadowsocks.crypto.aead import AeadCryptoBase, EVP_CTRL_AEAD_SET_IVLEN, \
-    EVP_CTRL_AEAD_GET_TAG, EVP_CTRL_AEAD_SET_TAG
-
-__all__ = ['ciphers']
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    with_statement,
+)
+
+import threading
+from ctypes import (
+    c_char,
+    c_char_p,
+    c_int,
+    c_size_t,
+    c_uint,
+    byref,
+    create_string_buffer,
+    c_void_p,
+    string_at,
+    Structure,
+)
+
+from crypto import util
+from crypto.aead import (
+    AeadCryptoBase,
+    EVP_CTRL_AEAD_SET_IVLEN,
+    EVP_CTRL_AEAD_GET_TAG,
+    EVP_CTRL_AEAD_SET_TAG,
+    SUBKEY_INFO,
+)
+from crypto.hkdf import hkdf
+
+__all__ = ["ciphers"]
 
 libcrypto = None
 loaded = False
 libsodium = None
 
-buf = None
+# EVP_KDF HKDF of OpenSSL 3, None before it or when it is missing
+hkdf_kdf = None
+
+# initial size of the per context scratch buffer update() returns from
 buf_size = 2048
 
 ctx_cleanup = None
 
 CIPHER_ENC_UNCHANGED = -1
 
+# reset contexts kept for the next streams, per process
+CTX_POOL_SIZE = 256
+
+OSSL_PARAM_UTF8_STRING = 4
+OSSL_PARAM_OCTET_STRING = 5
+OSSL_PARAM_UNMODIFIED = c_size_t(-1).value
+
+# shadowsocks method name -> name libcrypto knows the cipher by
+OPENSSL_CIPHER_NAMES = {
+    "chacha20-ietf-poly1305": "chacha20-poly1305",
+}
+
 
 def load_openssl(crypto_path=None):
-    global loaded, libcrypto, libsodium, buf, ctx_cleanup
+    global loaded, libcrypto, ctx_cleanup, hkdf_kdf
 
     crypto_path = dict(crypto_path) if crypto_path else dict()
-    path = crypto_path.get('openssl', None)
-    libcrypto = util.find_library(('crypto', 'eay32'),
-                                  'EVP_get_cipherbyname',
-                                  'libcrypto', path)
+    path = crypto_path.get("openssl", None)
+    libcrypto = util.find_library(
+        ("crypto", "eay32"), "EVP_get_cipherbyname", "libcrypto", path
+    )
     if libcrypto is None:
-        raise Exception('libcrypto(OpenSSL) not found with path %s' % path)
+        raise Exception("libcrypto(OpenSSL) not found with path %s" % path)
 
     libcrypto.EVP_get_cipherbyname.restype = c_void_p
+    if hasattr(libcrypto, "EVP_CIPHER_fetch"):
+        libcrypto.EVP_CIPHER_fetch.restype = c_void_p
+        libcrypto.EVP_CIPHER_fetch.argtypes = (c_void_p, c_char_p, c_char_p)
     libcrypto.EVP_CIPHER_CTX_new.restype = c_void_p
 
-    libcrypto.EVP_CipherInit_ex.argtypes = (c_void_p, c_void_p, c_char_p,
-                                            c_char_p, c_char_p, c_int)
+    libcrypto.EVP_CipherInit_ex.argtypes = (
+        c_void_p,
+        c_void_p,
+        c_char_p,
+        c_char_p,
+        c_char_p,
+        c_int,
+    )
     libcrypto.EVP_CIPHER_CTX_ctrl.argtypes = (c_void_p, c_int, c_int, c_void_p)
 
-    libcrypto.EVP_CipherUpdate.argtypes = (c_void_p, c_void_p, c_void_p,
-                                           c_char_p, c_int)
+    libcrypto.EVP_CipherUpdate.argtypes = (
+        c_void_p,
+        c_void_p,
+        c_void_p,
+        c_void_p,
+        c_int,
+    )
 
     libcrypto.EVP_CipherFinal_ex.argtypes = (c_void_p, c_void_p, c_void_p)
 
@@ -69,17 +118,99 @@ def load_openssl(crypto_path=None):
         libcrypto.EVP_CIPHER_CTX_reset.argtypes = (c_void_p,)
         ctx_cleanup = libcrypto.EVP_CIPHER_CTX_reset
     libcrypto.EVP_CIPHER_CTX_free.argtypes = (c_void_p,)
-    if hasattr(libcrypto, 'OpenSSL_add_all_ciphers'):
+    if hasattr(libcrypto, "OpenSSL_add_all_ciphers"):
         libcrypto.OpenSSL_add_all_ciphers()
 
-    buf = create_string_buffer(buf_size)
+    if hasattr(libcrypto, "EVP_KDF_fetch"):
+        libcrypto.EVP_KDF_fetch.restype = c_void_p
+        libcrypto.EVP_KDF_fetch.argtypes = (c_void_p, c_char_p, c_char_p)
+        libcrypto.EVP_KDF_CTX_new.restype = c_void_p
+        libcrypto.EVP_KDF_CTX_new.argtypes = (c_void_p,)
+        libcrypto.EVP_KDF_CTX_set_params.argtypes = (c_void_p, c_void_p)
+        libcrypto.EVP_KDF_derive.argtypes = (
+            c_void_p,
+            c_void_p,
+            c_size_t,
+            c_void_p,
+        )
+        hkdf_kdf = libcrypto.EVP_KDF_fetch(None, b"HKDF", None)
+
     loaded = True
 
 
+# libcrypto cipher name -> EVP_CIPHER*, never freed
+cipher_cache = {}
+
+
+def get_cipher(cipher_name):
+    """
+    The EVP_CIPHER* of a libcrypto cipher name, looked up once per process.
+    OpenSSL 3 fetches the provider implementation at every
+    EVP_CipherInit_ex of a cipher from EVP_get_cipherbyname, a fetched one
+    is bound already.
+    """
+    cipher = cipher_cache.get(cipher_name)
+    if cipher:
+        return cipher
+    if hasattr(libcrypto, "EVP_CIPHER_fetch"):
+        cipher = libcrypto.EVP_CIPHER_fetch(None, cipher_name, None)
+    if not cipher:
+        cipher = libcrypto.EVP_get_cipherbyname(cipher_name)
+    if not cipher:
+        cipher = load_cipher(cipher_name)
+    if cipher:
+        cipher_cache[cipher_name] = cipher
+    return cipher
+
+
+class CipherCtxPool(object):
+    """
+    Free list of EVP_CIPHER_CTX shared by all the streams of a process. A
+    stream takes one instead of EVP_CIPHER_CTX_new() and puts it back
+    reset, so no key stays behind, instead of freeing it. list.pop and
+    list.append keep it safe across threads.
+    """
+
+    def __init__(self, size=CTX_POOL_SIZE):
+        self.size = size
+        self._free = []
+        self.hits = 0
+        self.misses = 0
+        self.freed = 0
+
+    def get(self):
+        try:
+            ctx = self._free.pop()
+        except IndexError:
+            self.misses += 1
+            return libcrypto.EVP_CIPHER_CTX_new()
+        self.hits += 1
+        return ctx
+
+    def put(self, ctx):
+        ctx_cleanup(ctx)
+        if len(self._free) < self.size:
+            self._free.append(ctx)
+        else:
+            self.freed += 1
+            libcrypto.EVP_CIPHER_CTX_free(ctx)
+
+    def stats(self):
+        return {
+            "idle": len(self._free),
+            "hits": self.hits,
+            "misses": self.misses,
+            "freed": self.freed,
+        }
+
+
+ctx_pool = CipherCtxPool()
+
+
 def load_cipher(cipher_name):
-    func_name = b'EVP_' + cipher_name.replace(b'-', b'_')
+    func_name = b"EVP_" + cipher_name.replace(b"-", b"_")
     if bytes != str:
-        func_name = str(func_name, 'utf-8')
+        func_name = str(func_name, "utf-8")
     cipher = getattr(libcrypto, func_name, None)
     if cipher:
         cipher.restype = c_void_p
@@ -87,25 +218,127 @@ def load_cipher(cipher_name):
     return None
 
 
+class OSSL_PARAM(Structure):
+    _fields_ = [
+        ("key", c_char_p),
+        ("data_type", c_uint),
+        ("data", c_char_p),
+        ("data_size", c_size_t),
+        ("return_size", c_size_t),
+    ]
+
+
+def ossl_param(key, data_type, data):
+    return OSSL_PARAM(key, data_type, data, len(data), OSSL_PARAM_UNMODIFIED)
+
+
+class SubkeyDeriver(object):
+    """
+    HKDF-SHA1 of one master key in one EVP_KDF_derive() call per salt: the
+    kdf context keeps the digest, the key and the info, a derive passes the
+    salt only
+    """
+
+    def __init__(self, key, info):
+        self._ctx = libcrypto.EVP_KDF_CTX_new(hkdf_kdf)
+        if not self._ctx:
+            raise Exception("can not create kdf context")
+        params = (OSSL_PARAM * 4)(
+            ossl_param(b"digest", OSSL_PARAM_UTF8_STRING, b"SHA1"),
+            ossl_param(b"key", OSSL_PARAM_OCTET_STRING, key),
+            ossl_param(b"info", OSSL_PARAM_OCTET_STRING, info),
+            OSSL_PARAM(),
+        )
+        if libcrypto.EVP_KDF_CTX_set_params(self._ctx, params) != 1:
+            raise Exception("can not set up hkdf")
+        self._params = (OSSL_PARAM * 2)(
+            ossl_param(b"salt", OSSL_PARAM_OCTET_STRING, b""),
+            OSSL_PARAM(),
+        )
+        self._out = create_string_buffer(len(key))
+
+    def derive(self, salt, length):
+        if len(self._out) < length:
+            self._out = create_string_buffer(length)
+        param = self._params[0]
+        param.data = salt
+        param.data_size = len(salt)
+        r = libcrypto.EVP_KDF_derive(
+            self._ctx, self._out, length, self._params
+        )
+        if r != 1:
+            raise Exception("hkdf failed")
+        return self._out.raw[:length]
+
+
+# kdf contexts are not shared between threads: (key, info) -> deriver
+derivers = threading.local()
+
+
+def hkdf_sha1(key, salt, info, length):
+    """
+    crypto.hkdf.hkdf() with SHA-1 through libcrypto when it has EVP_KDF.
+    The kdf context of a key is kept: the keys are the master keys of the
+    configured passwords, a handful.
+    """
+    if not loaded:
+        load_openssl(None)
+    if not hkdf_kdf:
+        return hkdf(key, salt, info, length)
+    cache = getattr(derivers, "cache", None)
+    if cache is None:
+        cache = derivers.cache = {}
+    deriver = cache.get((key, info))
+    if deriver is None:
+        deriver = cache[(key, info)] = SubkeyDeriver(key, info)
+    return deriver.derive(salt, length)
+
+
+def in_pointer(data):
+    """
+    EVP_CipherUpdate input without a copy: bytes are passed as they are,
+    any writable buffer (bytearray, memoryview slice of one) is viewed in
+    place. Only a read only buffer other than bytes gets copied.
+    """
+    if isinstance(data, bytes):
+        return data
+    view = memoryview(data)
+    if view.readonly:
+        return view.tobytes()
+    return (c_char * view.nbytes).from_buffer(view)
+
+
+def out_pointer(data):
+    """
+    A writable buffer as an EVP_CipherUpdate output pointer
+    """
+    view = memoryview(data)
+    return (c_char * view.nbytes).from_buffer(view)
+
+
 class OpenSSLCryptoBase(object):
     """
     OpenSSL crypto base class
     """
+
     def __init__(self, cipher_name, crypto_path=None):
         self._ctx = None
         self._cipher = None
         if not loaded:
             load_openssl(crypto_path)
-        cipher_name = common.to_bytes(cipher_name)
-        cipher = libcrypto.EVP_get_cipherbyname(cipher_name)
-        if not cipher:
-            cipher = load_cipher(cipher_name)
+        cipher_name = util.to_bytes(
+            OPENSSL_CIPHER_NAMES.get(util.to_str(cipher_name), cipher_name)
+        )
+        cipher = get_cipher(cipher_name)
         if not cipher:
-            raise Exception('cipher %s not found in libcrypto' % cipher_name)
-        self._ctx = libcrypto.EVP_CIPHER_CTX_new()
+            raise Exception("cipher %s not found in libcrypto" % cipher_name)
+        self._ctx = ctx_pool.get()
         self._cipher = cipher
         if not self._ctx:
-            raise Exception('can not create cipher context')
+            raise Exception("can not create cipher context")
+        # per context, a global one can not be shared between threads
+        self._scratch_size = buf_size
+        self._scratch = create_string_buffer(buf_size)
 
     def encrypt_once(self, data):
         return self.update(data)
@@ -119,26 +352,49 @@ class OpenSSLCryptoBase(object):
         :param data: str
         :return: str
         """
-        global buf_size, buf
-        cipher_out_len = c_long(0)
-        l = len(data)
-        if buf_size < l:
-            buf_size = l * 2
-            buf = create_string_buffer(buf_size)
+        cipher_out_len = c_int(0)
+        size = len(data)
+        if self._scratch_size < size:
+            self._scratch_size = size * 2
+            self._scratch = create_string_buffer(self._scratch_size)
         libcrypto.EVP_CipherUpdate(
-            self._ctx, byref(buf),
-            byref(cipher_out_len), c_char_p(data), l
+            self._ctx,
+            self._scratch,
+            byref(cipher_out_len),
+            in_pointer(data),
+            size,
         )
-        # buf is copied to a str object when we access buf.raw
-        return buf.raw[:cipher_out_len.value]
+        # copies the output only, buf.raw would copy the whole buffer
+        return string_at(self._scratch, cipher_out_len.value)
+
+    def update_into(self, src, dst):
+        """
+        Encrypt/decrypt src straight into dst, no copy on either side
+        :param src: bytes or a buffer
+        :param dst: writable buffer of at least len(src) bytes
+        :return: number of bytes written to dst
+        """
+        cipher_out_len = c_int(0)
+        size = len(src)
+        if len(dst) < size:
+            raise ValueError("output buffer too small")
+        r = libcrypto.EVP_CipherUpdate(
+            self._ctx,
+            out_pointer(dst),
+            byref(cipher_out_len),
+            in_pointer(src),
+            size,
+        )
+        if not r:
+            raise Exception("Update cipher failed")
+        return cipher_out_len.value
 
     def __del__(self):
         self.clean()
 
     def clean(self):
         if self._ctx:
-            ctx_cleanup(self._ctx)
-            libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            ctx_pool.put(self._ctx)
             self._ctx = None
 
 
@@ -146,34 +402,31 @@ class OpenSSLAeadCrypto(OpenSSLCryptoBase, AeadCryptoBase):
     """
     Implement OpenSSL Aead mode: gcm, ocb
     """
+
     def __init__(self, cipher_name, key, iv, op, crypto_path=None):
         OpenSSLCryptoBase.__init__(self, cipher_name, crypto_path)
         AeadCryptoBase.__init__(self, cipher_name, key, iv, op, crypto_path)
 
         key_ptr = c_char_p(self._skey)
         r = libcrypto.EVP_CipherInit_ex(
-            self._ctx,
-            self._cipher,
-            None,
-            key_ptr, None,
-            c_int(op)
+            self._ctx, self._cipher, None, key_ptr, None, c_int(op)
         )
         if not r:
             self.clean()
-            raise Exception('can not initialize cipher context')
+            raise Exception("can not initialize cipher context")
 
         r = libcrypto.EVP_CIPHER_CTX_ctrl(
-            self._ctx,
-            c_int(EVP_CTRL_AEAD_SET_IVLEN),
-            c_int(self._nlen),
-            None
+            self._ctx, c_int(EVP_CTRL_AEAD_SET_IVLEN), c_int(self._nlen), None
         )
         if not r:
             self.clean()
-            raise Exception('Set ivlen failed')
+            raise Exception("Set ivlen failed")
 
         self.cipher_ctx_init()
 
+    def derive_subkey(self, key, salt):
+        return hkdf_sha1(key, salt, SUBKEY_INFO, len(key))
+
     def cipher_ctx_init(self):
         """
         Need init cipher context after EVP_CipherFinal_ex to reuse context
@@ -181,15 +434,11 @@ class OpenSSLAeadCrypto(OpenSSLCryptoBase, AeadCryptoBase):
         """
         iv_ptr = c_char_p(self._nonce.raw)
         r = libcrypto.EVP_CipherInit_ex(
-            self._ctx,
-            None,
-            None,
-            None, iv_ptr,
-            c_int(CIPHER_ENC_UNCHANGED)
+            self._ctx, None, None, None, iv_ptr, c_int(CIPHER_ENC_UNCHANGED)
         )
         if not r:
             self.clean()
-            raise Exception('can not initialize cipher context')
+            raise Exception("can not initialize cipher context")
 
         AeadCryptoBase.nonce_increment(self)
 
@@ -203,11 +452,12 @@ class OpenSSLAeadCrypto(OpenSSLCryptoBase, AeadCryptoBase):
         r = libcrypto.EVP_CIPHER_CTX_ctrl(
             self._ctx,
             c_int(EVP_CTRL_AEAD_SET_TAG),
-            c_int(tag_len), c_char_p(tag)
+            c_int(tag_len),
+            c_char_p(tag),
         )
         if not r:
             self.clean()
-            raise Exception('Set tag failed')
+            raise Exception("Set tag failed")
 
     def get_tag(self):
         """
@@ -219,11 +469,12 @@ class OpenSSLAeadCrypto(OpenSSLCryptoBase, AeadCryptoBase):
         r = libcrypto.EVP_CIPHER_CTX_ctrl(
             self._ctx,
             c_int(EVP_CTRL_AEAD_GET_TAG),
-            c_int(tag_len), byref(tag_buf)
+            c_int(tag_len),
+            byref(tag_buf),
         )
         if not r:
             self.clean()
-            raise Exception('Get tag failed')
+            raise Exception("Get tag failed")
         return tag_buf.raw[:tag_len]
 
     def final(self):
@@ -231,17 +482,15 @@ class OpenSSLAeadCrypto(OpenSSLCryptoBase, AeadCryptoBase):
         Finish encrypt/decrypt a chunk (<= 0x3FFF)
         :return: str
         """
-        global buf_size, buf
-        cipher_out_len = c_long(0)
+        cipher_out_len = c_int(0)
         r = libcrypto.EVP_CipherFinal_ex(
-            self._ctx,
-            byref(buf), byref(cipher_out_len)
+            self._ctx, self._scratch, byref(cipher_out_len)
         )
         if not r:
             self.clean()
             # print(self._nonce.raw, r, cipher_out_len)
-            raise Exception('Finalize cipher failed')
-        return buf.raw[:cipher_out_len.value]
+            raise Exception("Finalize cipher failed")
+        return string_at(self._scratch, cipher_out_len.value)
 
     def aead_encrypt(self, data):
         """
@@ -264,13 +513,63 @@ class OpenSSLAeadCrypto(OpenSSLCryptoBase, AeadCryptoBase):
         clen = len(data)
         if clen < self._tlen:
             self.clean()
-            raise Exception('Data too short')
+            raise Exception("Data too short")
 
-        self.set_tag(data[clen - self._tlen:])
-        plaintext = self.update(data[:clen - self._tlen]) + self.final()
+        self.set_tag(data[clen - self._tlen :])
+        plaintext = self.update(data[: clen - self._tlen]) + self.final()
         self.cipher_ctx_init()
         return plaintext
 
+    def aead_encrypt_into(self, data, out):
+        """
+        aead_encrypt() into a caller's buffer
+
+        :param data: plain text
+        :param out: writable buffer, len(data) + tag length at least
+        :return: number of bytes written, tag included
+        """
+        if len(out) < len(data) + self._tlen:
+            raise ValueError("output buffer too small")
+        out = memoryview(out)
+        n = self.update_into(data, out)
+        # gcm and chacha20 finish with nothing, ocb with < one block
+        tail = self.final()
+        out[n : n + len(tail)] = tail
+        n += len(tail)
+        r = libcrypto.EVP_CIPHER_CTX_ctrl(
+            self._ctx,
+            c_int(EVP_CTRL_AEAD_GET_TAG),
+            c_int(self._tlen),
+            out_pointer(out[n : n + self._tlen]),
+        )
+        if not r:
+            self.clean()
+            raise Exception("Get tag failed")
+        self.cipher_ctx_init()
+        return n + self._tlen
+
+    def aead_decrypt_into(self, data, out):
+        """
+        aead_decrypt() into a caller's buffer
+
+        :param data: cipher text with tag
+        :param out: writable buffer, len(data) - tag length at least
+        :return: number of plain text bytes written
+        """
+        clen = len(data)
+        if clen < self._tlen:
+            self.clean()
+            raise Exception("Data too short")
+
+        data = memoryview(data)
+        out = memoryview(out)
+        self.set_tag(data[clen - self._tlen :].tobytes())
+        n = self.update_into(data[: clen - self._tlen], out)
+        tail = self.final()
+        out[n : n + len(tail)] = tail
+        self.cipher_ctx_init()
+        return n + len(tail)
+
     def encrypt_once(self, data):
         return self.aead_encrypt(data)
 
@@ -282,15 +581,17 @@ class OpenSSLStreamCrypto(OpenSSLCryptoBase):
     """
     Crypto for stream modes: cfb, ofb, ctr
     """
+
     def __init__(self, cipher_name, key, iv, op, crypto_path=None):
         OpenSSLCryptoBase.__init__(self, cipher_name, crypto_path)
         key_ptr = c_char_p(key)
         iv_ptr = c_char_p(iv)
-        r = libcrypto.EVP_CipherInit_ex(self._ctx, self._cipher, None,
-                                        key_ptr, iv_ptr, c_int(op))
+        r = libcrypto.EVP_CipherInit_ex(
+            self._ctx, self._cipher, None, key_ptr, iv_ptr, c_int(op)
+        )
         if not r:
             self.clean()
-            raise Exception('can not initialize cipher context')
+            raise Exception("can not initialize cipher context")
 
     def encrypt(self, data):
         return self.update(data)
@@ -298,48 +599,61 @@ class OpenSSLStreamCrypto(OpenSSLCryptoBase):
     def decrypt(self, data):
         return self.update(data)
 
+    def encrypt_size(self, size):
+        return size
+
+    def decrypt_size(self, size):
+        return size
+
+    def encrypt_into(self, data, out):
+        return self.update_into(data, out)
+
+    def decrypt_into(self, data, out):
+        return self.update_into(data, out)
+
 
 ciphers = {
-    'aes-128-cfb': (16, 16, OpenSSLStreamCrypto),
-    'aes-192-cfb': (24, 16, OpenSSLStreamCrypto),
-    'aes-256-cfb': (32, 16, OpenSSLStreamCrypto),
-    'aes-128-ofb': (16, 16, OpenSSLStreamCrypto),
-    'aes-192-ofb': (24, 16, OpenSSLStreamCrypto),
-    'aes-256-ofb': (32, 16, OpenSSLStreamCrypto),
-    'aes-128-ctr': (16, 16, OpenSSLStreamCrypto),
-    'aes-192-ctr': (24, 16, OpenSSLStreamCrypto),
-    'aes-256-ctr': (32, 16, OpenSSLStreamCrypto),
-    'aes-128-cfb8': (16, 16, OpenSSLStreamCrypto),
-    'aes-192-cfb8': (24, 16, OpenSSLStreamCrypto),
-    'aes-256-cfb8': (32, 16, OpenSSLStreamCrypto),
-    'aes-128-cfb1': (16, 16, OpenSSLStreamCrypto),
-    'aes-192-cfb1': (24, 16, OpenSSLStreamCrypto),
-    'aes-256-cfb1': (32, 16, OpenSSLStreamCrypto),
-    'bf-cfb': (16, 8, OpenSSLStreamCrypto),
-    'camellia-128-cfb': (16, 16, OpenSSLStreamCrypto),
-    'camellia-192-cfb': (24, 16, OpenSSLStreamCrypto),
-    'camellia-256-cfb': (32, 16, OpenSSLStreamCrypto),
-    'cast5-cfb': (16, 8, OpenSSLStreamCrypto),
-    'des-cfb': (8, 8, OpenSSLStreamCrypto),
-    'idea-cfb': (16, 8, OpenSSLStreamCrypto),
-    'rc2-cfb': (16, 8, OpenSSLStreamCrypto),
-    'rc4': (16, 0, OpenSSLStreamCrypto),
-    'seed-cfb': (16, 16, OpenSSLStreamCrypto),
+    "aes-128-cfb": (16, 16, OpenSSLStreamCrypto),
+    "aes-192-cfb": (24, 16, OpenSSLStreamCrypto),
+    "aes-256-cfb": (32, 16, OpenSSLStreamCrypto),
+    "aes-128-ofb": (16, 16, OpenSSLStreamCrypto),
+    "aes-192-ofb": (24, 16, OpenSSLStreamCrypto),
+    "aes-256-ofb": (32, 16, OpenSSLStreamCrypto),
+    "aes-128-ctr": (16, 16, OpenSSLStreamCrypto),
+    "aes-192-ctr": (24, 16, OpenSSLStreamCrypto),
+    "aes-256-ctr": (32, 16, OpenSSLStreamCrypto),
+    "aes-128-cfb8": (16, 16, OpenSSLStreamCrypto),
+    "aes-192-cfb8": (24, 16, OpenSSLStreamCrypto),
+    "aes-256-cfb8": (32, 16, OpenSSLStreamCrypto),
+    "aes-128-cfb1": (16, 16, OpenSSLStreamCrypto),
+    "aes-192-cfb1": (24, 16, OpenSSLStreamCrypto),
+    "aes-256-cfb1": (32, 16, OpenSSLStreamCrypto),
+    "bf-cfb": (16, 8, OpenSSLStreamCrypto),
+    "camellia-128-cfb": (16, 16, OpenSSLStreamCrypto),
+    "camellia-192-cfb": (24, 16, OpenSSLStreamCrypto),
+    "camellia-256-cfb": (32, 16, OpenSSLStreamCrypto),
+    "cast5-cfb": (16, 8, OpenSSLStreamCrypto),
+    "des-cfb": (8, 8, OpenSSLStreamCrypto),
+    "idea-cfb": (16, 8, OpenSSLStreamCrypto),
+    "rc2-cfb": (16, 8, OpenSSLStreamCrypto),
+    "rc4": (16, 0, OpenSSLStreamCrypto),
+    "seed-cfb": (16, 16, OpenSSLStreamCrypto),
     # AEAD: iv_len = salt_len = key_len
-    'aes-128-gcm': (16, 16, OpenSSLAeadCrypto),
-    'aes-192-gcm': (24, 24, OpenSSLAeadCrypto),
-    'aes-256-gcm': (32, 32, OpenSSLAeadCrypto),
-    'aes-128-ocb': (16, 16, OpenSSLAeadCrypto),
-    'aes-192-ocb': (24, 24, OpenSSLAeadCrypto),
-    'aes-256-ocb': (32, 32, OpenSSLAeadCrypto),
+    "aes-128-gcm": (16, 16, OpenSSLAeadCrypto),
+    "aes-192-gcm": (24, 24, OpenSSLAeadCrypto),
+    "aes-256-gcm": (32, 32, OpenSSLAeadCrypto),
+    "aes-128-ocb": (16, 16, OpenSSLAeadCrypto),
+    "aes-192-ocb": (24, 24, OpenSSLAeadCrypto),
+    "aes-256-ocb": (32, 32, OpenSSLAeadCrypto),
+    "chacha20-ietf-poly1305": (32, 32, OpenSSLAeadCrypto),
 }
 
 
 def run_method(method):
 
-    print(method, ': [stream]', 32)
-    cipher = OpenSSLStreamCrypto(method, b'k' * 32, b'i' * 16, 1)
-    decipher = OpenSSLStreamCrypto(method, b'k' * 32, b'i' * 16, 0)
+    print(method, ": [stream]", 32)
+    cipher = OpenSSLStreamCrypto(method, b"k" * 32, b"i" * 16, 1)
+    decipher = OpenSSLStreamCrypto(method, b"k" * 32, b"i" * 16, 0)
 
     util.run_cipher(cipher, decipher)
 
@@ -348,16 +662,14 @@ def run_aead_method(method, key_len=16):
 
     if not loaded:
         load_openssl(None)
-    print(method, ': [payload][tag]', key_len)
-    cipher = libcrypto.EVP_get_cipherbyname(common.to_bytes(method))
-    if not cipher:
-        cipher = load_cipher(common.to_bytes(method))
-    if not cipher:
-        print('cipher not avaiable, please upgrade openssl')
+    print(method, ": [payload][tag]", key_len)
+    name = util.to_bytes(OPENSSL_CIPHER_NAMES.get(method, method))
+    if not get_cipher(name):
+        print("cipher not avaiable, please upgrade openssl")
         return
     key_len = int(key_len)
-    cipher = OpenSSLAeadCrypto(method, b'k' * key_len, b'i' * key_len, 1)
-    decipher = OpenSSLAeadCrypto(method, b'k' * key_len, b'i' * key_len, 0)
+    cipher = OpenSSLAeadCrypto(method, b"k" * key_len, b"i" * key_len, 1)
+    decipher = OpenSSLAeadCrypto(method, b"k" * key_len, b"i" * key_len, 0)
 
     util.run_cipher(cipher, decipher)
 
@@ -366,22 +678,80 @@ def run_aead_method_chunk(method, key_len=16):
 
     if not loaded:
         load_openssl(None)
-    print(method, ': chunk([size][tag][payload][tag]', key_len)
-    cipher = libcrypto.EVP_get_cipherbyname(common.to_bytes(method))
-    if not cipher:
-        cipher = load_cipher(common.to_bytes(method))
-    if not cipher:
-        print('cipher not avaiable, please upgrade openssl')
+    print(method, ": chunk([size][tag][payload][tag]", key_len)
+    name = util.to_bytes(OPENSSL_CIPHER_NAMES.get(method, method))
+    if not get_cipher(name):
+        print("cipher not avaiable, please upgrade openssl")
         return
     key_len = int(key_len)
-    cipher = OpenSSLAeadCrypto(method, b'k' * key_len, b'i' * key_len, 1)
-    decipher = OpenSSLAeadCrypto(method, b'k' * key_len, b'i' * key_len, 0)
+    cipher = OpenSSLAeadCrypto(method, b"k" * key_len, b"i" * key_len, 1)
+    decipher = OpenSSLAeadCrypto(method, b"k" * key_len, b"i" * key_len, 0)
 
     cipher.encrypt_once = cipher.encrypt
     decipher.decrypt_once = decipher.decrypt
     util.run_cipher(cipher, decipher)
 
 
+def bench_setup(method="aes-256-gcm", rounds=20000):
+    """
+    Stream setup cost, pooled contexts against a new one per stream
+    """
+    import time
+
+    key_len = 32
+    pool_size = ctx_pool.size
+    try:
+        for size in (0, pool_size):
+            ctx_pool.size = size
+            start = time.time()
+            for _ in range(rounds):
+                c = OpenSSLAeadCrypto(
+                    method, b"k" * key_len, b"i" * key_len, 1
+                )
+                c.clean()
+            print(
+                "%s setup, pool of %d: %.2f us"
+                % (method, size, (time.time() - start) * 1e6 / rounds)
+            )
+    finally:
+        ctx_pool.size = pool_size
+    print("ctx pool:", ctx_pool.stats())
+
+
+def test_ctx_pool():
+    cipher = OpenSSLAeadCrypto("aes-128-gcm", b"k" * 16, b"i" * 16, 1)
+    ctx = cipher._ctx
+    sealed = cipher.aead_encrypt(b"hello")
+    cipher.clean()
+    hits = ctx_pool.hits
+    # the reset context comes back, with nothing of the last key in it
+    decipher = OpenSSLAeadCrypto("aes-128-gcm", b"k" * 16, b"i" * 16, 0)
+    assert decipher._ctx == ctx and ctx_pool.hits == hits + 1
+    assert decipher.aead_decrypt(sealed) == b"hello"
+    assert get_cipher(b"aes-128-gcm") is get_cipher(b"aes-128-gcm")
+
+
+def test_hkdf_sha1():
+    import os
+
+    key = b"k" * 32
+    for _ in range(3):
+        salt = os.urandom(32)
+        assert hkdf_sha1(key, salt, SUBKEY_INFO, 32) == hkdf(
+            key, salt, SUBKEY_INFO, 32
+        )
+    # RFC 5869 test case 4
+    assert hkdf_sha1(
+        bytes.fromhex("0b0b0b0b0b0b0b0b0b0b0b"),
+        bytes.fromhex("000102030405060708090a0b0c"),
+        bytes.fromhex("f0f1f2f3f4f5f6f7f8f9"),
+        42,
+    ) == bytes.fromhex(
+        "085a01ea1b10f36933068b56efa5ad81a4f14b822f5b091568a9"
+        "cdd4f155fda2c22e422478d305f3f896"
+    )
+
+
 def test_aes_gcm(bits=128):
     method = "aes-{0}-gcm".format(bits)
     run_aead_method(method, bits / 8)
@@ -402,35 +772,45 @@ def test_aes_ocb_chunk(bits=128):
     run_aead_method_chunk(method, bits / 8)
 
 
+def test_chacha20_poly1305():
+    run_aead_method("chacha20-ietf-poly1305", 32)
+
+
+def test_chacha20_poly1305_chunk():
+    run_aead_method_chunk("chacha20-ietf-poly1305", 32)
+
+
 def test_aes_128_cfb():
-    run_method('aes-128-cfb')
+    run_method("aes-128-cfb")
 
 
 def test_aes_256_cfb():
-    run_method('aes-256-cfb')
+    run_method("aes-256-cfb")
 
 
 def test_aes_128_cfb8():
-    run_method('aes-128-cfb8')
+    run_method("aes-128-cfb8")
 
 
 def test_aes_256_ofb():
-    run_method('aes-256-ofb')
+    run_method("aes-256-ofb")
 
 
 def test_aes_256_ctr():
-    run_method('aes-256-ctr')
+    run_method("aes-256-ctr")
 
 
 def test_bf_cfb():
-    run_method('bf-cfb')
+    run_method("bf-cfb")
 
 
 def test_rc4():
-    run_method('rc4')
+    run_method("rc4")
 
 
-if __name__ == '__main__':
+if __name__ == "__main__":
+    test_ctx_pool()
+    test_hkdf_sha1()
     test_aes_128_cfb()
     test_aes_256_cfb()
     test_aes_256_ofb()
@@ -446,3 +826,6 @@ if __name__ == '__main__':
     test_aes_ocb_chunk(128)
     test_aes_ocb_chunk(192)
     test_aes_ocb_chunk(256)
+    test_chacha20_poly1305()
+    test_chacha20_poly1305_chunk()
+    bench_setup()
@@ -14,38 +14,57 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from __future__ import absolute_import, division, print_function, \
-    with_statement
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    with_statement,
+)
 
 import hashlib
 from crypto import openssl
 
-__all__ = ['ciphers']
+__all__ = ["ciphers"]
 
 
-def create_cipher(alg, key, iv, op, crypto_path=None,
-                  key_as_bytes=0, d=None, salt=None,
-                  i=1, padding=1):
-    md5 = hashlib.md5()
-    md5.update(key)
+# master key -> md5 that has hashed it, copied for every IV
+seeded_md5 = {}
+
+
+def create_cipher(
+    alg,
+    key,
+    iv,
+    op,
+    crypto_path=None,
+    key_as_bytes=0,
+    d=None,
+    salt=None,
+    i=1,
+    padding=1,
+):
+    seed = seeded_md5.get(key)
+    if seed is None:
+        seed = seeded_md5[key] = hashlib.md5(key)
+    md5 = seed.copy()
     md5.update(iv)
     rc4_key = md5.digest()
-    return openssl.OpenSSLStreamCrypto(b'rc4', rc4_key, b'', op, crypto_path)
+    return openssl.OpenSSLStreamCrypto(b"rc4", rc4_key, b"", op, crypto_path)
 
 
 ciphers = {
-    'rc4-md5': (16, 16, create_cipher),
+    "rc4-md5": (16, 16, create_cipher),
 }
 
 
 def test():
     from crypto import util
 
-    cipher = create_cipher('rc4-md5', b'k' * 32, b'i' * 16, 1)
-    decipher = create_cipher('rc4-md5', b'k' * 32, b'i' * 16, 0)
+    cipher = create_cipher("rc4-md5", b"k" * 32, b"i" * 16, 1)
+    decipher = create_cipher("rc4-md5", b"k" * 32, b"i" * 16, 0)
 
     util.run_cipher(cipher, decipher)
 
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     test()
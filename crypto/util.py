@@ -18,14 +18,31 @@ import os
 import logging
 
 
+def to_bytes(s):
+    if isinstance(s, str):
+        return s.encode("utf-8")
+    return s
+
+
+def to_str(s):
+    if isinstance(s, bytes):
+        return s.decode("utf-8")
+    return s
+
+
+# (names, symbol, library name, custom path) -> loaded library
+found_libraries = {}
+
+
 def find_library_nt(name):
     # modified from ctypes.util
     # ctypes.util.find_library just returns first result he found
     # but we want to try them all
     # because on Windows, users may have both 32bit and 64bit version installed
     import glob
+
     results = []
-    for directory in os.environ['PATH'].split(os.pathsep):
+    for directory in os.environ["PATH"].split(os.pathsep):
         fname = os.path.join(directory, name)
         if os.path.isfile(fname):
             results.append(fname)
@@ -40,21 +57,43 @@ def find_library_nt(name):
 
 def load_library(path, search_symbol, library_name):
     from ctypes import CDLL
+
     try:
         lib = CDLL(path)
         if hasattr(lib, search_symbol):
-            logging.info('loading %s from %s', library_name, path)
+            logging.info("loading %s from %s", library_name, path)
             return lib
         else:
-            logging.warn('can\'t find symbol %s in %s', search_symbol,
-                         path)
+            logging.warn("can't find symbol %s in %s", search_symbol, path)
     except Exception:
         pass
     return None
 
 
-def find_library(possible_lib_names, search_symbol, library_name,
-                 custom_path=None):
+def find_library(
+    possible_lib_names, search_symbol, library_name, custom_path=None
+):
+    """
+    Search and load a library once per process: ctypes.util.find_library
+    forks ldconfig/gcc and the fallback globs directories, later calls
+    with the same arguments get the loaded library back
+    """
+    if type(possible_lib_names) not in (list, tuple):
+        possible_lib_names = [possible_lib_names]
+    key = (tuple(possible_lib_names), search_symbol, library_name, custom_path)
+    lib = found_libraries.get(key)
+    if lib is None:
+        lib = _find_library(
+            possible_lib_names, search_symbol, library_name, custom_path
+        )
+        if lib is not None:
+            found_libraries[key] = lib
+    return lib
+
+
+def _find_library(
+    possible_lib_names, search_symbol, library_name, custom_path=None
+):
     import ctypes.util
 
     if custom_path:
@@ -68,13 +107,17 @@ def find_library(possible_lib_names, search_symbol, library_name,
     lib_names = []
     for lib_name in possible_lib_names:
         lib_names.append(lib_name)
-        lib_names.append('lib' + lib_name)
+        lib_names.append("lib" + lib_name)
 
     for name in lib_names:
         if os.name == "nt":
             paths.extend(find_library_nt(name))
         else:
-            path = ctypes.util.find_library(name)
+            try:
+                path = ctypes.util.find_library(name)
+            except OSError:
+                # gcc may name files that do not exist for 'libfoo'
+                path = None
             if path:
                 paths.append(path)
 
@@ -86,10 +129,11 @@ def find_library(possible_lib_names, search_symbol, library_name,
 
         for name in lib_names:
             patterns = [
-                '/usr/local/lib*/lib%s.*' % name,
-                '/usr/lib*/lib%s.*' % name,
-                'lib%s.*' % name,
-                '%s.dll' % name]
+                "/usr/local/lib*/lib%s.*" % name,
+                "/usr/lib*/lib%s.*" % name,
+                "lib%s.*" % name,
+                "%s.dll" % name,
+            ]
 
             for pat in patterns:
                 files = glob.glob(pat)
@@ -109,7 +153,7 @@ def parse_mode(cipher_nme):
     :param cipher_nme: str cipher name, aes-128-cfb, aes-128-gcm ...
     :return: str/None The mode, cfb, gcm ...
     """
-    hyphen = cipher_nme.rfind('-')
+    hyphen = cipher_nme.rfind("-")
     if hyphen > 0:
         return cipher_nme[hyphen:]
     return None
@@ -126,38 +170,48 @@ def run_cipher(cipher, decipher):
 
     cipher_results = []
     pos = 0
-    print('test start')
+    print("test start")
     start = time.time()
     while pos < len(plain):
-        l = random.randint(100, 32768)
-        # print(pos, l)
-        c = cipher.encrypt_once(plain[pos:pos + l])
+        size = random.randint(100, 32768)
+        # print(pos, size)
+        c = cipher.encrypt_once(plain[pos : pos + size])
         cipher_results.append(c)
-        pos += l
+        pos += size
     pos = 0
     # c = b''.join(cipher_results)
     plain_results = []
     for c in cipher_results:
-        # l = random.randint(100, 32768)
-        l = len(c)
+        # size = random.randint(100, 32768)
+        size = len(c)
         plain_results.append(decipher.decrypt_once(c))
-        pos += l
+        pos += size
     end = time.time()
-    print('speed: %d bytes/s' % (block_size * rounds / (end - start)))
-    assert b''.join(plain_results) == plain
+    print("speed: %d bytes/s" % (block_size * rounds / (end - start)))
+    assert b"".join(plain_results) == plain
 
 
 def test_find_library():
-    assert find_library('c', 'strcpy', 'libc') is not None
-    assert find_library(['c'], 'strcpy', 'libc') is not None
-    assert find_library(('c',), 'strcpy', 'libc') is not None
-    assert find_library(('crypto', 'eay32'), 'EVP_CipherUpdate',
-                        'libcrypto') is not None
-    assert find_library('notexist', 'strcpy', 'libnotexist') is None
-    assert find_library('c', 'symbol_not_exist', 'c') is None
-    assert find_library(('notexist', 'c', 'crypto', 'eay32'),
-                        'EVP_CipherUpdate', 'libc') is not None
-
-
-if __name__ == '__main__':
+    assert find_library("c", "strcpy", "libc") is not None
+    assert find_library(["c"], "strcpy", "libc") is not None
+    assert find_library(("c",), "strcpy", "libc") is not None
+    assert (
+        find_library(("crypto", "eay32"), "EVP_CipherUpdate", "libcrypto")
+        is not None
+    )
+    assert find_library("notexist", "strcpy", "libnotexist") is None
+    assert find_library("c", "symbol_not_exist", "c") is None
+    assert (
+        find_library(
+            ("notexist", "c", "crypto", "eay32"), "EVP_CipherUpdate", "libc"
+        )
+        is not None
+    )
+    # loaded once, whatever the spelling of the names
+    assert find_library("c", "strcpy", "libc") is find_library(
+        ["c"], "strcpy", "libc"
+    )
+
+
+if __name__ == "__main__":
     test_find_library()
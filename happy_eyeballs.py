@@ -0,0 +1,149 @@
+import asyncio
+import socket
+from asyncio.staggered import staggered_race
+
+from asyncdns.enums import QType
+from utils import tfo
+from utils.loggers import get_logger
+
+log = get_logger("happy-eyeballs")
+
+# RFC 8305: wait this long for AAAA once A is in, and between attempts
+RESOLUTION_DELAY = 0.05
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+
+def literal_address(host):
+    """
+    (family, ip) for a host that is already an IPv4 or IPv6 literal, None
+    for a name that needs resolving.
+    """
+    if isinstance(host, bytes):
+        host = host.decode("utf8", "replace")
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, host)
+        except OSError:
+            continue
+        return family, socket.inet_ntop(family, packed)
+    return None
+
+
+def answer_address(answer):
+    if answer.type == QType.QTYPE_AAAA.value:
+        return socket.AF_INET6, socket.inet_ntop(
+            socket.AF_INET6, bytes(answer.rdata)
+        )
+    return socket.AF_INET, ".".join("%u" % label for label in answer.rdata)
+
+
+def interleave(addresses):
+    """
+    Alternate address families, starting with the family of the first
+    address (RFC 8305 section 4).
+    """
+    by_family = {}
+    for address in addresses:
+        by_family.setdefault(address[0], []).append(address)
+    queues = list(by_family.values())
+    result = []
+    while queues:
+        for queue in list(queues):
+            result.append(queue.pop(0))
+            if not queue:
+                queues.remove(queue)
+    return result
+
+
+async def resolve_addresses(resolver, host, delay=RESOLUTION_DELAY):
+    """
+    Look up AAAA and A for ``host`` at once. IPv6 goes first when both
+    come back within ``delay`` of each other; a family whose lookup is
+    slower than that is left out unless the other one found nothing.
+    """
+    literal = literal_address(host)
+    if literal:
+        return [literal]
+    aaaa = asyncio.ensure_future(resolver.resolve_all(host, QType.QTYPE_AAAA))
+    a = asyncio.ensure_future(resolver.resolve_all(host, QType.QTYPE_A))
+    lookups = (aaaa, a)
+    try:
+        done, pending = await asyncio.wait(
+            lookups, return_when=asyncio.FIRST_COMPLETED
+        )
+        if pending:
+            await asyncio.wait(pending, timeout=delay)
+        answers = [
+            answer
+            for lookup in lookups
+            if lookup.done() and not lookup.exception()
+            for answer in lookup.result()
+        ]
+        if not answers and not all(lookup.done() for lookup in lookups):
+            await asyncio.wait(lookups)
+            answers = [
+                answer
+                for lookup in lookups
+                if not lookup.exception()
+                for answer in lookup.result()
+            ]
+    finally:
+        # the lookups themselves are shared and keep filling the cache
+        for lookup in lookups:
+            lookup.cancel()
+    return interleave([answer_address(answer) for answer in answers])
+
+
+async def _connect(loop, family, ip, port, fast_open):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        if fast_open:
+            tfo.enable_connect(sock)
+        await loop.sock_connect(sock, (ip, port))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def open_connection(
+    loop,
+    addresses,
+    port,
+    delay=CONNECTION_ATTEMPT_DELAY,
+    fast_open=False,
+):
+    """
+    Connect to the first of ``addresses`` ((family, ip) pairs) that
+    answers, starting the next attempt every ``delay`` seconds or as soon
+    as the previous one fails; the losers are cancelled and closed.
+
+    A TCP_FASTOPEN_CONNECT socket reports itself connected before the
+    handshake, so it would win every race: Fast Open is only used when
+    there is a single address to try.
+    """
+    if not addresses:
+        raise OSError("no address to connect to")
+    if len(addresses) == 1:
+        family, ip = addresses[0]
+        return await _connect(loop, family, ip, port, fast_open)
+    sock, index, errors = await staggered_race(
+        [
+            lambda family=family, ip=ip: _connect(
+                loop, family, ip, port, False
+            )
+            for family, ip in addresses
+        ],
+        delay,
+        loop=loop,
+    )
+    if sock is None:
+        log.info("connect %r port %u failed: %r" % (addresses, port, errors))
+        raise errors[-1] or OSError("connect failed")
+    if index:
+        log.info(
+            "connected to %s after %u failed or slow"
+            % (addresses[index][1], index)
+        )
+    return sock
@@ -2,82 +2,178 @@ import collections
 import time
 from collections.abc import MutableMapping
 
+_MISSING = object()
+
 
 class LRUCache(MutableMapping):
-    
-    def __init__(self, timeout=60.0, close_cb=None, *args, **kwargs):
+    """
+    Mapping with a least recently used order, an optional bound on its
+    size and per key expiry.
+
+    A key set with ``cache[key] = value`` expires ``timeout`` seconds
+    after it was last read or written; ``set(key, value, ttl)`` gives it
+    a fixed lifetime instead. Expiry is lazy: reading an expired key drops
+    it, and sweep() walks the keys to drop the ones nobody reads any
+    more. Past ``max_entries`` the least recently used key is evicted.
+    ``close_cb(value)`` is called for every key that expires or is
+    evicted, not for the ones deleted explicitly.
+    """
+
+    def __init__(
+        self,
+        timeout=60.0,
+        close_cb=None,
+        max_entries=None,
+        clock=None,
+    ):
+        if close_cb is not None and not callable(close_cb):
+            raise RuntimeError("close call back must be callable")
         self._timeout = timeout
-        if not callable(close_cb):
-            assert RuntimeError("close call back must be callable")
         self._close_cb = close_cb
-        self._last_accesses = collections.deque()
-        self._access_keys_by_time = collections.defaultdict(lambda: [])
-        self._keys_last_access = {}
-        self._lru = {}#.update(*args, **kwargs)
-        
-    def __getitem__(self, item):
-        now_ = time.time()
-        self._last_accesses.append(now_)
-        self._access_keys_by_time[now_].append(item)
-        self._keys_last_access[item] = now_
-        return self._lru[item]
-    
+        self._max_entries = max_entries
+        self._clock = clock or time.monotonic
+        # key -> (value, deadline, sliding), deadline None for a key that
+        # never expires
+        self._data = collections.OrderedDict()
+        self.expirations = 0
+        self.evictions = 0
+
+    def _expire(self, key, value):
+        del self._data[key]
+        self.expirations += 1
+        if self._close_cb:
+            self._close_cb(value)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, deadline, sliding = entry
+        if deadline is not None:
+            now = self._clock()
+            if deadline <= now:
+                self._expire(key, value)
+                return default
+            if sliding:
+                self._data[key] = (value, now + self._timeout, True)
+        self._data.move_to_end(key)
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return False
+        return entry[1] is None or entry[1] > self._clock()
+
+    def set(self, key, value, ttl=None):
+        if ttl is not None:
+            entry = (value, self._clock() + ttl, False)
+        elif self._timeout:
+            entry = (value, self._clock() + self._timeout, True)
+        else:
+            entry = (value, None, False)
+        data = self._data
+        data[key] = entry
+        data.move_to_end(key)
+        if self._max_entries is not None:
+            while len(data) > self._max_entries:
+                _, old = data.popitem(last=False)
+                self.evictions += 1
+                if self._close_cb:
+                    self._close_cb(old[0])
+
     def __setitem__(self, key, value):
-        now_ = time.time()
-        self._last_accesses.append(now_)
-        self._access_keys_by_time[now_].append(key)
-        self._keys_last_access[key] = now_
-        self._lru[key] = value
-        
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
     def __iter__(self):
-        return iter(self._lru)
-    
+        return iter(self._data)
+
     def __len__(self):
-        return len(self._lru)
-    
-    def __delitem__(self, key):
-        del self._lru[key]
-        del self._keys_last_access[key]
-    
+        return len(self._data)
+
+    def peek(self, key, default=None):
+        """
+        The value without counting as a use, None once expired.
+        """
+        entry = self._data.get(key)
+        if entry is None or (
+            entry[1] is not None and entry[1] <= self._clock()
+        ):
+            return default
+        return entry[0]
+
+    def items(self):
+        # snapshot, reading every key must not reorder them under us
+        return [(key, entry[0]) for key, entry in self._data.items()]
+
+    def values(self):
+        return [entry[0] for entry in self._data.values()]
+
+    def clear(self):
+        self._data.clear()
+
     def sweep(self):
-        now_ = time.time()
-        
-        if len(self._last_accesses) == 0:
-            return 0
-        
-        last_access = self._last_accesses[0]
-        while self._overdue(last_access, now_):
-            self._last_accesses.popleft()
-            for k in self._access_keys_by_time[last_access]:
-                
-                if k in self._lru and self._overdue(self._keys_last_access[k], now_):
-                    print(
-                        "%s ==> in :%r, overdue:%r" % (
-                        k, (k in self._lru), self._overdue(self._keys_last_access[k], now_)))
-                    print("del %s" % k)
-                    del self._lru[k]
-                    del self._keys_last_access[k]
-            del self._access_keys_by_time[last_access]
-            
-            if self._last_accesses:
-                last_access = self._last_accesses[0]
-            else:
-                break
-            
-    def _overdue(self, access_time, now):
-        print("%r vs %r" %(now - access_time, self._timeout))
-        return bool(now - access_time > self._timeout)
-
-
-if __name__ == '__main__':
-    c = LRUCache(timeout=0.5)
-    c['a'] = 1
-    c['b'] = 2
-    time.sleep(0.4)
-    c.sweep()
-    assert c['a'] == 1
-    assert c['b'] == 2
-    time.sleep(0.5)
-    c.sweep()
-    assert 'a' not in c
-    assert 'b' not in c
+        """
+        Expire every key that is due. Returns how many were.
+        """
+        now = self._clock()
+        expired = [
+            (key, entry[0])
+            for key, entry in self._data.items()
+            if entry[1] is not None and entry[1] <= now
+        ]
+        for key, value in expired:
+            self._expire(key, value)
+        return len(expired)
+
+
+def _bench(keys=100000, rounds=3):
+    import random
+
+    names = ["host%u.example" % i for i in range(keys)]
+    picks = [random.choice(names) for _ in range(keys)]
+
+    def run(cache, bounded):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for name, pick in zip(names, picks):
+                cache[name] = name
+                cache.get(pick)
+                if bounded and len(cache) > keys // 2:
+                    cache.popitem(last=False)
+        return time.perf_counter() - started
+
+    plain = run(collections.OrderedDict(), True)
+    cache = LRUCache(timeout=0.05, max_entries=keys // 2)
+    elapsed = run(cache, False)
+    print(
+        "%u set+get in %.2fs, %.2f us per pair (OrderedDict %.2f us), "
+        "%u keys held"
+        % (
+            keys * rounds,
+            elapsed,
+            elapsed / keys / rounds * 1e6,
+            plain / keys / rounds * 1e6,
+            len(cache),
+        )
+    )
+    time.sleep(0.1)
+    started = time.perf_counter()
+    expired = cache.sweep()
+    print(
+        "swept %u expired keys in %.3fs"
+        % (expired, time.perf_counter() - started)
+    )
+
+
+if __name__ == "__main__":
+    _bench()
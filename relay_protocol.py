@@ -0,0 +1,177 @@
+import asyncio
+
+from relay_stats import ChunkSizer, DirectionStats
+from utils.loggers import get_logger
+
+log = get_logger("relay_protocol")
+
+COALESCE_THRESHOLD = 1024
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """
+    One side of a relayed connection. Bytes read by this side's transport
+    are written straight to the peer's transport, and write backpressure on
+    either side pauses reading on the other, so the steady state is one
+    callback per read with no coroutine or future in between.
+
+    With ``coalesce`` set, reads smaller than COALESCE_THRESHOLD are
+    queued and handed to the peer with a single writelines() at the end
+    of the loop tick.
+    """
+
+    def __init__(
+        self, loop, stats=None, sizer=None, coalesce=False, on_lost=None
+    ):
+        self._loop = loop
+        self._on_lost = on_lost
+        self._stats = stats or DirectionStats()
+        self._sizer = sizer or ChunkSizer()
+        self._coalesce = coalesce
+        self._pending = []
+        self._early = []
+        self._view = memoryview(bytearray(self._sizer.size))
+        self._transport = None
+        self._peer = None
+        self._eof = False
+        self._closed = loop.create_future()
+
+    @staticmethod
+    def pair(local, remote):
+        local._peer = remote
+        remote._peer = local
+        local._drain_early()
+        remote._drain_early()
+
+    def _drain_early(self):
+        # hand over what arrived before the peer was wired up
+        peer_transport = self._peer.transport
+        if self._early:
+            early, self._early = self._early, []
+            peer_transport.writelines(early)
+            self._stats.on_write()
+        if self._closed.done():
+            if not peer_transport.is_closing():
+                peer_transport.close()
+        elif self._eof:
+            if not self._forward_eof():
+                self._transport.close()
+        else:
+            self._transport.resume_reading()
+
+    @property
+    def transport(self):
+        return self._transport
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def connection_made(self, transport):
+        self._transport = transport
+        # nothing should be read before the peer is wired up; some loops
+        # re-add the reader after this returns, so buffer_updated copes
+        # with early reads as well
+        transport.pause_reading()
+
+    @property
+    def stats(self):
+        return self._stats
+
+    def get_buffer(self, sizehint):
+        size = self._sizer.size
+        if len(self._view) < size:
+            self._view = memoryview(bytearray(size))
+        return self._view[:size]
+
+    def buffer_updated(self, nbytes):
+        self._stats.on_read(nbytes, self._sizer.size)
+        self._sizer.update(nbytes)
+        if self._peer is None:
+            self._early.append(bytes(self._view[:nbytes]))
+            self._transport.pause_reading()
+            return
+        if self._coalesce and nbytes < COALESCE_THRESHOLD:
+            if not self._pending:
+                self._loop.call_soon(self._flush)
+            self._pending.append(bytes(self._view[:nbytes]))
+            return
+        self._flush()
+        peer_transport = self._peer.transport
+        peer_transport.write(self._view[:nbytes])
+        self._stats.on_write()
+        if peer_transport.get_write_buffer_size():
+            # the transport may still hold a reference to our buffer
+            self._view = memoryview(bytearray(len(self._view)))
+
+    def _flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        peer_transport = self._peer.transport
+        if not peer_transport.is_closing():
+            peer_transport.writelines(pending)
+            self._stats.on_write()
+
+    def eof_received(self):
+        self._eof = True
+        if self._peer is None:
+            # forwarded by pair()
+            return True
+        self._flush()
+        return self._forward_eof()
+
+    def _forward_eof(self):
+        peer_transport = self._peer.transport
+        if self._peer._eof or not peer_transport.can_write_eof():
+            peer_transport.close()
+            return False
+        peer_transport.write_eof()
+        return True
+
+    def pause_writing(self):
+        if self._peer:
+            self._peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self._peer:
+            self._peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self._on_lost:
+            # the transport closes the socket only after this returns
+            self._on_lost(self._transport.get_extra_info("socket"))
+        if self._peer:
+            self._flush()
+        if exc:
+            log.info("relay connection lost: %r" % exc)
+        if self._peer and not self._peer.transport.is_closing():
+            if exc:
+                self._peer.transport.abort()
+            else:
+                self._peer.transport.close()
+        if not self._closed.done():
+            self._closed.set_result(exc)
+
+
+async def relay_sockets(
+    loop, local_sock, remote_sock, stats, coalesce=False, on_remote_lost=None
+):
+    """
+    Hand two connected sockets over to selector transports and relay
+    between them until both sides are closed. ``on_remote_lost`` gets the
+    remote socket while it is still open.
+    """
+    local = RelayProtocol(loop, stats.up, coalesce=coalesce)
+    remote = RelayProtocol(
+        loop, stats.down, coalesce=coalesce, on_lost=on_remote_lost
+    )
+    await loop.connect_accepted_socket(lambda: local, local_sock)
+    try:
+        await loop.create_connection(lambda: remote, sock=remote_sock)
+    except Exception:
+        local.transport.close()
+        raise
+    RelayProtocol.pair(local, remote)
+    await asyncio.wait([local.closed, remote.closed])
+    return local, remote
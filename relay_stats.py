@@ -0,0 +1,116 @@
+import time
+
+MIN_CHUNK_SIZE = 4096
+MAX_CHUNK_SIZE = 256 * 1024
+
+
+class ChunkSizer:
+    """
+    Read size for one relay direction. A read that fills the whole chunk
+    means the link has more to give, so the chunk doubles; a read that
+    uses less than a quarter of it looks like interactive traffic, so the
+    chunk halves again.
+    """
+
+    def __init__(self, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+        self._min_size = min_size
+        self._max_size = max_size
+        self._size = min_size
+
+    @property
+    def size(self):
+        return self._size
+
+    def update(self, nbytes):
+        if nbytes >= self._size:
+            self._size = min(self._size * 2, self._max_size)
+        elif nbytes <= self._size // 4:
+            self._size = max(self._size // 2, self._min_size)
+        return self._size
+
+
+class DirectionStats:
+    __slots__ = ("bytes", "reads", "writes", "chunk_size", "max_chunk_size")
+
+    def __init__(self):
+        self.bytes = 0
+        self.reads = 0
+        self.writes = 0
+        self.chunk_size = 0
+        self.max_chunk_size = 0
+
+    def on_read(self, nbytes, chunk_size):
+        self.bytes += nbytes
+        self.reads += 1
+        self.chunk_size = chunk_size
+        if chunk_size > self.max_chunk_size:
+            self.max_chunk_size = chunk_size
+
+    def on_write(self, count=1):
+        self.writes += count
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class RelayStats:
+    """
+    Per-connection counters, one DirectionStats for each flow: ``up`` is
+    client to remote, ``down`` is remote to client.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.up = DirectionStats()
+        self.down = DirectionStats()
+        self.tfo_in = False
+        self.tfo_out = False
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def as_dict(self):
+        return {
+            "duration": self.duration,
+            "tfo_in": self.tfo_in,
+            "tfo_out": self.tfo_out,
+            "up": self.up.as_dict(),
+            "down": self.down.as_dict(),
+        }
+
+
+class RelayTotals:
+    """
+    Aggregated counters over every connection a TCPRelay has handled.
+    """
+
+    def __init__(self):
+        self.connections_total = 0
+        self.connections_active = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.reads = 0
+        self.writes = 0
+        self.tfo_in = 0
+        self.tfo_out = 0
+
+    def open(self):
+        self.connections_total += 1
+        self.connections_active += 1
+
+    def close(self, stats):
+        self.connections_active -= 1
+        self.bytes_up += stats.up.bytes
+        self.bytes_down += stats.down.bytes
+        self.reads += stats.up.reads + stats.down.reads
+        self.writes += stats.up.writes + stats.down.writes
+        self.tfo_in += stats.tfo_in
+        self.tfo_out += stats.tfo_out
+
+    def as_dict(self):
+        return dict(vars(self))
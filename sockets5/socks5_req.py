@@ -32,6 +32,10 @@ class AddrReq:
     def rsv(self):
         return self._rsv
 
+    @property
+    def atyp(self):
+        return self._atyp
+
     @property
     def addr(self):
         return self._addr
@@ -42,8 +46,14 @@ class AddrReq:
 
     @property
     def bypass(self):
-        fmt_ = "!BB" + "%us" % len(self._addr) + "H"
-        return pack(fmt_, self._atyp, len(self._addr), self._addr, self._port)
+        if self._atyp == Socks5AddressAddrType.DOMAINNAME.value:
+            fmt_ = "!BB" + "%us" % len(self._addr) + "H"
+            return pack(
+                fmt_, self._atyp, len(self._addr), self._addr, self._port
+            )
+        # IPv4 and IPv6 addresses have a fixed length and no length byte
+        fmt_ = "!B" + "%us" % len(self._addr) + "H"
+        return pack(fmt_, self._atyp, self._addr, self._port)
 
     def to_bytes(self):
         return pack("!BB", self._ver, self._cmd) + self._rsv + self.bypass
@@ -14,9 +14,9 @@ class Socks5AuthRsp:
 
 
 class Socks5AddrRsp:
-    def __new__(cls, atyp, addr, port):
+    def __new__(cls, atyp, addr, port, rep=Socks5RepType.SUCCEEDED):
         ver = 5
-        rep = Socks5RepType.SUCCEEDED.value
+        rep = rep.value
         rsv = 0
         if isinstance(atyp, Enum):
             atyp = atyp.value
@@ -1,6 +1,10 @@
-import asyncio
-from tcprelay import TCPRelay
+import argparse
+from functools import partial
+
+from crypto_executor import OFFLOAD_THRESHOLD
+from tcprelay import TCPRelay, RELAY_MODE_ZEROCOPY
 from utils.loggers import get_logger
+from workers import run
 
 log = get_logger("sslocal")
 
@@ -10,13 +14,80 @@ PORT = 1081
 REMOTE_HOST = "127.0.0.1"
 REMOTE_PORT = 8388
 
+RELAY_MODE = RELAY_MODE_ZEROCOPY
+
+FAST_OPEN = True
+
+# the thread hop costs bulk throughput unless spare cores take the work
+CRYPTO_OFFLOAD = 0
+
+POOL_MIN_IDLE = 4
+POOL_MAX_IDLE = 16
+
+OPTIMISTIC_CONNECT = True
+
+
+def make_relay(
+    loop,
+    reuse_port,
+    debug=False,
+    method=None,
+    password=None,
+    crypto_offload=CRYPTO_OFFLOAD,
+):
+    loop.set_debug(debug)
+    print("create tcprelay")
+    return TCPRelay(
+        loop,
+        True,
+        HOST,
+        PORT,
+        REMOTE_HOST,
+        REMOTE_PORT,
+        relay_mode=RELAY_MODE,
+        reuse_port=reuse_port,
+        pool_min_idle=POOL_MIN_IDLE,
+        pool_max_idle=POOL_MAX_IDLE,
+        optimistic_connect=OPTIMISTIC_CONNECT,
+        fast_open=FAST_OPEN,
+        method=method,
+        password=password,
+        crypto_offload=crypto_offload,
+    )
+
+
 if __name__ == "__main__":
-    loop_ = asyncio.get_event_loop()
-    loop_.set_debug(True)
+    parser = argparse.ArgumentParser(description="sslocal")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="fork N SO_REUSEPORT workers (0: run in this process)",
+    )
+    parser.add_argument(
+        "-m", "--method", help="cipher, e.g. aes-256-gcm (default: plain)"
+    )
+    parser.add_argument("-k", "--password", help="shared with the ssserver")
+    parser.add_argument(
+        "--crypto-offload",
+        type=int,
+        default=CRYPTO_OFFLOAD,
+        metavar="BYTES",
+        help="cipher reads of BYTES and more in worker threads, e.g. %u "
+        "on a multi-core host (default 0: never)" % OFFLOAD_THRESHOLD,
+    )
+    args = parser.parse_args()
     log.info(
         "sslocal listen on local(%s:%u) remote(%s:%u)"
         % (HOST, PORT, REMOTE_HOST, REMOTE_PORT)
     )
-    print("create tcprelay")
-    relay_server = TCPRelay(loop_, True, HOST, PORT, REMOTE_HOST, REMOTE_PORT)
-    loop_.run_until_complete(relay_server.accept())
+    run(
+        partial(
+            make_relay,
+            debug=not args.workers,
+            method=args.method,
+            password=args.password,
+            crypto_offload=args.crypto_offload,
+        ),
+        args.workers,
+    )
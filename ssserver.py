@@ -1,17 +1,107 @@
-import asyncio
-from tcprelay import TCPRelay
+import argparse
+from functools import partial
+
+from asyncdns.shared_cache import default_path
+from asyncdns.upstreams import DEFAULT_UPSTREAMS, parse_upstreams
+from crypto_executor import OFFLOAD_THRESHOLD
+from tcprelay import TCPRelay, RELAY_MODE_ZEROCOPY
 from utils.loggers import get_logger
+from workers import run
 
-log = get_logger("sslocal")
+log = get_logger("ssserver")
 
 HOST = "0.0.0.0"
 PORT = 8388
 
+RELAY_MODE = RELAY_MODE_ZEROCOPY
+
+FAST_OPEN = True
+
+# the thread hop costs bulk throughput unless spare cores take the work
+CRYPTO_OFFLOAD = 0
+
+
+def make_relay(
+    loop,
+    reuse_port,
+    debug=False,
+    dns_upstreams=None,
+    dns_cache_file=None,
+    dns_shared_cache=None,
+    method=None,
+    password=None,
+    crypto_offload=CRYPTO_OFFLOAD,
+):
+    loop.set_debug(debug)
+    print("create tcprelay")
+    return TCPRelay(
+        loop,
+        False,
+        HOST,
+        PORT,
+        relay_mode=RELAY_MODE,
+        reuse_port=reuse_port,
+        fast_open=FAST_OPEN,
+        dns_upstreams=dns_upstreams,
+        dns_cache_file=dns_cache_file,
+        dns_shared_cache=dns_shared_cache,
+        method=method,
+        password=password,
+        crypto_offload=crypto_offload,
+    )
+
 
 if __name__ == "__main__":
-    loop_ = asyncio.get_event_loop()
-    loop_.set_debug(True)
+    parser = argparse.ArgumentParser(description="ssserver")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="fork N SO_REUSEPORT workers (0: run in this process)",
+    )
+    parser.add_argument(
+        "--dns",
+        type=parse_upstreams,
+        default=list(DEFAULT_UPSTREAMS),
+        help="comma separated upstream resolvers, ip[:port] or [ipv6]:port",
+    )
+    parser.add_argument(
+        "--dns-cache",
+        metavar="PATH",
+        help="save the DNS cache here and warm up from it on start",
+    )
+    parser.add_argument(
+        "--shared-dns-cache",
+        action="store_true",
+        help="share DNS answers between workers through %s"
+        % default_path(PORT),
+    )
+    parser.add_argument(
+        "-m", "--method", help="cipher, e.g. aes-256-gcm (default: plain)"
+    )
+    parser.add_argument("-k", "--password", help="shared with the sslocal")
+    parser.add_argument(
+        "--crypto-offload",
+        type=int,
+        default=CRYPTO_OFFLOAD,
+        metavar="BYTES",
+        help="cipher reads of BYTES and more in worker threads, e.g. %u "
+        "on a multi-core host (default 0: never)" % OFFLOAD_THRESHOLD,
+    )
+    args = parser.parse_args()
     log.info("ssserver listen on local(%s:%u)" % (HOST, PORT))
-    print("create tcprelay")
-    relay_server = TCPRelay(loop_, False, HOST, PORT)
-    loop_.run_until_complete(relay_server.accept())
+    run(
+        partial(
+            make_relay,
+            debug=not args.workers,
+            dns_upstreams=args.dns,
+            dns_cache_file=args.dns_cache,
+            dns_shared_cache=(
+                default_path(PORT) if args.shared_dns_cache else None
+            ),
+            method=args.method,
+            password=args.password,
+            crypto_offload=args.crypto_offload,
+        ),
+        args.workers,
+    )
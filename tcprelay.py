@@ -1,15 +1,52 @@
 import asyncio
+import errno
+import fcntl
+import os
 import socket
+import sys
+from asyncio.base_events import _set_reuseport
+from functools import partial
 
-from async_dns.resolver import DnsResolver
-from sockets5.enums import Socks5AuthMethod, Socks5AddressAddrType
+from async_dns.async_resolver import AsyncDnsResolver
+from asyncdns.shared_cache import SharedDnsCache
+from crypto.cryptor import Cryptor, ctx_pool, try_cipher
+from crypto_executor import CryptoExecutor
+from happy_eyeballs import open_connection, resolve_addresses
+from relay_protocol import relay_sockets
+from relay_stats import ChunkSizer, RelayStats, RelayTotals
+from upstream_pool import UpstreamPool, open_upstream
+from sockets5.enums import (
+    Socks5AuthMethod,
+    Socks5AddressAddrType,
+    Socks5RepType,
+)
 from sockets5.socks5_req import Socks5AuthReqGen, Socks5AddrReqGen
 from sockets5.socks5_rsp import Socks5AuthRsp, Socks5AddrRsp, Socks5AddrRspGen
+from utils import tfo
 from utils.util import async_pull
 from utils.loggers import get_logger
 
 log = get_logger("tcprelay")
 
+RELAY_MODE_COPY = "copy"
+RELAY_MODE_ZEROCOPY = "zerocopy"
+RELAY_MODE_PROTOCOL = "protocol"
+RELAY_MODES = (RELAY_MODE_COPY, RELAY_MODE_ZEROCOPY, RELAY_MODE_PROTOCOL)
+
+PIPE_SIZE = 256 * 1024
+
+# how a pump sees the other end go away, not worth a log line
+PEER_CLOSED = (BrokenPipeError, ConnectionAbortedError, ConnectionResetError)
+
+FIRST_PAYLOAD_SIZE = 16 * 1024
+FIRST_PAYLOAD_WAIT = 0.05
+TUNNEL_RECV_SIZE = 16 * 1024
+
+
+def splice_supported():
+    # os.splice is there from python 3.10 on, Linux only
+    return sys.platform.startswith("linux") and hasattr(os, "splice")
+
 
 class TCPRelay:
     def __init__(
@@ -20,11 +57,37 @@ class TCPRelay:
         sslocal_port,
         ssserver_host=None,
         ssserver_port=None,
+        relay_mode=RELAY_MODE_COPY,
+        coalesce_writes=False,
+        reuse_port=False,
+        pool_min_idle=0,
+        pool_max_idle=8,
+        pool_idle_timeout=30.0,
+        optimistic_connect=False,
+        fast_open=False,
+        dns_upstreams=None,
+        dns_cache_file=None,
+        dns_shared_cache=None,
+        method=None,
+        password=None,
+        crypto_offload=0,
     ):
+        if relay_mode not in RELAY_MODES:
+            raise ValueError("unknown relay mode: %r" % relay_mode)
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         print("server fd:%r" % self._sock)
         self._sock.setblocking(False)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        if reuse_port:
+            _set_reuseport(self._sock)
+        self._fast_open_listen = False
+        self._fast_open_connect = False
+        if fast_open:
+            support = tfo.kernel_support()
+            log.info("kernel TCP fast open support: %#x" % support)
+            if support & tfo.TFO_SERVER:
+                self._fast_open_listen = tfo.enable_listener(self._sock)
+            self._fast_open_connect = bool(support & tfo.TFO_CLIENT)
         self._sock.bind((sslocal_host, sslocal_port))
         self._sock.listen(socket.SOMAXCONN)
         self._loop = loop
@@ -33,16 +96,99 @@ class TCPRelay:
         self._sslocal_port = sslocal_port
         self._ssserver_host = ssserver_host
         self._ssserver_port = ssserver_port
-        self._resolver = DnsResolver(self._loop, "8.8.8.8", 53)
+        self._relay_mode = relay_mode
+        if method:
+            # a bad method or missing libcrypto should stop us here
+            try_cipher(password, method)
+        self._method = method
+        self._password = password
+        # cipher work on buffers of crypto_offload bytes and more goes to
+        # worker threads, 0 (the default) keeps it all on the loop
+        self._crypto_executor = None
+        if method and crypto_offload:
+            self._crypto_executor = CryptoExecutor(loop, crypto_offload)
+        self._coalesce_writes = coalesce_writes
+        self._optimistic_connect = optimistic_connect
+        self._stats = RelayTotals()
+        self._handlers = set()
+        dns_cache = None
+        if dns_shared_cache:
+            dns_cache = SharedDnsCache(dns_shared_cache)
+        self._resolver = AsyncDnsResolver(
+            self._loop,
+            cache=dns_cache,
+            upstreams=dns_upstreams,
+            cache_file=dns_cache_file,
+        )
+        self._pool = None
+        if is_sslocal and pool_min_idle > 0:
+            self._pool = UpstreamPool(
+                loop,
+                ssserver_host,
+                ssserver_port,
+                min_idle=pool_min_idle,
+                max_idle=pool_max_idle,
+                idle_timeout=pool_idle_timeout,
+                fast_open=self._fast_open_connect,
+            )
+
+    async def connect_upstream(self):
+        """
+        A connected socket to the ssserver, from the pool when there is one.
+        """
+        if self._pool:
+            return await self._pool.acquire()
+        return await open_upstream(
+            self._loop,
+            self._ssserver_host,
+            self._ssserver_port,
+            fast_open=self._fast_open_connect,
+        )
 
     async def accept(self):
+        if self._pool:
+            self._pool.start()
         while True:
             csock, address = await self._loop.sock_accept(self._sock)
-            self._loop.create_task(
+            task = self._loop.create_task(
                 TCPRelayHandler(
                     self, self._loop, self._resolver, csock
                 ).relay()
             )
+            self._handlers.add(task)
+            task.add_done_callback(self._handlers.discard)
+
+    def close(self):
+        """
+        Stop listening. Connections already accepted keep relaying, see
+        drain() and shutdown(). The DNS cache is saved for the next start,
+        when it has a file.
+        """
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._resolver.save()
+        if self._pool:
+            self._pool.close()
+
+    def shutdown(self):
+        """
+        Release what connections in flight still rely on, the crypto
+        worker threads: call it once drain() has returned.
+        """
+        if self._method:
+            log.info("cipher context pool: %r" % ctx_pool.stats())
+        if self._crypto_executor:
+            log.info("crypto executor: %r" % self._crypto_executor.stats())
+            self._crypto_executor.close()
+
+    async def drain(self, timeout=None):
+        """
+        Wait for in-flight connections to finish, at most ``timeout``
+        seconds. Returns the number of connections still running.
+        """
+        if self._handlers:
+            await asyncio.wait(list(self._handlers), timeout=timeout)
+        return len(self._handlers)
 
     @property
     def sslocal_host(self):
@@ -64,6 +210,47 @@ class TCPRelay:
     def is_sslocal(self):
         return self._is_sslocal
 
+    @property
+    def relay_mode(self):
+        return self._relay_mode
+
+    @property
+    def coalesce_writes(self):
+        return self._coalesce_writes
+
+    @property
+    def optimistic_connect(self):
+        return self._optimistic_connect
+
+    @property
+    def pool(self):
+        return self._pool
+
+    @property
+    def fast_open_listen(self):
+        return self._fast_open_listen
+
+    @property
+    def fast_open_connect(self):
+        return self._fast_open_connect
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def crypto_executor(self):
+        return self._crypto_executor
+
+    def new_cryptor(self):
+        """
+        The cipher state of one sslocal <-> ssserver connection, None when
+        they talk in plain text.
+        """
+        if not self._method:
+            return None
+        return Cryptor(self._password, self._method)
+
 
 class TCPRelayHandler:
     def __init__(self, config: TCPRelay, loop, resolver, sock):
@@ -75,6 +262,15 @@ class TCPRelayHandler:
         self._downstream = None
         self._sock.setblocking(False)
         self._resolver = resolver
+        self._stats = RelayStats()
+        self._cryptor = config.new_cryptor()
+        self._cipher_streams = []
+        # decrypted tunnel bytes read ahead of the socks5 reply/request
+        self._tunnel_plain = b""
+
+    @property
+    def stats(self):
+        return self._stats
 
     async def authorize(self):
         auth_req = await async_pull(Socks5AuthReqGen(), self._loop, self._sock)
@@ -86,81 +282,397 @@ class TCPRelayHandler:
 
     async def address(self):
 
-        self._remote_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._remote_sock.setblocking(False)
-        addr_req = await async_pull(Socks5AddrReqGen(), self._loop, self._sock)
+        if self._config.is_sslocal:
+            addr_req = await async_pull(
+                Socks5AddrReqGen(), self._loop, self._sock
+            )
+        else:
+            addr_req = await self._tunnel_pull(Socks5AddrReqGen())
         print("addr_req:", addr_req)
+        if not addr_req:
+            self._sock.close()
+            return None
+
+        if self._config.is_sslocal and self._config.optimistic_connect:
+            return await self._optimistic_address(addr_req)
 
         if self._config.is_sslocal:
 
-            await self._loop.sock_connect(
-                self._remote_sock,
-                (self._config.ssserver_host, self._config.ssserver_port),
-            )
-            await self._loop.sock_sendall(
-                self._remote_sock, addr_req.to_bytes()
-            )
-            addr_rsp = await async_pull(
-                Socks5AddrRspGen(), self._loop, self._remote_sock
-            )
+            self._remote_sock = await self._config.connect_upstream()
+            await self._tunnel_sendall(addr_req.to_bytes())
+            addr_rsp = await self._tunnel_pull(Socks5AddrRspGen())
+            if not addr_rsp:
+                self._sock.close()
+                self._remote_sock.close()
+                return None
             addr_rsp = addr_rsp.to_bytes()
         else:
 
-            answer = await self._resolver.resolve(addr_req.addr)
-            if not answer:
+            self._remote_sock = await self._connect_target(addr_req)
+            if self._remote_sock is None:
+                await self._tunnel_sendall(
+                    Socks5AddrRsp(
+                        Socks5AddressAddrType.IP4,
+                        b"\x00.\x00.\x00.\x00",
+                        0,
+                        Socks5RepType.HOST_UNREACHABLE,
+                    ),
+                )
+                self._sock.close()
                 return None
-            target_ip = ".".join(["%u" % label for label in answer.rdata])
-            print("target ip:", target_ip)
-            await self._loop.sock_connect(self._remote_sock, (target_ip, 80))
             addr_rsp = Socks5AddrRsp(
                 Socks5AddressAddrType.IP4, b"\x00.\x00.\x00.\x00", 4112
             )
         print("addr_rsp:", addr_rsp)
-        if addr_rsp:
+        if addr_rsp and self._config.is_sslocal:
             await self._loop.sock_sendall(self._sock, addr_rsp)
+        elif addr_rsp:
+            await self._tunnel_sendall(addr_rsp)
         return addr_rsp
 
+    async def _connect_target(self, addr_req):
+        """
+        Resolve A and AAAA for the requested name concurrently and race
+        connections to the results, RFC 8305 style. IP literals are
+        connected to directly. None when nothing could be reached.
+        """
+        if addr_req.atyp == Socks5AddressAddrType.IP4.value:
+            addresses = [
+                (
+                    socket.AF_INET,
+                    socket.inet_ntop(socket.AF_INET, addr_req.addr),
+                )
+            ]
+        elif addr_req.atyp == Socks5AddressAddrType.IP6.value:
+            addresses = [
+                (
+                    socket.AF_INET6,
+                    socket.inet_ntop(socket.AF_INET6, addr_req.addr),
+                )
+            ]
+        else:
+            addresses = await resolve_addresses(self._resolver, addr_req.addr)
+        print("target addresses:", addresses)
+        try:
+            return await open_connection(
+                self._loop,
+                addresses,
+                addr_req.port,
+                fast_open=self._config.fast_open_connect,
+            )
+        except OSError as e:
+            log.info("connect %r failed: %r" % (addr_req.addr, e))
+            return None
+
+    async def _optimistic_address(self, addr_req):
+        """
+        Tell the client it is connected right away, then send the address
+        header and the client's first payload to the ssserver in a single
+        write. The ssserver's reply is only checked afterwards; if it
+        reports a failure the client is closed.
+        """
+        upstream = self._loop.create_task(self._config.connect_upstream())
+        addr_rsp = Socks5AddrRsp(
+            Socks5AddressAddrType.IP4, b"\x00.\x00.\x00.\x00", 0
+        )
+        await self._loop.sock_sendall(self._sock, addr_rsp)
+        try:
+            # server-speaks-first protocols send nothing, do not wait long
+            first = await asyncio.wait_for(
+                self._loop.sock_recv(self._sock, FIRST_PAYLOAD_SIZE),
+                FIRST_PAYLOAD_WAIT,
+            )
+            if not first:
+                raise ConnectionAbortedError
+        except asyncio.TimeoutError:
+            first = b""
+        except (ConnectionAbortedError, ConnectionResetError):
+            upstream.cancel()
+            self._sock.close()
+            return None
+
+        addr_rsp_ = None
+        try:
+            self._remote_sock = await upstream
+            await self._tunnel_sendall(addr_req.to_bytes() + first)
+            if first:
+                self._stats.up.on_read(len(first), FIRST_PAYLOAD_SIZE)
+                self._stats.up.on_write()
+            addr_rsp_ = await self._tunnel_pull(Socks5AddrRspGen())
+        except OSError as e:
+            log.info("optimistic connect failed: %r" % e)
+        if not addr_rsp_ or addr_rsp_.rep != Socks5RepType.SUCCEEDED.value:
+            log.info("ssserver refused %r: %r" % (addr_req.addr, addr_rsp_))
+            self._sock.close()
+            if self._remote_sock:
+                self._remote_sock.close()
+            return None
+        return addr_rsp
+
+    @property
+    def _tunnel(self):
+        # the socket to the other shadowsocks end
+        return self._remote_sock if self._config.is_sslocal else self._sock
+
+    async def _tunnel_sendall(self, data):
+        if self._cryptor is not None:
+            data = self._cryptor.encrypt(data)
+        await self._loop.sock_sendall(self._tunnel, data)
+
+    async def _tunnel_recv(self, size):
+        while not self._tunnel_plain:
+            data = await self._loop.sock_recv(self._tunnel, TUNNEL_RECV_SIZE)
+            if not data:
+                return b""
+            self._tunnel_plain = self._cryptor.decrypt(data)
+        data = self._tunnel_plain[:size]
+        self._tunnel_plain = self._tunnel_plain[size:]
+        return data
+
+    async def _tunnel_pull(self, field):
+        if self._cryptor is None:
+            return await async_pull(field, self._loop, self._tunnel)
+        return await async_pull(field, self._loop, None, self._tunnel_recv)
+
+    def _note_fast_open(self, sock):
+        if self._config.fast_open_connect and not self._stats.tfo_out:
+            self._stats.tfo_out = tfo.used_syn_data(sock)
+
     def _stop_upstream(self):
+        self._note_fast_open(self._remote_sock)
         self._loop.remove_reader(self._sock.fileno())
         self._loop.remove_writer(self._remote_sock.fileno())
 
     def _stop_downstream(self):
+        self._note_fast_open(self._remote_sock)
         self._loop.remove_reader(self._remote_sock.fileno())
         self._loop.remove_writer(self._sock.fileno())
 
-    async def upstream(self):
-        while True:
+    def _wait_fd(self, add, remove, fd):
+        fut = self._loop.create_future()
+
+        def _ready():
+            remove(fd)
+            if not fut.done():
+                fut.set_result(None)
+
+        add(fd, _ready)
+        fut.add_done_callback(lambda _: remove(fd))
+        return fut
+
+    def _wait_readable(self, sock):
+        return self._wait_fd(
+            self._loop.add_reader, self._loop.remove_reader, sock.fileno()
+        )
+
+    def _wait_writable(self, sock):
+        return self._wait_fd(
+            self._loop.add_writer, self._loop.remove_writer, sock.fileno()
+        )
+
+    def _drain_into(self, src, view):
+        # coalescing: pick up whatever else is already queued on the
+        # socket so it leaves in the same send
+        total = 0
+        while total < len(view):
             try:
-                up_ = await self._loop.sock_recv(self._sock, 4096)
-                if not up_:
-                    raise ConnectionAbortedError
-                await self._loop.sock_sendall(self._remote_sock, up_)
-            except (BrokenPipeError, ConnectionAbortedError):
-                self._stop_upstream()
-                self._downstream.cancel()
+                n = src.recv_into(view[total:])
+            except (BlockingIOError, InterruptedError):
                 break
-            except asyncio.CancelledError:
-                self._stop_upstream()
-                self._sock.close()
-                self._remote_sock.close()
+            if not n:
                 break
+            total += n
+        return total
 
-    async def downstream(self):
+    async def _copy_pump(self, src, dst, stats):
+        sizer = ChunkSizer()
         while True:
+            size = sizer.size
+            data = await self._loop.sock_recv(src, size)
+            if not data:
+                raise ConnectionAbortedError
+            stats.on_read(len(data), size)
+            sizer.update(len(data))
+            await self._loop.sock_sendall(dst, data)
+            stats.on_write()
+
+    async def _ring_pump(self, src, dst, stats):
+        # one preallocated buffer per direction, filled in place by
+        # recv_into and sent through memoryview slices, so no per-chunk
+        # bytes objects are created
+        sizer = ChunkSizer()
+        view = memoryview(bytearray(sizer.size))
+        coalesce = self._config.coalesce_writes
+        while True:
+            size = sizer.size
+            if len(view) < size:
+                view = memoryview(bytearray(size))
+            n = await self._loop.sock_recv_into(src, view[:size])
+            if not n:
+                raise ConnectionAbortedError
+            if coalesce and n < size:
+                n += self._drain_into(src, view[n:size])
+            stats.on_read(n, size)
+            sizer.update(n)
+            await self._loop.sock_sendall(dst, view[:n])
+            stats.on_write()
+
+    async def _crypto_pump(self, src, dst, stats, encrypting):
+        # recv buffers go through the cipher whole, the AEAD framing cuts
+        # them into chunks in one call. The cipher reads the recv buffer
+        # and writes the send buffer in place: no bytes object in between
+        if encrypting:
+            transform = self._cryptor.encrypt_into
+            out_size = self._cryptor.encrypt_size
+        else:
+            transform = self._cryptor.decrypt_into
+            out_size = self._cryptor.decrypt_size
+            if self._tunnel_plain:
+                pending, self._tunnel_plain = self._tunnel_plain, b""
+                await self._loop.sock_sendall(dst, pending)
+                stats.on_write()
+        executor = self._config.crypto_executor
+        if executor is not None:
+            # bulk buffers are ciphered by a worker, in order
+            transform = executor.stream(transform)
+            self._cipher_streams.append(transform)
+        sizer = ChunkSizer()
+        view = memoryview(bytearray(sizer.size))
+        out = memoryview(bytearray(out_size(sizer.size)))
+        while True:
+            size = sizer.size
+            if len(view) < size:
+                view = memoryview(bytearray(size))
+            n = await self._loop.sock_recv_into(src, view[:size])
+            if not n:
+                raise ConnectionAbortedError
+            stats.on_read(n, size)
+            sizer.update(n)
+            need = out_size(n)
+            if len(out) < need:
+                out = memoryview(bytearray(need))
             try:
-                down_ = await self._loop.sock_recv(self._remote_sock, 4096)
-                if not down_:
+                if executor is None:
+                    n = transform(view[:n], out)
+                else:
+                    n = await transform(view[:n], out)
+            except Exception as e:
+                log.info("cipher failed, closing: %r" % e)
+                raise ConnectionAbortedError
+            if n:
+                await self._loop.sock_sendall(dst, out[:n])
+                stats.on_write()
+
+    async def _splice_pump(self, src, dst, stats):
+        # plaintext only: bytes move socket -> pipe -> socket inside the
+        # kernel and never reach a python buffer
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        rfd, wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            fcntl.fcntl(wfd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass
+        sizer = ChunkSizer()
+        spliced = False
+        try:
+            while True:
+                await self._wait_readable(src)
+                size = sizer.size
+                try:
+                    n = os.splice(src.fileno(), wfd, size, flags=flags)
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    if spliced or e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    log.info("splice unavailable, fall back to recv_into")
+                    break
+                if not n:
                     raise ConnectionAbortedError
-                await self._loop.sock_sendall(self._sock, down_)
-            except (BrokenPipeError, ConnectionAbortedError):
-                self._stop_downstream()
-                self._upstream.cancel()
-                break
-            except asyncio.CancelledError:
-                self._stop_downstream()
-                self._remote_sock.close()
-                self._sock.close()
-                break
+                spliced = True
+                stats.on_read(n, size)
+                sizer.update(n)
+                while n:
+                    try:
+                        n -= os.splice(rfd, dst.fileno(), n, flags=flags)
+                        stats.on_write()
+                    except BlockingIOError:
+                        await self._wait_writable(dst)
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+        await self._ring_pump(src, dst, stats)
+
+    def _pick_pump(self, encrypting):
+        if self._cryptor is not None:
+            # cipher text has to pass through python: nothing to splice
+            return partial(self._crypto_pump, encrypting=encrypting)
+        if self._config.relay_mode == RELAY_MODE_ZEROCOPY:
+            if splice_supported():
+                return self._splice_pump
+            return self._ring_pump
+        return self._copy_pump
+
+    async def upstream(self):
+        try:
+            await self._pick_pump(self._config.is_sslocal)(
+                self._sock, self._remote_sock, self._stats.up
+            )
+        except OSError as e:
+            if not isinstance(e, PEER_CLOSED):
+                log.info("upstream failed: %r" % e)
+            self._stop_upstream()
+            self._downstream.cancel()
+        except asyncio.CancelledError:
+            self._stop_upstream()
+            self._sock.close()
+            self._remote_sock.close()
+
+    async def downstream(self):
+        try:
+            await self._pick_pump(not self._config.is_sslocal)(
+                self._remote_sock, self._sock, self._stats.down
+            )
+        except OSError as e:
+            if not isinstance(e, PEER_CLOSED):
+                log.info("downstream failed: %r" % e)
+            self._stop_downstream()
+            self._upstream.cancel()
+        except asyncio.CancelledError:
+            self._stop_downstream()
+            self._remote_sock.close()
+            self._sock.close()
+
+    async def _relay_protocols(self):
+        log.info(
+            "%s start streaming over transports"
+            % ("sslocal" if self._config.is_sslocal else "ssserver")
+        )
+        try:
+            await relay_sockets(
+                self._loop,
+                self._sock,
+                self._remote_sock,
+                self._stats,
+                coalesce=self._config.coalesce_writes,
+                on_remote_lost=self._note_fast_open,
+            )
+        except OSError as e:
+            log.info("relay setup failed: %r" % e)
+            self._sock.close()
+            self._remote_sock.close()
+
+    def _finish(self):
+        if self._cryptor is not None:
+            executor = self._config.crypto_executor
+            if executor is None:
+                self._cryptor.close()
+            else:
+                # a cancelled pump may have left a job on the contexts
+                executor.when_idle(self._cipher_streams, self._cryptor.close)
+        self._stats.finish()
+        self._config.stats.close(self._stats)
+        log.info("connection stats: %r" % self._stats.as_dict())
 
     async def relay(self):
         if self._config.is_sslocal:
@@ -170,9 +682,21 @@ class TCPRelayHandler:
         if not await self.address():
             return None
 
+        self._config.stats.open()
+        if self._config.fast_open_listen:
+            self._stats.tfo_in = tfo.used_syn_data(self._sock)
+        if (
+            self._config.relay_mode == RELAY_MODE_PROTOCOL
+            and self._cryptor is None
+        ):
+            await self._relay_protocols()
+            return self._finish()
+
         self._downstream = self._loop.create_task(self.downstream())
         self._upstream = self._loop.create_task(self.upstream())
         log.info(
             "%s start streaming"
             % ("sslocal" if self._config.is_sslocal else "ssserver")
         )
+        await asyncio.wait([self._upstream, self._downstream])
+        self._finish()
@@ -0,0 +1,56 @@
+import os
+
+from asyncdns.cache import DnsCache
+from asyncdns.cache_store import load_cache, save_cache
+from asyncdns.resolve_rsp import Answer
+
+RECORDS = 2000
+
+
+def _filled_cache():
+    cache = DnsCache(max_entries=RECORDS, stale_ttl=60.0)
+    for i in range(RECORDS):
+        name = b"host%u.example" % i
+        cache.put(
+            name,
+            1,
+            [
+                Answer(name, 5, 1, 300, 6, b"cdn.example"),
+                Answer(b"cdn.example", 1, 1, 300, 4, (10, 0, i >> 8, i & 255)),
+            ],
+        )
+    cache.put_negative(b"nx.example", 1, 3)
+    return cache
+
+
+def test_save_and_load(tmp_path):
+    cache = _filled_cache()
+    path = os.path.join(str(tmp_path), "dns.cache")
+    # bounded by max_entries: the negative answer pushed out host0
+    assert save_cache(cache, path) == RECORDS
+    assert cache.get(b"host0.example", 1) is None
+    warm = DnsCache(max_entries=RECORDS, stale_ttl=60.0)
+    assert load_cache(warm, path)
+    entry = warm.get(b"host258.example", 1)
+    assert entry.answers == cache.get(b"host258.example", 1).answers
+    assert warm.get(b"nx.example", 1).negative
+    assert warm.get(b"other.example", 1) is None
+
+
+def test_unread_entries_survive_the_next_save(tmp_path):
+    path = os.path.join(str(tmp_path), "dns.cache")
+    saved = save_cache(_filled_cache(), path)
+    warm = DnsCache(max_entries=RECORDS, stale_ttl=60.0)
+    load_cache(warm, path)
+    warm.put(b"host1.example", 1, [Answer(b"x", 1, 1, 30, 1, 7)])
+    assert save_cache(warm, path) == saved
+    again = DnsCache()
+    load_cache(again, path)
+    assert again.get(b"host1.example", 1).answers[0].rdata == 7
+    assert again.get(b"host7.example", 1).answers[1].rdata[3] == 7
+
+
+def test_missing_file(tmp_path):
+    cache = DnsCache()
+    assert not load_cache(cache, os.path.join(str(tmp_path), "missing"))
+    assert cache.get(b"host1.example", 1) is None
@@ -0,0 +1,35 @@
+import asyncio
+
+from crypto_executor import CryptoExecutor
+
+
+async def _ordered(loop):
+    executor = CryptoExecutor(loop, threshold=4)
+    order = []
+
+    def transform(src, dst):
+        order.append(bytes(src))
+        return len(src)
+
+    stream = executor.stream(transform)
+    # big ones go to the pool, small ones must still come after them
+    calls = [b"a" * 8, b"b", b"c" * 8, b"d"]
+    results = await asyncio.gather(*[stream(c, None) for c in calls])
+    stats = executor.stats()
+    closed = []
+    executor.when_idle([stream], lambda: closed.append(1))
+    executor.close()
+    return calls, order, results, stats, closed
+
+
+def test_stream_keeps_order():
+    loop = asyncio.new_event_loop()
+    try:
+        calls, order, results, stats, closed = loop.run_until_complete(
+            _ordered(loop)
+        )
+    finally:
+        loop.close()
+    assert order == calls and results == [8, 1, 8, 1]
+    assert stats == {"inline": 2, "offloaded": 2}
+    assert closed == [1]
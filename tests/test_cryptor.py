@@ -0,0 +1,69 @@
+import os
+import random
+
+import pytest
+
+from crypto.cryptor import Cryptor, _IntoPipe, _Pipe
+
+METHODS = [
+    "aes-128-gcm",
+    "aes-256-gcm",
+    "chacha20-ietf-poly1305",
+    "aes-256-cfb",
+]
+
+
+@pytest.mark.parametrize("pipe_type", [_Pipe, _IntoPipe])
+@pytest.mark.parametrize("method", METHODS)
+def test_round_trip(method, pipe_type):
+    local = Cryptor(b"password", method)
+    server = Cryptor(b"password", method)
+    pipe = pipe_type(local, server)
+    plain = os.urandom(1024 * 1024)
+    pos = 0
+    opened = []
+    while pos < len(plain):
+        size = random.randint(100, 32768)
+        opened.append(
+            pipe.decrypt_once(pipe.encrypt_once(plain[pos : pos + size]))
+        )
+        pos += size
+    assert b"".join(opened) == plain
+
+
+def test_split_chunks():
+    local = Cryptor(b"password", "aes-256-gcm")
+    server = Cryptor(b"password", "aes-256-gcm")
+    plain = os.urandom(100000)
+    cipher = local.encrypt(plain)
+    # byte by byte around the salt and chunk headers, then in big pieces
+    got = [server.decrypt(cipher[i : i + 1]) for i in range(100)]
+    got.append(server.decrypt(cipher[100:70000]))
+    got.append(server.decrypt(cipher[70000:]))
+    assert b"".join(got) == plain
+    assert server.decrypt(local.encrypt(b"more")) == b"more"
+
+
+def test_tampered_chunk_rejected():
+    local = Cryptor(b"password", "aes-256-gcm")
+    server = Cryptor(b"password", "aes-256-gcm")
+    tampered = bytearray(local.encrypt(b"x" * 100))
+    tampered[-1] ^= 1
+    with pytest.raises(Exception):
+        server.decrypt(bytes(tampered))
+
+
+@pytest.mark.parametrize("method", ["aes-256-gcm", "aes-256-cfb"])
+def test_into_buffers(method):
+    # into a buffer, straight from a writable recv buffer
+    local = Cryptor(b"password", method)
+    server = Cryptor(b"password", method)
+    plain = os.urandom(100000)
+    sealed = bytearray(local.encrypt_size(len(plain)))
+    assert local.encrypt_into(memoryview(plain), sealed) == len(sealed)
+    opened = bytearray(len(plain))
+    n = 0
+    for pos in range(0, len(sealed), 4000):
+        piece = memoryview(sealed)[pos : pos + 4000]
+        n += server.decrypt_into(piece, memoryview(opened)[n:])
+    assert n == len(plain) and opened == plain
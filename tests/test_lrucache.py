@@ -0,0 +1,59 @@
+from lrucache import LRUCache
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_sweep_after_timeout():
+    clock = _Clock()
+    c = LRUCache(timeout=0.5, clock=clock)
+    c["a"] = 1
+    c["b"] = 2
+    clock.now += 0.4
+    c.sweep()
+    assert c["a"] == 1
+    assert c["b"] == 2
+    clock.now += 0.6
+    c.sweep()
+    assert "a" not in c
+    assert "b" not in c
+
+
+def test_expired_on_read():
+    clock = _Clock()
+    closed = []
+    c = LRUCache(timeout=0.1, close_cb=closed.append, clock=clock)
+    c["a"] = 1
+    clock.now += 0.15
+    # no sweep: the read itself finds it expired
+    assert c.get("a") is None
+    assert "a" not in c and closed == [1]
+
+
+def test_max_entries_evicts_least_recent():
+    closed = []
+    c = LRUCache(timeout=None, close_cb=closed.append, max_entries=2)
+    c["a"] = 1
+    c["b"] = 2
+    assert c["a"] == 1
+    c["c"] = 3
+    assert "b" not in c and closed == [2]
+    assert c["a"] == 1 and c["c"] == 3
+
+
+def test_fixed_ttl_does_not_slide():
+    clock = _Clock()
+    closed = []
+    c = LRUCache(timeout=10.0, close_cb=closed.append, clock=clock)
+    c.set("fixed", 4, ttl=0.2)
+    c["sliding"] = 5
+    clock.now += 0.1
+    assert c["fixed"] == 4
+    clock.now += 0.15
+    assert c.sweep() == 1 and closed[-1] == 4
+    assert c["sliding"] == 5
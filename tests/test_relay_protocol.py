@@ -0,0 +1,58 @@
+import asyncio
+import socket
+
+from relay_protocol import relay_sockets
+from relay_stats import RelayStats
+
+
+async def _recv_exactly(loop, sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+async def _relay_with_late_remote(loop):
+    local_sock, client = socket.socketpair()
+    remote_sock, server = socket.socketpair()
+    for sock in (local_sock, client, remote_sock, server):
+        sock.setblocking(False)
+
+    create_connection = loop.create_connection
+
+    async def late_create_connection(*args, **kwargs):
+        # the local side gets to read before the remote transport exists
+        await asyncio.sleep(0.05)
+        return await create_connection(*args, **kwargs)
+
+    loop.create_connection = late_create_connection
+    client.sendall(b"sent before the remote side connects")
+    relay = loop.create_task(
+        relay_sockets(loop, local_sock, remote_sock, RelayStats())
+    )
+
+    early = await _recv_exactly(loop, server, 36)
+    await loop.sock_sendall(server, b"pong")
+    reply = await _recv_exactly(loop, client, 4)
+    client.shutdown(socket.SHUT_WR)
+    eof = await loop.sock_recv(server, 1)
+    server.close()
+    await asyncio.wait_for(relay, 1)
+    client.close()
+    return early, reply, eof
+
+
+def test_data_sent_before_remote_connects():
+    loop = asyncio.new_event_loop()
+    try:
+        early, reply, eof = loop.run_until_complete(
+            _relay_with_late_remote(loop)
+        )
+    finally:
+        loop.close()
+    assert early == b"sent before the remote side connects"
+    assert reply == b"pong"
+    assert eof == b""
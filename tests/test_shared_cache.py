@@ -0,0 +1,67 @@
+import os
+
+from asyncdns.resolve_rsp import Answer
+from asyncdns.shared_cache import SharedDnsCache
+
+WORKERS = 4
+NAMES = 500
+
+
+def _answers(i):
+    i %= 256
+    return [Answer(b"hot.example", 1, 1, 300 + i, 4, (i, i, i, i))]
+
+
+def _intact(answer):
+    return len(set(answer.rdata + (answer.ttl - 300,))) == 1
+
+
+def _write(path, worker):
+    cache = SharedDnsCache(path)
+    for i in range(NAMES):
+        cache.put(b"w%u-%u.example" % (worker, i), 1, _answers(i))
+        cache.put(b"hot.example", 1, _answers(i))
+
+
+def test_no_torn_reads_across_processes(tmp_path):
+    path = os.path.join(str(tmp_path), "dns.table")
+    pids = []
+    for worker in range(WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _write(path, worker)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    reader = SharedDnsCache(path)
+    assert reader.shared
+    torn = 0
+    running = set(pids)
+    statuses = []
+    while running:
+        record = reader._table.load((b"hot.example", 1))
+        if record:
+            # a torn read would decode to something put never wrote
+            torn += not _intact(record[0][0])
+        for pid in list(running):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                statuses.append(status)
+                running.discard(pid)
+    assert statuses == [0] * WORKERS
+    assert torn == 0
+    found = sum(
+        reader.get(b"w%u-%u.example" % (worker, i), 1) is not None
+        for worker in range(WORKERS)
+        for i in range(NAMES)
+    )
+    assert found
+    reader.close()
+
+
+def test_falls_back_to_a_private_cache():
+    alone = SharedDnsCache("/nonexistent/dns.table")
+    assert not alone.shared
+    alone.put(b"a.example", 1, _answers(0))
+    assert alone.get(b"a.example", 1) is not None
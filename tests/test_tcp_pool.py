@@ -0,0 +1,158 @@
+import asyncio
+import struct
+
+from async_dns.async_resolver import AsyncDnsResolver
+from async_dns.resolver import DnsResolver
+from async_dns.tcp_pool import LENGTH_STRUCT, MAX_CONNECTIONS, frame
+from asyncdns.enums import QClass, QType
+from asyncdns.resolve_req import ResolveRequest
+
+NAMES = [b"host%u.example" % i for i in range(200)]
+
+
+class _StandInServer:
+    """
+    Local stand-in for an upstream: A queries are answered with
+    ``records`` addresses, truncated to the first one over UDP, and TCP
+    replies to pipelined queries are sent in reverse.
+    """
+
+    def __init__(self, records=100):
+        self.records = records
+        self.udp_queries = 0
+        self.tcp_queries = 0
+        self.tcp_connections = 0
+
+    def answer(self, query, truncate):
+        question = query[12:]
+        count = 1 if truncate else self.records
+        flags = 0x8380 if truncate else 0x8180
+        answers = b"".join(
+            struct.pack("!HHHIH", 0xC00C, 1, 1, 60, 4)
+            + bytes([10, 0, i // 256, i % 256])
+            for i in range(count)
+        )
+        return (
+            query[:2]
+            + struct.pack("!HHHHH", flags, 1, count, 0, 0)
+            + question
+            + answers
+        )
+
+    def datagram_received(self, data, addr):
+        self.udp_queries += 1
+        self.transport.sendto(self.answer(data, truncate=True), addr)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    async def serve_tcp(self, reader, writer):
+        self.tcp_connections += 1
+        while True:
+            batch = []
+            try:
+                (size,) = LENGTH_STRUCT.unpack(await reader.readexactly(2))
+                batch.append(await reader.readexactly(size))
+                # gather what is already pipelined behind it
+                while len(reader._buffer) >= 2:
+                    (size,) = LENGTH_STRUCT.unpack(await reader.readexactly(2))
+                    batch.append(await reader.readexactly(size))
+            except asyncio.IncompleteReadError:
+                writer.close()
+                return
+            self.tcp_queries += len(batch)
+            for query in reversed(batch):
+                writer.write(frame(self.answer(query, truncate=False)))
+            await writer.drain()
+
+
+def _run_against_stand_in(check):
+    async def run(loop):
+        stand_in = _StandInServer()
+        udp, _ = await loop.create_datagram_endpoint(
+            lambda: stand_in, local_addr=("127.0.0.1", 0)
+        )
+        port = udp.get_extra_info("socket").getsockname()[1]
+        tcp = await asyncio.start_server(stand_in.serve_tcp, "127.0.0.1", port)
+        try:
+            await check(loop, stand_in, port)
+        finally:
+            udp.close()
+            tcp.close()
+            await tcp.wait_closed()
+            await asyncio.sleep(0.1)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run(loop))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_truncated_answer_retried_over_tcp():
+    async def check(loop, stand_in, port):
+        resolver = AsyncDnsResolver(loop, "127.0.0.1", port, prefetch=False)
+        try:
+            answers = await resolver.resolve_all(b"big.example")
+            assert len(answers) == stand_in.records
+            results = await asyncio.gather(
+                *[resolver.resolve(n) for n in NAMES]
+            )
+            assert all(results), results
+            assert stand_in.tcp_connections <= MAX_CONNECTIONS
+        finally:
+            resolver.close()
+
+    _run_against_stand_in(check)
+
+
+def test_pipelined_replies_out_of_order():
+    async def check(loop, stand_in, port):
+        resolver = AsyncDnsResolver(loop, "127.0.0.1", port, prefetch=False)
+        queries = [
+            ResolveRequest(n, QType.QTYPE_A, QClass.QCLASS_IN) for n in NAMES
+        ]
+        addr = ("127.0.0.1", port)
+        try:
+            replies = await asyncio.gather(
+                *[resolver.tcp.query(addr, q.to_bytes()) for q in queries]
+            )
+            assert all(
+                r.questions[0].qname == n
+                and len(r.answers) == stand_in.records
+                for r, n in zip(replies, NAMES)
+            )
+            assert resolver.tcp.stats()["connects"] <= MAX_CONNECTIONS
+            assert stand_in.tcp_connections <= MAX_CONNECTIONS
+        finally:
+            resolver.close()
+
+    _run_against_stand_in(check)
+
+
+def test_thread_pool_resolver_falls_back_to_tcp():
+    async def check(loop, stand_in, port):
+        threaded = DnsResolver(loop, "127.0.0.1", port)
+        outcomes = []
+        header, answers = await loop.run_in_executor(
+            None,
+            threaded._resolve,
+            [b"big.example"],
+            QType.QTYPE_A,
+            QClass.QCLASS_IN,
+            threaded.upstreams.ranked(),
+            outcomes,
+        )
+        # upstream updates are left to the loop thread
+        assert outcomes
+        assert not header.truncated and len(answers) == stand_in.records
+
+    _run_against_stand_in(check)
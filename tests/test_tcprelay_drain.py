@@ -0,0 +1,90 @@
+import asyncio
+import os
+import socket
+import struct
+
+from tcprelay import TCPRelay
+
+PAYLOAD_SIZE = 512 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _echo(reader, writer):
+    while True:
+        data = await reader.read(CHUNK_SIZE)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def _drain_while_relaying(loop):
+    echo = await asyncio.start_server(_echo, "127.0.0.1", 0)
+    echo_port = echo.sockets[0].getsockname()[1]
+    server_port = _free_port()
+    local_port = _free_port()
+    cipher = dict(method="aes-256-gcm", password="drain", crypto_offload=1)
+    relays = [
+        TCPRelay(loop, False, "127.0.0.1", server_port, **cipher),
+        TCPRelay(
+            loop,
+            True,
+            "127.0.0.1",
+            local_port,
+            "127.0.0.1",
+            server_port,
+            **cipher
+        ),
+    ]
+    accepts = [loop.create_task(relay.accept()) for relay in relays]
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", local_port)
+    writer.write(b"\x05\x01\x00")
+    assert await reader.readexactly(2) == b"\x05\x00"
+    writer.write(
+        b"\x05\x01\x00\x01"
+        + socket.inet_aton("127.0.0.1")
+        + struct.pack("!H", echo_port)
+    )
+    await reader.readexactly(10)
+
+    payload = os.urandom(PAYLOAD_SIZE)
+    half = PAYLOAD_SIZE // 2
+    writer.write(payload[:half])
+    echoed = await reader.readexactly(half)
+    # what workers.serve does on SIGTERM, with the connection still open
+    for accept, relay in zip(accepts, relays):
+        accept.cancel()
+        relay.close()
+    drains = [loop.create_task(relay.drain(5)) for relay in relays]
+    writer.write(payload[half:])
+    echoed += await reader.readexactly(PAYLOAD_SIZE - half)
+    writer.close()
+    left = await asyncio.gather(*drains)
+    offloaded = [r.crypto_executor.stats()["offloaded"] for r in relays]
+    for relay in relays:
+        relay.shutdown()
+    echo.close()
+    return echoed == payload, left, offloaded
+
+
+def test_drain_with_crypto_offload():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        intact, left, offloaded = loop.run_until_complete(
+            _drain_while_relaying(loop)
+        )
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+    assert intact
+    assert left == [0, 0]
+    assert all(offloaded)
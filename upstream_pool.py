@@ -0,0 +1,144 @@
+import collections
+import socket
+
+from utils import tfo
+from utils.loggers import get_logger
+
+log = get_logger("upstream_pool")
+
+PROBE_INTERVAL = 5.0
+
+
+async def open_upstream(loop, host, port, fast_open=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    if fast_open:
+        tfo.enable_connect(sock)
+    try:
+        await loop.sock_connect(sock, (host, port))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def is_alive(sock):
+    """
+    Health probe for an idle upstream socket: it must have nothing to
+    read, since a pooled connection has not sent anything yet. Readable
+    means the peer closed it (or misbehaved).
+    """
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError:
+        return False
+    return False
+
+
+class UpstreamPool:
+    """
+    Keeps between ``min_idle`` and ``max_idle`` connected, unused sockets
+    to the ssserver so a SOCKS CONNECT can be forwarded without waiting
+    for a TCP handshake. Idle sockets older than ``idle_timeout`` or
+    failing the probe are dropped every PROBE_INTERVAL seconds.
+
+    ``fast_open`` only applies to the connect made when the pool is
+    empty. Pooled sockets connect without it: TCP Fast Open saves the
+    round trip by carrying the first send on the SYN, and with
+    TCP_FASTOPEN_CONNECT a pooled socket, which sends nothing, would put
+    its handshake off until it is used, which is the wait the pool
+    exists to take away.
+    """
+
+    def __init__(
+        self,
+        loop,
+        host,
+        port,
+        min_idle=2,
+        max_idle=8,
+        idle_timeout=30.0,
+        fast_open=False,
+    ):
+        self._loop = loop
+        self._host = host
+        self._port = port
+        self._fast_open = fast_open
+        self._min_idle = min_idle
+        self._max_idle = max(min_idle, max_idle)
+        self._idle_timeout = idle_timeout
+        self._idle = collections.deque()
+        self._connecting = 0
+        self._timer = None
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        self._maintain()
+
+    def close(self):
+        self._closed = True
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self._idle:
+            sock, _ = self._idle.popleft()
+            sock.close()
+
+    async def acquire(self):
+        while self._idle:
+            # newest first, it is the least likely to have been dropped
+            sock, _ = self._idle.pop()
+            if is_alive(sock):
+                self.hits += 1
+                self._refill()
+                return sock
+            sock.close()
+        self.misses += 1
+        self._refill()
+        return await open_upstream(
+            self._loop, self._host, self._port, fast_open=self._fast_open
+        )
+
+    def _refill(self):
+        if self._closed:
+            return
+        while len(self._idle) + self._connecting < self._min_idle:
+            self._connecting += 1
+            self._loop.create_task(self._fill_one())
+
+    async def _fill_one(self):
+        try:
+            sock = await open_upstream(self._loop, self._host, self._port)
+        except OSError as e:
+            log.info("upstream pool connect failed: %r" % e)
+            return
+        finally:
+            self._connecting -= 1
+        if self._closed or len(self._idle) >= self._max_idle:
+            sock.close()
+        else:
+            self._idle.append((sock, self._loop.time()))
+
+    def _maintain(self):
+        now = self._loop.time()
+        alive = collections.deque()
+        for sock, since in self._idle:
+            if now - since < self._idle_timeout and is_alive(sock):
+                alive.append((sock, since))
+            else:
+                sock.close()
+        self._idle = alive
+        self._refill()
+        self._timer = self._loop.call_later(PROBE_INTERVAL, self._maintain)
+
+    def as_dict(self):
+        return {
+            "idle": len(self._idle),
+            "connecting": self._connecting,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,66 @@
+import socket
+import struct
+
+from utils.loggers import get_logger
+
+log = get_logger("tfo")
+
+TCP_FASTOPEN = getattr(socket, "TCP_FASTOPEN", 23)
+TCP_FASTOPEN_CONNECT = getattr(socket, "TCP_FASTOPEN_CONNECT", 30)
+TCP_INFO = getattr(socket, "TCP_INFO", 11)
+TCPI_OPT_SYN_DATA = 0x20
+
+TFO_CLIENT = 0x1
+TFO_SERVER = 0x2
+TFO_SYSCTL = "/proc/sys/net/ipv4/tcp_fastopen"
+TFO_QUEUE_LEN = 1024
+
+
+def kernel_support():
+    """
+    TFO_CLIENT | TFO_SERVER bits enabled in the kernel, 0 when TCP Fast
+    Open is off or the platform does not expose it.
+    """
+    try:
+        with open(TFO_SYSCTL) as f:
+            return int(f.read().strip()) & (TFO_CLIENT | TFO_SERVER)
+    except (OSError, ValueError):
+        return 0
+
+
+def enable_listener(sock, qlen=TFO_QUEUE_LEN):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN, qlen)
+    except OSError as e:
+        log.info("TCP_FASTOPEN on listener failed: %r" % e)
+        return False
+    return True
+
+
+def enable_connect(sock):
+    """
+    With TCP_FASTOPEN_CONNECT set, connect() returns at once and the SYN
+    leaves with the first send(), carrying its data when a cookie for the
+    peer is cached.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+    except OSError as e:
+        log.info("TCP_FASTOPEN_CONNECT failed: %r" % e)
+        return False
+    return True
+
+
+def used_syn_data(sock):
+    """
+    Whether data rode on the SYN of this connection and was acknowledged,
+    read from the tcpi_options byte of struct tcp_info.
+    """
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, 8)
+    except OSError:
+        return False
+    if len(info) < 6:
+        return False
+    options = struct.unpack_from("!B", info, 5)[0]
+    return bool(options & TCPI_OPT_SYN_DATA)
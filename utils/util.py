@@ -141,7 +141,7 @@ def bits(s, cnt):
     return s
 
 
-VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d\-_]{1,63}(?<!-)$", re.IGNORECASE)
+VALID_HOSTNAME = re.compile(rb"(?!-)[A-Z\d\-_]{1,63}(?<!-)$", re.IGNORECASE)
 
 
 def is_valid_host(hostname):
@@ -167,6 +167,7 @@ def recognizable_ip(ip_str):
     else:
         return False
 
+
 #
 # def pull_from_sock(field, sock):
 #     dat_ = None
@@ -182,15 +183,26 @@ def recognizable_ip(ip_str):
 #         return None
 
 
-async def async_pull(field, loop, sock):
+async def async_pull(field, loop, sock, recv=None):
+    # recv: coroutine function standing in for loop.sock_recv(sock, n).
+    # The peer closing before the first byte is a plain close, not an
+    # error: None without a traceback.
     dat_ = None
+    received = 0
     try:
         while True:
             len_ = field.send(dat_)
-            dat_ = await loop.sock_recv(sock, len_)
+            if recv is None:
+                dat_ = await loop.sock_recv(sock, len_)
+            else:
+                dat_ = await recv(len_)
+            if len_ and not dat_:
+                if received:
+                    log.info("peer closed after %u bytes" % received)
+                return None
+            received += len(dat_)
     except StopIteration as e:
         return e.value
     except Exception as e:
         log.exception(e)
         return None
-
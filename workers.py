@@ -0,0 +1,220 @@
+import asyncio
+import errno
+import json
+import os
+import selectors
+import signal
+import time
+
+from utils.loggers import get_logger
+
+log = get_logger("workers")
+
+DRAIN_TIMEOUT = 30.0
+METRICS_INTERVAL = 10.0
+RESTART_BACKOFF = 1.0
+
+
+def serve(relay_factory, reuse_port=False, metrics_fd=None):
+    """
+    Run one relay on its own event loop until SIGTERM. On SIGTERM the
+    listener is closed and in-flight connections get DRAIN_TIMEOUT seconds
+    to finish. When ``metrics_fd`` is given the relay's totals are written
+    to it as one json line every METRICS_INTERVAL seconds.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    relay = relay_factory(loop, reuse_port)
+    accept_task = loop.create_task(relay.accept())
+
+    def _report():
+        line = json.dumps(dict(relay.stats.as_dict(), pid=os.getpid()))
+        try:
+            os.write(metrics_fd, line.encode("utf8") + b"\n")
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            log.info("metrics pipe closed: %r" % e)
+            return
+        loop.call_later(METRICS_INTERVAL, _report)
+
+    async def _shutdown():
+        log.info(
+            "worker %u draining %u connections"
+            % (os.getpid(), relay.stats.connections_active)
+        )
+        accept_task.cancel()
+        relay.close()
+        left = await relay.drain(DRAIN_TIMEOUT)
+        relay.shutdown()
+        if left:
+            log.info(
+                "worker %u gave up on %u connections" % (os.getpid(), left)
+            )
+        loop.stop()
+
+    loop.add_signal_handler(
+        signal.SIGTERM, lambda: loop.create_task(_shutdown())
+    )
+    if metrics_fd is not None:
+        loop.call_later(METRICS_INTERVAL, _report)
+    try:
+        loop.run_forever()
+    finally:
+        if metrics_fd is not None:
+            _report()
+        loop.close()
+
+
+class Worker:
+    def __init__(self, pid, metrics_fd):
+        self.pid = pid
+        self.metrics_fd = metrics_fd
+        self.started = time.time()
+        self.buffer = b""
+        self.metrics = {}
+
+
+class Supervisor:
+    """
+    Forks ``workers`` processes that each bind the listener with
+    SO_REUSEPORT, restarts any that die and sums the metrics they report.
+    SIGTERM/SIGINT are forwarded to the workers as SIGTERM so they drain.
+    """
+
+    def __init__(self, relay_factory, workers):
+        self._relay_factory = relay_factory
+        self._nworkers = workers
+        self._workers = {}
+        self._select = selectors.DefaultSelector()
+        self._stopping = False
+        self._last_report = time.time()
+        self._retired = {}
+
+    def _spawn(self):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            for worker in self._workers.values():
+                if worker.metrics_fd is not None:
+                    os.close(worker.metrics_fd)
+            self._select.close()
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                os.set_blocking(wfd, False)
+                serve(self._relay_factory, True, wfd)
+            except Exception as e:
+                log.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(wfd)
+        worker = Worker(pid, rfd)
+        self._workers[pid] = worker
+        self._select.register(rfd, selectors.EVENT_READ, worker)
+        log.info("worker %u started" % pid)
+        return worker
+
+    def _read_metrics(self, worker):
+        try:
+            data = os.read(worker.metrics_fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            data = b""
+        if not data:
+            self._select.unregister(worker.metrics_fd)
+            os.close(worker.metrics_fd)
+            worker.metrics_fd = None
+            return
+        lines = (worker.buffer + data).split(b"\n")
+        worker.buffer = lines.pop()
+        for line in lines:
+            if line:
+                worker.metrics = json.loads(line.decode("utf8"))
+
+    def _reap(self):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            worker = self._workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.metrics_fd is not None:
+                self._read_metrics(worker)
+            if worker.metrics_fd is not None:
+                self._select.unregister(worker.metrics_fd)
+                os.close(worker.metrics_fd)
+            self._retire(worker)
+            log.info("worker %u exited with status %r" % (pid, status))
+            if not self._stopping:
+                if time.time() - worker.started < RESTART_BACKOFF:
+                    time.sleep(RESTART_BACKOFF)
+                self._spawn()
+
+    def _retire(self, worker):
+        # keep the counters of dead workers so totals do not go backwards
+        for key, value in worker.metrics.items():
+            if key in ("pid", "connections_active"):
+                continue
+            self._retired[key] = self._retired.get(key, 0) + value
+
+    def metrics(self):
+        """
+        Sum of the latest metrics reported by every worker, dead or alive.
+        """
+        total = dict(self._retired)
+        total["connections_active"] = 0
+        for worker in self._workers.values():
+            for key, value in worker.metrics.items():
+                if key != "pid":
+                    total[key] = total.get(key, 0) + value
+        total["workers"] = len(self._workers)
+        return total
+
+    def _stop(self, signum, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        log.info(
+            "supervisor stopping, draining %u workers" % len(self._workers)
+        )
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self._nworkers):
+            self._spawn()
+        while self._workers:
+            for key, mask in self._select.select(timeout=1.0):
+                self._read_metrics(key.data)
+            self._reap()
+            now = time.time()
+            if now - self._last_report > METRICS_INTERVAL:
+                self._last_report = now
+                log.info("metrics: %r" % self.metrics())
+        log.info("all workers exited, metrics: %r" % self.metrics())
+        self._select.close()
+
+
+def run(relay_factory, workers=0):
+    """
+    ``relay_factory(loop, reuse_port)`` builds a TCPRelay. With no workers
+    the relay runs in this process, otherwise under a Supervisor.
+    """
+    if workers > 0:
+        Supervisor(relay_factory, workers).run()
+    else:
+        serve(relay_factory)